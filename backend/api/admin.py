@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.utils.html import mark_safe
-from .models import Profile, FriendRequest, Message
+from .models import Profile, FriendRequest, Message, Conversation
 
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'first_name', 'last_name', 'profile_image_preview')
@@ -18,3 +18,4 @@ class ProfileAdmin(admin.ModelAdmin):
 admin.site.register(Profile, ProfileAdmin)
 admin.site.register(FriendRequest)
 admin.site.register(Message)
+admin.site.register(Conversation)
@@ -1,6 +1,29 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from . import authentication, friendships, rooms, versions
+        from .models import Conversation, FriendRequest, Profile, RoomMember, conversations_changed
+
+        post_save.connect(authentication.user_changed, sender=User)
+        post_delete.connect(authentication.user_changed, sender=User)
+
+        post_save.connect(friendships.friend_request_changed, sender=FriendRequest)
+        post_delete.connect(friendships.friend_request_changed, sender=FriendRequest)
+
+        post_save.connect(rooms.member_changed, sender=RoomMember)
+        post_delete.connect(rooms.member_changed, sender=RoomMember)
+
+        # Versions behind the ETags in api/versions.py
+        post_save.connect(versions.user_saved, sender=User)
+        post_save.connect(versions.profile_saved, sender=Profile)
+        post_delete.connect(versions.profile_saved, sender=Profile)
+        post_save.connect(versions.friend_request_changed, sender=FriendRequest)
+        post_delete.connect(versions.friend_request_changed, sender=FriendRequest)
+        conversations_changed.connect(versions.conversations_changed, sender=Conversation)
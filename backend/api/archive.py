@@ -0,0 +1,188 @@
+"""
+Cold storage for old messages.
+
+archive_messages moves whole months out of api_message: each month
+becomes one file in the "message_archive" storage holding one gzip member
+per conversation, and a MessageArchive row per member records where it
+is. Concatenated gzip members are themselves a valid gzip file, so an
+archive can also be read whole with zcat. On PostgreSQL the month's
+partition is then dropped; elsewhere its rows are deleted.
+
+ConversationArchive reads the segments back for MessageListView once a
+conversation's scrollback runs past what is still in the table.
+"""
+import gzip
+import io
+import json
+import logging
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.db import connection, transaction
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from . import partitions
+from .log import log
+from .models import Message, MessageArchive
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 2000
+
+
+def get_storage():
+    return storages["message_archive"]
+
+
+def cutoff(now=None):
+    """Start of the oldest month that stays in the table."""
+    return partitions.add_months(partitions.month_start(now or timezone.now()), -settings.MESSAGE_HOT_MONTHS)
+
+
+def archivable_months(before):
+    """Months older than `before` that still have messages in the table."""
+    if partitions.is_partitioned(connection):
+        # Late rows for an archived month would sit in the default partition
+        partitions.ensure_partitions(connection, partitions.month_start(timezone.now()))
+        return sorted(month for month in partitions.partitions(connection) if month < before)
+    oldest = Message.objects.filter(timestamp__lt=before).order_by("timestamp").values_list("timestamp", flat=True).first()
+    months = []
+    month = partitions.month_start(oldest) if oldest else before
+    while month < before:
+        months.append(month)
+        month = partitions.add_months(month, 1)
+    return months
+
+
+def encode_segment(messages):
+    lines = [
+        json.dumps({
+            "id": message.id,
+            "sender": message.sender_id,
+            "receiver": message.receiver_id,
+            "content": message.content,
+            "timestamp": message.timestamp.isoformat(),
+        }, ensure_ascii=False)
+        for message in messages
+    ]
+    return gzip.compress(("\n".join(lines) + "\n").encode(), compresslevel=9)
+
+
+def decode_segment(data):
+    return [
+        Message(
+            id=row["id"], sender_id=row["sender"], receiver_id=row["receiver"],
+            content=row["content"], timestamp=datetime.fromisoformat(row["timestamp"]),
+        )
+        for row in map(json.loads, gzip.decompress(data).decode().splitlines())
+    ]
+
+
+def segment_entry(month, pair, messages, offset, length):
+    return MessageArchive(
+        user_low_id=pair[0], user_high_id=pair[1], month=month.date(), offset=offset, length=length,
+        count=len(messages), first_timestamp=messages[0].timestamp, first_id=messages[0].id,
+        last_timestamp=messages[-1].timestamp, last_id=messages[-1].id,
+    )
+
+
+def archive_month(month):
+    """
+    Move every message of `month` into an archive file. Returns the number
+    of messages archived. The month's rows are locked against new writes
+    while they are copied, so nothing inserted meanwhile is dropped.
+    """
+    end = partitions.add_months(month, 1)
+    with transaction.atomic():
+        if partitions.is_partitioned(connection):
+            with connection.cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {partitions.partition_name(month)} IN SHARE MODE")
+        rows = Message.objects.filter(timestamp__gte=month, timestamp__lt=end).annotate(
+            low=Least("sender_id", "receiver_id"), high=Greatest("sender_id", "receiver_id")
+        ).order_by("low", "high", "timestamp", "id")
+
+        buffer, entries, pair, messages = io.BytesIO(), [], None, []
+
+        def flush():
+            data = encode_segment(messages)
+            entries.append(segment_entry(month, pair, messages, buffer.tell(), len(data)))
+            buffer.write(data)
+
+        for message in rows.iterator(chunk_size=BATCH_SIZE):
+            if (message.low, message.high) != pair:
+                if messages:
+                    flush()
+                pair, messages = (message.low, message.high), []
+            messages.append(message)
+        if messages:
+            flush()
+
+        if entries:
+            path = get_storage().save(f"messages/{month:%Y-%m}.ndjson.gz", ContentFile(buffer.getvalue()))
+            for entry in entries:
+                entry.path = path
+            MessageArchive.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+        if partitions.is_partitioned(connection):
+            with connection.cursor() as cursor:
+                partitions.drop_partition(cursor, month)
+        elif entries:
+            # Rows that arrived after the read have higher ids and stay put
+            newest_id = max(entry.last_id for entry in entries)
+            Message.objects.filter(timestamp__gte=month, timestamp__lt=end, id__lte=newest_id).delete()
+
+    count = sum(entry.count for entry in entries)
+    log(logger, logging.INFO, "archive.month", month=f"{month:%Y-%m}", messages=count, conversations=len(entries))
+    return count
+
+
+class ConversationArchive:
+    """
+    Archived messages between two users, read a page at a time. Keys are
+    (timestamp, id), the order MessageCursorPagination walks in.
+    """
+
+    def __init__(self, user_id, other_id):
+        self.user_low, self.user_high = sorted((int(user_id), int(other_id)))
+
+    def segments(self):
+        # Read from the table on every page, not a per-process cache, so a
+        # worker sees months archived by another process straight away.
+        # Served by archive_pair_recent_idx.
+        return MessageArchive.objects.filter(user_low_id=self.user_low, user_high_id=self.user_high)
+
+    def load(self, segment):
+        with get_storage().open(segment.path, "rb") as archive:
+            archive.seek(segment.offset)
+            return decode_segment(archive.read(segment.length))
+
+    def before(self, key, limit):
+        """Up to `limit` messages older than key (all, if key is None), newest first."""
+        segments = self.segments().order_by("-last_timestamp", "-last_id")
+        if key is not None:
+            segments = segments.filter(first_timestamp__lte=key[0])
+        return self.collect(segments, limit, reverse=True, keep=lambda k: key is None or k < key)
+
+    def after(self, key, limit):
+        """Up to `limit` messages newer than key, oldest first."""
+        segments = self.segments().filter(last_timestamp__gte=key[0]).order_by("first_timestamp", "first_id")
+        return self.collect(segments, limit, reverse=False, keep=lambda k: k > key)
+
+    def collect(self, segments, limit, reverse, keep):
+        rows = []
+        for segment in segments:
+            # Segments are visited nearest first; once the page is full only
+            # one overlapping it (a month archived twice) can still matter
+            edge = (segment.last_timestamp, segment.last_id) if reverse else (segment.first_timestamp, segment.first_id)
+            if len(rows) >= limit and (edge < key_of(rows[limit - 1]) if reverse else edge > key_of(rows[limit - 1])):
+                break
+            rows.extend(message for message in self.load(segment) if keep(key_of(message)))
+            rows.sort(key=key_of, reverse=reverse)
+        return rows[:limit]
+
+
+def key_of(message):
+    return (message.timestamp, message.id)
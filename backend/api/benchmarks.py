@@ -0,0 +1,127 @@
+"""
+Seeded data and endpoint definitions shared by the query budget tests in
+api/tests.py and the `bench_api` timing command.
+"""
+import itertools
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Conversation, FriendRequest, Message, Profile, Room, RoomMember, RoomMessage
+from .pagination import encode_cursor
+
+
+_usernames = itertools.count()
+
+
+def make_users(count, first_name, last_name="Bench"):
+    usernames = [f"bench_{next(_usernames)}" for _ in range(count)]
+    User.objects.bulk_create([User(username=username, password="!") for username in usernames])
+    users = list(User.objects.filter(username__in=usernames).order_by("id"))
+    profiles = []
+    for i, user in enumerate(users):
+        profile = Profile(user=user, first_name=f"{first_name}{i}", last_name=last_name)
+        profile.set_search_names()
+        profiles.append(profile)
+    Profile.objects.bulk_create(profiles)
+    return users
+
+
+class Dataset:
+    """
+    One user ("me") with `size` friends, `size` incoming and `size` outgoing
+    pending requests, `size` strangers matching a search, and
+    `messages_per_friend` messages in each direction with every friend.
+    "me" and every friend also share a room, where each friend has posted
+    `messages_per_friend` messages.
+    """
+
+    def __init__(self, size, messages_per_friend=3):
+        self.size = size
+        # Everything seeded below shows up in a sync from here
+        self.sync_cursor = encode_cursor(timezone.now() - timedelta(minutes=1), 0)
+        with transaction.atomic():
+            self.me = make_users(1, "Owner")[0]
+            self.friends = make_users(size, "Friend")
+            self.requesters = make_users(size, "Requester")
+            self.requested = make_users(size, "Requested")
+            self.strangers = make_users(size, "Stranger")
+
+            FriendRequest.objects.bulk_create(
+                [
+                    # Half the friendships were initiated by each side
+                    FriendRequest(from_user=self.me, to_user=friend, status="accepted") if i % 2 else
+                    FriendRequest(from_user=friend, to_user=self.me, status="accepted")
+                    for i, friend in enumerate(self.friends)
+                ] + [
+                    FriendRequest(from_user=user, to_user=self.me) for user in self.requesters
+                ] + [
+                    FriendRequest(from_user=self.me, to_user=user) for user in self.requested
+                ]
+            )
+
+            messages = []
+            for friend in self.friends:
+                for i in range(messages_per_friend):
+                    messages.append(Message(sender=friend, receiver=self.me, content=f"hello {i}"))
+                    messages.append(Message(sender=self.me, receiver=friend, content=f"hi {i}"))
+            Message.objects.bulk_create(messages)
+            Conversation.objects.record_messages(list(Message.objects.filter(id__in=[message.id for message in messages])))
+
+            self.room = Room.objects.create(name="Bench room", created_by=self.me)
+            RoomMember.objects.bulk_create([RoomMember(room=self.room, user=user) for user in [self.me, *self.friends]])
+            RoomMessage.objects.bulk_create([
+                RoomMessage(room=self.room, sender=friend, content=f"hey {i}")
+                for friend in self.friends for i in range(messages_per_friend)
+            ])
+
+        self.friend = self.friends[0]
+        self.last_message_id = Message.objects.filter(sender=self.friend, receiver=self.me).order_by("-id").values_list("id", flat=True).first()
+
+    def pending_request(self):
+        """A fresh incoming request for accept/reject."""
+        requester = make_users(1, "Late")[0]
+        return FriendRequest.objects.create(from_user=requester, to_user=self.me)
+
+
+class Endpoint:
+    """
+    A request against one route. `prepare(dataset)` returns (path, data) and
+    runs outside the measured block, so writes it needs don't count.
+    `budget` is the most queries the request may run at any dataset size.
+    """
+
+    def __init__(self, name, method, budget, prepare):
+        self.name = name
+        self.method = method
+        self.budget = budget
+        self.prepare = prepare
+
+    def request(self, client, dataset):
+        path, data = self.prepare(dataset)
+        return getattr(client, self.method)(path, data, format="json")
+
+
+ENDPOINTS = [
+    Endpoint("profile", "get", 1, lambda d: ("/api/profile/", None)),
+    Endpoint("user_search", "get", 1, lambda d: ("/api/users/search/", {"q": "stranger"})),
+    Endpoint("friends_incoming", "get", 1, lambda d: ("/api/friends/incoming/", None)),
+    Endpoint("friends_outgoing", "get", 1, lambda d: ("/api/friends/outgoing/", None)),
+    Endpoint("friends", "get", 1, lambda d: ("/api/friends/", None)),
+    Endpoint("has_new_message", "get", 2, lambda d: ("/api/has_new_message/", None)),
+    # A short history's only page also checks the archive for older months
+    Endpoint("message_list", "get", 3, lambda d: (f"/api/messages/{d.friend.id}/", None)),
+    Endpoint("sync", "get", 3, lambda d: ("/api/sync/", {"since": d.sync_cursor})),
+    Endpoint("message_create", "post", 7, lambda d: ("/api/messages/", {"receiver": d.friend.id, "content": "benchmark"})),
+    Endpoint("mark_read", "post", 1, lambda d: ("/api/messages/read/", {"friend_id": d.friend.id, "message_id": d.last_message_id})),
+    Endpoint("friend_request_send", "post", 6, lambda d: ("/api/friends/request/", {"to_username": make_users(1, "Target")[0].username})),
+    Endpoint("friend_request_accept", "put", 2, lambda d: (f"/api/friends/accept/{d.pending_request().id}/", None)),
+    Endpoint("friend_request_reject", "delete", 2, lambda d: (f"/api/friends/reject/{d.pending_request().id}/", None)),
+    Endpoint("metrics", "get", 0, lambda d: ("/api/metrics/", None)),
+    Endpoint("rooms", "get", 1, lambda d: ("/api/rooms/", None)),
+    Endpoint("room_messages", "get", 1, lambda d: (f"/api/rooms/{d.room.id}/messages/", None)),
+    Endpoint("room_message_create", "post", 5, lambda d: (f"/api/rooms/{d.room.id}/messages/", {"content": "benchmark"})),
+    Endpoint("room_read", "post", 1, lambda d: (f"/api/rooms/{d.room.id}/read/", {"message_id": d.room.messages.latest("id").id})),
+]
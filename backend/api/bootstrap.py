@@ -0,0 +1,62 @@
+from django.db.models import F, Q
+
+from . import friendships
+from .models import Conversation, FriendRequest, Profile
+from .serializers import FriendRequestSerializer, ProfileSerializer
+
+
+def friends(user_id, context=None):
+    """
+    The user's friends as serialized profiles with their unread state,
+    friends we have talked to first (newest conversation first), then
+    everyone else. Two queries once the friend ids are cached.
+    """
+    friend_ids = friendships.get_friend_ids(user_id)
+
+    # Conversations come back newest first straight from the index
+    conversations = {}
+    for conversation in Conversation.objects.for_user(user_id).filter(
+        Q(user_low_id__in=friend_ids) | Q(user_high_id__in=friend_ids)
+    ).order_by(F("last_message_at").desc(nulls_last=True), "-id"):
+        conversations[conversation.other_user_id(user_id)] = conversation
+
+    profiles = {
+        profile.user_id: profile
+        for profile in Profile.objects.filter(user_id__in=friend_ids).select_related("user")
+    }
+    ordered_ids = list(conversations) + sorted(friend_ids - conversations.keys())
+    ordered = [profiles[friend_id] for friend_id in ordered_ids if friend_id in profiles]
+
+    result = []
+    for profile_data in ProfileSerializer(ordered, many=True, context=context).data:
+        conversation = conversations.get(profile_data["user_id"])
+        unread_count = conversation.unread_count_for(user_id) if conversation else 0
+        result.append({
+            **profile_data,
+            "unread_count": unread_count,
+            "last_read_id": conversation.last_read_id_for(user_id) if conversation else 0,
+            "has_new_message": unread_count > 0,
+        })
+    return result
+
+
+def snapshot(user_id):
+    """
+    What a client needs to draw its first screen: the user's own profile
+    (None before one is created), friends with presence and unread state,
+    and pending requests in both directions. Five queries however many
+    friends and requests there are, four once the friend ids are cached.
+    """
+    profile = Profile.objects.filter(user_id=user_id).select_related("user").first()
+    pending = FriendRequest.objects.filter(
+        Q(from_user_id=user_id) | Q(to_user_id=user_id), status="pending"
+    ).select_related("from_user__profile", "to_user__profile")
+    incoming, outgoing = [], []
+    for request_data in FriendRequestSerializer(pending, many=True).data:
+        (incoming if request_data["to_user"]["id"] == user_id else outgoing).append(request_data)
+    return {
+        "profile": ProfileSerializer(profile).data if profile else None,
+        "friends": friends(user_id),
+        "incoming": incoming,
+        "outgoing": outgoing,
+    }
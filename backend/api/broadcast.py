@@ -0,0 +1,60 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import delivery, metrics
+
+
+async def group_send_many(groups, message, channel_layer=None):
+    """
+    Send one message to many groups concurrently instead of awaiting each
+    group_send in turn. At most BROADCAST_CONCURRENCY sends are in flight so
+    a large fan-out can't exhaust the channel layer's connection pool.
+    """
+    groups = list(dict.fromkeys(groups))
+    await _send_all([(group, message) for group in groups], channel_layer)
+
+
+async def send_to_users(user_ids, message, channel_layer=None):
+    """
+    Like group_send_many over the users' groups, but every copy carries the
+    user's next sequence number and is retained so a reconnecting client
+    can be sent what it missed (see api/delivery.py). Use this for events
+    the client must not lose; typing and presence stay fire-and-forget.
+    """
+    sequenced = await sync_to_async(delivery.sequence, thread_sensitive=False)(user_ids, message)
+    await _send_all([(user_group(user_id), message) for user_id, message in sequenced.items()], channel_layer)
+
+
+async def _send_all(sends, channel_layer=None):
+    channel_layer = channel_layer or get_channel_layer()
+    if not sends:
+        return
+    if len(sends) == 1:
+        await metrics.group_send(channel_layer, *sends[0])
+        return
+
+    semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+
+    async def send(group, message):
+        async with semaphore:
+            await metrics.group_send(channel_layer, group, message)
+
+    await asyncio.gather(*(send(group, message) for group, message in sends))
+
+
+def broadcast(groups, message):
+    # Entry point for sync code such as the REST views
+    async_to_sync(group_send_many)(groups, message)
+
+
+def notify_users(user_ids, message):
+    # Sync entry point for send_to_users
+    async_to_sync(send_to_users)(user_ids, message)
+
+
+def user_group(user_id):
+    return f"user_{user_id}"
@@ -1,186 +1,356 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
-from .models import Profile, FriendRequest, Message
-from .serializers import MessageSerializer
-import django.db.models as models
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .models import Message, Conversation
+from . import bootstrap, delivery, events, friendships, metrics, presence, profiling, rooms, sync, typing_indicators, write_behind
+from .broadcast import group_send_many, send_to_users, user_group
+from .log import log
+from .metrics import database_sync_to_async
+import asyncio
 import json
-from django.utils import timezone
+import logging
 from urllib.parse import parse_qs
+from django.db import transaction
+
+
+logger = logging.getLogger(__name__)
+
+PONG = json.dumps({"type": "pong"})
+
+# Frame types counted under their own label; anything else is "other"
+FRAME_TYPES = {"ping", "ack", "replay", "send_message", "typing", "mark_read", "send_room_message", "mark_room_read"}
 
 
 class FriendConsumer(AsyncWebsocketConsumer):
+    # connect() can close or raise before setting these; disconnect() runs anyway
+    user = None
+    group_name = None
+    room_ids = ()
+    head_seq = 0
+    accepted = False
+    presence_task = None
+
     async def connect(self):
-        # Get user_id from query string
-        query_string = self.scope['query_string'].decode()
-        query_params = parse_qs(query_string)
-        user_id = query_params.get('user_id', [None])[0]
+        # Set by JWTAuthMiddleware from the access token in the query string
+        user = self.scope.get("user")
+        self.user = user if user is not None and user.is_authenticated else None
+        if not self.user:
+            metrics.WS_CONNECTS.labels(result="rejected").inc()
+            await self.close(code=4001)
+            return
 
-        self.user = None
-        if user_id:
-            try:
-                self.user = await database_sync_to_async(User.objects.get)(id=user_id)
-            except User.DoesNotExist:
-                print(f"User with id {user_id} not found")
+        self.group_name = user_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # One group per room, so a room message is a single group_send
+        self.room_ids = set(await database_sync_to_async(rooms.get_room_ids)(self.user.id))
+        await asyncio.gather(*(
+            self.channel_layer.group_add(rooms.room_group(room_id), self.channel_name) for room_id in self.room_ids
+        ))
 
-        print(f"WebSocket connect attempt by user: {self.user}, user_id: {user_id}")
+        await self.accept()
+        self.accepted = True
+        metrics.WS_CONNECTS.labels(result="accepted").inc()
+        metrics.WS_CONNECTIONS.inc()
+        log(logger, logging.INFO, "ws.connect", user_id=self.user.id, channel=self.channel_name)
 
-        # Always join a group (even anonymous gets a placeholder group)
-        self.group_name = f"user_{self.user.id if self.user else 'anonymous'}"
-        print(f"Joining group: {self.group_name}")
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # Catch the client up on anything it missed while disconnected:
+        # from the event buffer if it still reaches back far enough,
+        # otherwise with a delta sync from the database. A client with no
+        # cursor at all gets its whole first screen instead.
+        with profiling.profile("ws.connect", user_id=self.user.id):
+            if not await self.replay_missed():
+                if self.query_param("since") is None and settings.WS_BOOTSTRAP:
+                    await self.send_bootstrap()
+                else:
+                    await self.send_sync(self.query_param("since"))
 
-        if self.user:
-            await self.update_online_status(True)
-            await self.notify_friends_status(True)
+        # Presence bookkeeping and the friend fan-out happen after the socket
+        # is accepted so a user with many friends doesn't wait on them.
+        self.presence_task = asyncio.create_task(self.announce_online())
 
-        await self.accept()
+    def query_param(self, name):
+        return parse_qs(self.scope.get("query_string", b"").decode()).get(name, [None])[0]
+
+    async def replay_missed(self):
+        # ?seq= is the last sequence this client processed; a client that
+        # only kept its sync cursor resumes from the user's last ack.
+        seq = self.query_param("seq")
+        try:
+            after = None if seq is None else int(seq)
+        except ValueError:
+            seq = after = None
+        self.head_seq, missed = await sync_to_async(delivery.missed, thread_sensitive=False)(self.user.id, after)
+        if missed is None or (seq is None and self.query_param("since") is None):
+            # Gap in the buffer, or a first connect that needs a cursor
+            return False
+        await self.send_missed(missed)
+        return True
+
+    async def send_missed(self, missed):
+        for text in missed:
+            await self.send(text_data=text)
+        metrics.WS_EVENTS_SENT.labels(type="replay").inc(len(missed))
+
+    async def send_sync(self, since=None):
+        try:
+            data = await database_sync_to_async(sync.delta)(self.user.id, since)
+        except ValueError:
+            # Unusable cursor: hand out a fresh one, the client reloads
+            data = await database_sync_to_async(sync.delta)(self.user.id)
+            data["reset"] = True
+        # Sequence numbers restart from here
+        data["seq"] = self.head_seq
+        await self.send(text_data=events.dumps({"event": "sync", **data}))
+        metrics.WS_EVENTS_SENT.labels(type="sync").inc()
+
+    async def send_bootstrap(self):
+        data = await self.load_bootstrap()
+        data["seq"] = self.head_seq
+        await self.send(text_data=events.dumps({"event": "bootstrap", **data}))
+        metrics.WS_EVENTS_SENT.labels(type="bootstrap").inc()
+
+    async def announce_online(self):
+        tracker = presence.get_tracker()
+        tracker.ensure_sweeper()
+        came_online = await sync_to_async(tracker.connect, thread_sensitive=False)(
+            self.user.id, self.channel_name
+        )
+        # A second tab doesn't change what friends see
+        if came_online:
+            await self.notify_friends_status(True)
 
     async def disconnect(self, close_code):
-        if hasattr(self, "user") and self.user:
-            print(f"WebSocket disconnected for user: {self.user}, close_code: {close_code}")
-            await self.channel_layer.group_discard(self.group_name, self.channel_name)
-            await self.update_online_status(False)
-            await self.notify_friends_status(False)
+        if self.accepted:
+            metrics.WS_CONNECTIONS.dec()
+        if self.user:
+            log(logger, logging.INFO, "ws.disconnect", user_id=self.user.id, close_code=close_code)
+            with profiling.profile("ws.disconnect", user_id=self.user.id):
+                await self.channel_layer.group_discard(self.group_name, self.channel_name)
+                await asyncio.gather(*(
+                    self.channel_layer.group_discard(rooms.room_group(room_id), self.channel_name)
+                    for room_id in self.room_ids
+                ))
+                # Nobody keeps seeing us type after we leave
+                await group_send_many(
+                    [user_group(receiver_id) for receiver_id in typing_indicators.get_coalescer().stop_sender(self.user.id)],
+                    events.typing_indicator(self.user.id, self.user.username, False),
+                    self.channel_layer
+                )
+                # A connect that failed before announcing us has nothing to
+                # undo, and removing the socket anyway would unbalance the
+                # refcount for the user's other tabs.
+                if self.presence_task is None:
+                    return
+                # Let the connect bookkeeping land first so the refcount stays balanced
+                await asyncio.gather(self.presence_task, return_exceptions=True)
+                went_offline = await sync_to_async(presence.get_tracker().disconnect, thread_sensitive=False)(
+                    self.user.id, self.channel_name
+                )
+                if went_offline:
+                    await self.notify_friends_status(False)
 
     async def receive(self, text_data):
+        with metrics.WS_HANDLER_SECONDS.labels(handler="receive").time(), \
+                profiling.profile("ws.receive", user_id=self.user.id) as query_profile:
+            await self.handle_frame(text_data, query_profile)
+
+    async def handle_frame(self, text_data, query_profile=None):
         data = json.loads(text_data)
-        print("WS received:", data)
+        frame_type = data.get("type") or data.get("event")
+        frame_type = frame_type if frame_type in FRAME_TYPES else "other"
+        if query_profile is not None:
+            query_profile.fields["type"] = frame_type
+        metrics.WS_EVENTS_RECEIVED.labels(type=frame_type).inc()
+        # Never the content, and only a sample: this runs for every frame
+        log(
+            logger, logging.DEBUG, "ws.frame", sample_rate=settings.WS_FRAME_LOG_SAMPLE_RATE,
+            user_id=self.user.id, type=frame_type, size=len(text_data),
+        )
 
         if data.get("type") == "ping":
-            await self.send(text_data=json.dumps({"type": "pong"}))
+            await self.send(text_data=PONG)
+            metrics.WS_EVENTS_SENT.labels(type="pong").inc()
+            return
+
+        if data.get("type") == "ack":
+            # Highest sequence the client has processed; it resumes from here
+            try:
+                seq = int(data["seq"])
+            except (KeyError, TypeError, ValueError):
+                return
+            await sync_to_async(delivery.get_buffer().ack, thread_sensitive=False)(self.user.id, seq)
+            return
+
+        if data.get("type") == "replay":
+            # The client saw a gap after `seq` that didn't fill on its own
+            try:
+                seq = int(data["seq"])
+            except (KeyError, TypeError, ValueError):
+                return
+            self.head_seq, missed = await sync_to_async(delivery.missed, thread_sensitive=False)(self.user.id, seq)
+            if missed is None:
+                # Trimmed already; a sync restarts the sequence
+                await self.send_sync(data.get("since"))
+            else:
+                await self.send_missed(missed)
             return
 
         if data.get("event") == "send_message":
-            receiver_id = data.get("receiver_id")
             content = data.get("content")
-            if not receiver_id or not content:
+            receiver_id = await self.message_receiver(data.get("receiver_id"))
+            if receiver_id is None or not content:
                 return
 
-            # Save to DB
-            message = await self.save_message(receiver_id, content)
-            serialized = MessageSerializer(message).data
-
-            # Broadcast to receiver group
-            await self.channel_layer.group_send(
-                f"user_{receiver_id}",
-                {
-                    "type": "chat_message",
-                    "message": serialized
-                }
-            )
-
-            # Broadcast to sender group too
-            await self.channel_layer.group_send(
-                f"user_{self.user.id}",
-                {
-                    "type": "chat_message",
-                    "message": serialized
-                }
+            if settings.MESSAGE_WRITE_BEHIND:
+                # The insert happens later
+                writer = write_behind.get_writer()
+                message = writer.build(self.user.id, int(receiver_id), content)
+                await writer.submit(message)
+            else:
+                # Save to DB
+                message = await self.save_message(receiver_id, content)
+            # Broadcast to receiver and sender groups together
+            await send_to_users(
+                [receiver_id, self.user.id],
+                events.new_message(events.message_data(message)),
+                self.channel_layer
             )
         
         elif data.get("event") == "typing":
             receiver_id = data.get("receiver_id")
-            is_typing = data.get("is_typing", False)
+            is_typing = bool(data.get("is_typing", False))
 
-            if receiver_id:
+            try:
+                receiver_id = int(receiver_id)
+            except (TypeError, ValueError):
+                return
+            # Keystroke-rate events are collapsed to state changes
+            coalescer = typing_indicators.get_coalescer()
+            coalescer.ensure_sweeper()
+            if coalescer.update(self.user.id, receiver_id, self.user.username, is_typing):
                 # Send typing event to receiver
-                await self.channel_layer.group_send(
-                    f"user_{receiver_id}",
-                    {
-                        "type": "typing_indicator",
-                        "user_id": self.user.id,
-                        "username": self.user.username,
-                        "is_typing": is_typing
-                    }
+                await metrics.group_send(
+                    self.channel_layer,
+                    user_group(receiver_id),
+                    events.typing_indicator(self.user.id, self.user.username, is_typing)
                 )
 
-    # Generic chat message handler (same for sender + receiver)
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            "event": "new_message",
-            "message": event["message"]
-        }))
-
-    async def typing_indicator(self, event):
-        await self.send(text_data=json.dumps({
-            "event": "typing_indicator",
-            "user_id": event["user_id"],
-            "username": event["username"],
-            "is_typing": event["is_typing"],
-        }))
-
-    async def friend_request(self, event):
-        await self.send(text_data=json.dumps({
-            "event": "friend_request",
-            "from_user": event["from_user"],
-            "request_id": event["request_id"]
-        }))
-
-    async def friend_request_accepted(self, event):
-        await self.send(text_data=json.dumps({
-            "event": "friend_request_accepted",
-            "from_user": event["from_user"],
-            "to_user": event["to_user"],
-            "request_id": event["request_id"]
-        }))
-
-    async def online_status(self, event):
-        await self.send(text_data=json.dumps({
-            "event": "online_status",
-            "user_id": event["user_id"],
-            "username": event["username"],
-            "is_online": event["is_online"]
-        }))
-
-    async def new_message_dot(self, event):
-        await self.send(text_data=json.dumps({
-            "event": "new_message_dot",
-        }))
+        elif data.get("event") == "mark_read":
+            # One marker, or a batch under "conversations"
+            markers = data.get("conversations") or [data]
+            watermarks = {}
+            for marker in markers:
+                try:
+                    message_id = marker.get("message_id")
+                    watermarks[int(marker["friend_id"])] = None if message_id is None else int(message_id)
+                except (AttributeError, KeyError, TypeError, ValueError):
+                    return
+            if await self.mark_read(watermarks):
+                await send_to_users(
+                    [self.user.id], events.conversation_read(list(watermarks)), self.channel_layer
+                )
 
-    @database_sync_to_async
-    def update_online_status(self, is_online):
-        if not self.user:
-            return
+        elif data.get("event") == "send_room_message":
+            content = data.get("content")
+            try:
+                room_id = int(data.get("room_id"))
+            except (TypeError, ValueError):
+                return
+            if not content or not await database_sync_to_async(rooms.is_member)(self.user.id, room_id):
+                return
+            message = await database_sync_to_async(rooms.record_message)(room_id, self.user.id, content)
+            # Every member's sockets are in the room's group
+            await rooms.apublish(room_id, events.room_message(events.room_message_data(message)), self.channel_layer)
+
+        elif data.get("event") == "mark_room_read":
+            try:
+                room_id, message_id = int(data["room_id"]), int(data["message_id"])
+            except (KeyError, TypeError, ValueError):
+                return
+            if await database_sync_to_async(rooms.mark_read)(room_id, self.user.id, message_id):
+                await send_to_users([self.user.id], events.room_read(room_id, message_id), self.channel_layer)
+
+    # Events arrive already encoded (see api/events.py), so every handler
+    # just forwards the text to the socket.
+    async def forward(self, event):
+        with metrics.WS_HANDLER_SECONDS.labels(handler=event["type"]).time():
+            await self.send(text_data=event["text"])
+        metrics.WS_EVENTS_SENT.labels(type=event["type"]).inc()
+
+    chat_message = forward
+    typing_indicator = forward
+    friend_request = forward
+    friend_request_accepted = forward
+    online_status = forward
+    conversation_read = forward
+    room_message = forward
+    room_members = forward
+    room_read = forward
+
+    async def room_joined(self, event):
+        # Added to a room (or made one) while connected
+        self.room_ids.add(event["room_id"])
+        await self.channel_layer.group_add(rooms.room_group(event["room_id"]), self.channel_name)
+        await self.forward(event)
+
+    async def room_left(self, event):
+        self.room_ids.discard(event["room_id"])
+        await self.channel_layer.group_discard(rooms.room_group(event["room_id"]), self.channel_name)
+        await self.forward(event)
+
+    async def send_error(self, message):
+        await self.send(text_data=events.error(message))
+        metrics.WS_EVENTS_SENT.labels(type="error").inc()
+
+    async def message_receiver(self, receiver_id):
+        """
+        The receiver of a send_message frame as an int, or None after
+        telling the client why not. Both persistence paths rely on this:
+        only friends can be messaged over the socket, which the cached
+        graph answers without a query.
+        """
         try:
-            profile = Profile.objects.get(user=self.user)
-            profile.is_online = is_online
-            profile.last_seen = timezone.now()
-            profile.save()
-        except Profile.DoesNotExist:
-            print(f"Profile not found for user: {self.user}")
+            receiver_id = int(receiver_id)
+        except (TypeError, ValueError):
+            await self.send_error("Invalid receiver")
+            return None
+        if receiver_id not in await self.get_friend_ids():
+            await self.send_error("You can only message friends")
+            return None
+        return receiver_id
 
     @database_sync_to_async
-    def get_friends(self):
+    def get_friend_ids(self):
         if not self.user:
-            return []
-        friend_requests = FriendRequest.objects.filter(
-            status="accepted"
-        ).filter(models.Q(from_user=self.user) | models.Q(to_user=self.user))
-        friends = []
-        for req in friend_requests:
-            if req.from_user == self.user:
-                friends.append(req.to_user)
-            else:
-                friends.append(req.from_user)
-        return friends
+            return frozenset()
+        return friendships.get_friend_ids(self.user.id)
 
     async def notify_friends_status(self, is_online):
         if not self.user:
             return
-        friends = await self.get_friends()
-        for friend in friends:
-            await self.channel_layer.group_send(
-                f"user_{friend.id}",
-                {
-                    "type": "online_status",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_online": is_online
-                }
+        with metrics.WS_HANDLER_SECONDS.labels(handler="notify_friends_status").time():
+            friend_ids = await self.get_friend_ids()
+            await group_send_many(
+                [user_group(friend_id) for friend_id in friend_ids],
+                events.online_status(self.user.id, self.user.username, is_online),
+                self.channel_layer
             )
 
+    @database_sync_to_async
+    def load_bootstrap(self):
+        # Cursor first, so whatever changes while the snapshot is read comes
+        # again in the next sync rather than falling between the two
+        cursor = sync.delta(self.user.id)["cursor"]
+        return {**bootstrap.snapshot(self.user.id), "cursor": cursor}
+
+    @database_sync_to_async
+    def mark_read(self, watermarks):
+        return Conversation.objects.mark_read(self.user.id, watermarks)
+
     @database_sync_to_async
     def save_message(self, receiver_id, content):
-        receiver = User.objects.get(id=receiver_id)
-        return Message.objects.create(sender=self.user, receiver=receiver, content=content)
+        # receiver_id has been through message_receiver
+        with transaction.atomic():
+            message = Message.objects.create(sender_id=self.user.id, receiver_id=receiver_id, content=content)
+            Conversation.objects.record_message(message)
+        return message
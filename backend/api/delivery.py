@@ -0,0 +1,174 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+
+def with_seq(text, seq):
+    # Event texts are JSON objects, so the number is spliced in front of the
+    # existing fields instead of decoding and encoding again.
+    return f'{{"seq":{seq},{text[1:]}'
+
+
+class LocalEventBuffer:
+    """
+    Per-user sequence counters and the last EVENT_BUFFER_SIZE events, kept
+    in this process. Only correct with a single worker.
+
+    Users are kept in the order they were last touched, which is also the
+    order they expire in, so each lookup drops expired users from the front
+    and users who never come back don't hold on to their events.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, user_id):
+        now = time.time()
+        while self._users:
+            oldest = next(iter(self._users.values()))
+            if oldest["expires_at"] > now:
+                break
+            self._users.popitem(last=False)
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = self._users[user_id] = {"seq": 0, "acked": 0, "events": deque(maxlen=self.size)}
+        else:
+            self._users.move_to_end(user_id)
+        entry["expires_at"] = now + self.ttl
+        return entry
+
+    def append(self, user_ids, text):
+        texts = {}
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entry(user_id)
+                entry["seq"] += 1
+                sequenced = with_seq(text, entry["seq"])
+                entry["events"].append((entry["seq"], sequenced))
+                texts[user_id] = sequenced
+        return texts
+
+    def ack(self, user_id, seq):
+        with self._lock:
+            entry = self._entry(user_id)
+            entry["acked"] = max(entry["acked"], min(seq, entry["seq"]))
+
+    def since(self, user_id, after):
+        with self._lock:
+            entry = self._entry(user_id)
+            if after is None:
+                after = entry["acked"]
+            return entry["seq"], after, [(seq, text) for seq, text in entry["events"] if seq > after]
+
+
+class RedisEventBuffer:
+    """
+    Shares counters and retained events between workers.
+
+    events:seq:<user_id> is the last sequence handed out, events:acked:<user_id>
+    the highest one the client acknowledged, and events:log:<user_id> a
+    sorted set of sequenced event texts scored by sequence, trimmed to
+    EVENT_BUFFER_SIZE. All three expire after EVENT_BUFFER_TTL of silence.
+    """
+
+    APPEND_SCRIPT = """
+    local seq = redis.call('INCR', KEYS[1])
+    local text = '{"seq":' .. seq .. ',' .. string.sub(ARGV[1], 2)
+    redis.call('ZADD', KEYS[2], seq, text)
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    return text
+    """
+
+    ACK_SCRIPT = """
+    local head = tonumber(redis.call('GET', KEYS[1]) or '0')
+    local acked = tonumber(redis.call('GET', KEYS[2]) or '0')
+    local seq = math.min(tonumber(ARGV[1]), head)
+    if seq > acked then
+        redis.call('SET', KEYS[2], seq, 'EX', ARGV[2])
+    end
+    return seq
+    """
+
+    def __init__(self, url, size, ttl):
+        import redis
+
+        self.size = size
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self._append = self.client.register_script(self.APPEND_SCRIPT)
+        self._ack = self.client.register_script(self.ACK_SCRIPT)
+
+    def keys(self, user_id):
+        return f"events:seq:{user_id}", f"events:log:{user_id}", f"events:acked:{user_id}"
+
+    def append(self, user_ids, text):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            seq_key, log_key, _ = self.keys(user_id)
+            self._append(keys=[seq_key, log_key], args=[text, self.size, self.ttl], client=pipe)
+        return dict(zip(user_ids, pipe.execute()))
+
+    def ack(self, user_id, seq):
+        seq_key, _, acked_key = self.keys(user_id)
+        self._ack(keys=[seq_key, acked_key], args=[seq, self.ttl])
+
+    def since(self, user_id, after):
+        seq_key, log_key, acked_key = self.keys(user_id)
+        if after is None:
+            after = int(self.client.get(acked_key) or 0)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(seq_key)
+        pipe.zrangebyscore(log_key, f"({after}", "+inf", withscores=True)
+        head, events = pipe.execute()
+        return int(head or 0), after, [(int(seq), text) for text, seq in events]
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                if settings.EVENT_BUFFER_REDIS_URL:
+                    _buffer = RedisEventBuffer(
+                        settings.EVENT_BUFFER_REDIS_URL, settings.EVENT_BUFFER_SIZE, settings.EVENT_BUFFER_TTL
+                    )
+                else:
+                    _buffer = LocalEventBuffer(settings.EVENT_BUFFER_SIZE, settings.EVENT_BUFFER_TTL)
+    return _buffer
+
+
+def sequence(user_ids, message):
+    """
+    Number message for each user and retain it. Returns {user_id: message}
+    where every copy's text carries that user's next sequence number.
+    """
+    texts = get_buffer().append(list(dict.fromkeys(int(user_id) for user_id in user_ids)), message["text"])
+    return {user_id: {**message, "text": text} for user_id, text in texts.items()}
+
+
+def missed(user_id, after=None):
+    """
+    Retained events after `after` (default: the last acknowledged sequence).
+    Returns (head, events), with events None when the buffer no longer
+    reaches back that far and the caller has to fall back to a delta sync.
+    """
+    head, after, events = get_buffer().since(user_id, after)
+    if after > head:
+        # Counters were lost (buffer expired or restarted)
+        return head, None
+    if after < head and (not events or events[0][0] != after + 1):
+        # The oldest events we'd need were already trimmed
+        return head, None
+    return head, [text for seq, text in events]
@@ -0,0 +1,109 @@
+"""
+Real-time event envelopes.
+
+Each event is encoded to its final JSON text once, when it is published,
+and travels through the channel layer as {"type": <handler>, "text": ...}.
+Consumers forward the text to the socket untouched, so a message fanned
+out to N sockets is serialized once rather than N times. orjson is used
+when it is installed.
+"""
+import json
+
+from rest_framework import serializers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_timestamp_field = serializers.DateTimeField()
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+
+def message_data(message):
+    # Same output as MessageSerializer, without DRF field introspection
+    return {
+        "id": message.id,
+        "sender": message.sender_id,
+        "receiver": message.receiver_id,
+        "content": message.content,
+        "timestamp": _timestamp_field.to_representation(message.timestamp),
+        # A message that was just sent hasn't been read yet
+        "is_read": False,
+    }
+
+
+def layer_message(handler, event, **fields):
+    return {"type": handler, "text": dumps({"event": event, **fields})}
+
+
+def error(message):
+    # Sent straight to the socket that sent a rejected frame, so plain text
+    return dumps({"event": "error", "error": message})
+
+
+def new_message(data):
+    return layer_message("chat_message", "new_message", message=data)
+
+
+def typing_indicator(user_id, username, is_typing):
+    return layer_message("typing_indicator", "typing_indicator", user_id=user_id, username=username, is_typing=is_typing)
+
+
+def online_status(user_id, username, is_online):
+    return layer_message("online_status", "online_status", user_id=user_id, username=username, is_online=is_online)
+
+
+def friend_request(from_user, request_id):
+    return layer_message("friend_request", "friend_request", from_user=from_user, request_id=request_id)
+
+
+def friend_request_accepted(from_user, to_user, request_id):
+    return layer_message(
+        "friend_request_accepted", "friend_request_accepted",
+        from_user=from_user, to_user=to_user, request_id=request_id,
+    )
+
+
+def conversation_read(friend_ids):
+    # Tells the reader's other tabs to clear these badges
+    return layer_message("conversation_read", "conversation_read", friend_ids=friend_ids)
+
+
+def room_message_data(message):
+    return {
+        "id": message.id,
+        "room": message.room_id,
+        "sender": message.sender_id,
+        "content": message.content,
+        "timestamp": _timestamp_field.to_representation(message.timestamp),
+    }
+
+
+def room_message(data):
+    # Published once to the room's group, not per member
+    return layer_message("room_message", "room_message", message=data)
+
+
+def room_joined(room_id, name):
+    # room_id is also kept outside the text for the consumer to join the group
+    return {**layer_message("room_joined", "room_joined", room_id=room_id, name=name), "room_id": room_id}
+
+
+def room_left(room_id):
+    return {**layer_message("room_left", "room_left", room_id=room_id), "room_id": room_id}
+
+
+def room_members(room_id, added=(), removed=()):
+    return layer_message("room_members", "room_members", room_id=room_id, added=list(added), removed=list(removed))
+
+
+def room_read(room_id, message_id):
+    # Tells the reader's other tabs to clear the room's badge
+    return layer_message("room_read", "room_read", room_id=room_id, message_id=message_id)
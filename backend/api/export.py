@@ -0,0 +1,136 @@
+"""
+Gzip-compressed NDJSON export of everything a user has in the chat.
+
+One JSON object per line, each with a "type": an "export" header, the
+user's "profile", their "friend_request"s, then every "message" they
+sent or received, archived months first (month by month, a conversation
+at a time) and then the live table in (timestamp, id) order. Group rooms
+follow: a "room_membership" per room they are in, then every
+"room_message" in those rooms or sent by them, in (timestamp, id) order.
+
+Rows are read in chunks (a server-side cursor on PostgreSQL), encoded a
+line at a time and compressed incrementally, so memory stays flat no
+matter how much history there is.
+"""
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.utils import timezone
+
+from . import archive
+from .models import FriendRequest, Message, MessageArchive, Profile, RoomMember, RoomMessage
+
+
+# Rows fetched per round trip, and compressed bytes per yielded chunk
+BATCH_SIZE = 2000
+CHUNK_SIZE = 64 * 1024
+
+
+def message_record(message):
+    return {
+        "type": "message",
+        "id": message.id,
+        "sender": message.sender_id,
+        "receiver": message.receiver_id,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+    }
+
+
+def room_message_record(message):
+    return {
+        "type": "room_message",
+        "id": message.id,
+        "room": message.room_id,
+        "sender": message.sender_id,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+    }
+
+
+def records(user_id):
+    user = User.objects.get(id=user_id)
+    yield {"type": "export", "user_id": user.id, "username": user.username, "exported_at": timezone.now().isoformat()}
+
+    profile = Profile.objects.filter(user_id=user_id).first()
+    if profile is not None:
+        yield {
+            "type": "profile",
+            "first_name": profile.first_name,
+            "last_name": profile.last_name,
+            "profile_picture": profile.profile_picture.name or None,
+            "last_seen": profile.last_seen.isoformat(),
+        }
+
+    for friend_request in FriendRequest.objects.filter(Q(from_user_id=user_id) | Q(to_user_id=user_id)).order_by("id"):
+        yield {
+            "type": "friend_request",
+            "id": friend_request.id,
+            "from_user": friend_request.from_user_id,
+            "to_user": friend_request.to_user_id,
+            "status": friend_request.status,
+            "created_at": friend_request.created_at.isoformat(),
+        }
+
+    segments = MessageArchive.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id)).order_by(
+        "month", "first_timestamp", "first_id"
+    )
+    for segment in segments.iterator(chunk_size=BATCH_SIZE):
+        for message in archive.ConversationArchive(segment.user_low_id, segment.user_high_id).load(segment):
+            yield message_record(message)
+
+    messages = Message.objects.filter(Q(sender_id=user_id) | Q(receiver_id=user_id)).order_by("timestamp", "id")
+    for message in messages.iterator(chunk_size=BATCH_SIZE):
+        yield message_record(message)
+
+    memberships = RoomMember.objects.filter(user_id=user_id).select_related("room").order_by("joined_at", "id")
+    for membership in memberships:
+        yield {
+            "type": "room_membership",
+            "room": membership.room_id,
+            "name": membership.room.name,
+            "joined_at": membership.joined_at.isoformat(),
+            "last_read_id": membership.last_read_id,
+        }
+
+    # A subquery rather than a join, which would repeat a message once per member
+    room_ids = RoomMember.objects.filter(user_id=user_id).values("room_id")
+    room_messages = RoomMessage.objects.filter(Q(room_id__in=room_ids) | Q(sender_id=user_id)).order_by("timestamp", "id")
+    for message in room_messages.iterator(chunk_size=BATCH_SIZE):
+        yield room_message_record(message)
+
+
+def gzip_chunks(user_id, level=6):
+    """The export as gzip bytes, in chunks of roughly CHUNK_SIZE."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending, size = [], 0
+    for record in records(user_id):
+        data = compressor.compress(json.dumps(record, ensure_ascii=False).encode() + b"\n")
+        if data:
+            pending.append(data)
+            size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b"".join(pending)
+            pending, size = [], 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
+
+
+async def agzip_chunks(user_id):
+    """
+    gzip_chunks for ASGI, which buffers a sync iterator whole before
+    sending it. Each chunk is produced on the thread-sensitive executor,
+    so the whole export runs on one thread and one database connection,
+    as a server-side cursor needs.
+    """
+    chunks = gzip_chunks(user_id)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    while True:
+        chunk = await next_chunk(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
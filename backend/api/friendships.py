@@ -0,0 +1,165 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+
+from .models import FriendRequest
+
+
+# Both backends guard against a load that races an invalidation: the loader
+# takes generation() before reading the database and passes it to set(), and
+# an invalidation in between makes that set() a no-op (locally) or leaves an
+# entry that get() no longer accepts (shared).
+
+class LocalFriendshipBackend:
+    """In-process LRU of user id -> frozenset of friend ids."""
+
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        # user id -> token of the load in flight, dropped by invalidation
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            friend_ids = self._entries.get(user_id)
+            if friend_ids is not None:
+                self._entries.move_to_end(user_id)
+            return friend_ids
+
+    def generation(self, user_id):
+        token = object()
+        with self._lock:
+            self._loading[user_id] = token
+        return token
+
+    def set(self, user_id, friend_ids, generation):
+        with self._lock:
+            if self._loading.get(user_id) is not generation:
+                return
+            del self._loading[user_id]
+            self._entries[user_id] = friend_ids
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+                self._loading.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loading.clear()
+
+
+class SharedFriendshipBackend:
+    """
+    Stores adjacency sets in a Django cache so every worker sees the same
+    invalidations. Each entry is tagged with the generation tokens it was
+    loaded under, one per user and one for the whole backend, and only
+    counts while both are current. Invalidating a user or clearing the
+    backend replaces a token, and leaves the rest of a shared alias alone.
+    """
+
+    key_prefix = "friends:"
+    generation_prefix = "friends_gen:"
+    all_key = "friends_gen:all"
+
+    def __init__(self, alias, timeout):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def generation_key(self, user_id):
+        return f"{self.generation_prefix}{user_id}"
+
+    def generation(self, user_id):
+        keys = [self.all_key, self.generation_key(user_id)]
+        found = self.cache.get_many(keys)
+        for key in keys:
+            if key not in found:
+                # add() keeps whichever token a concurrent loader stored first
+                self.cache.add(key, new_token(), None)
+                found[key] = self.cache.get(key)
+        return tuple(found[key] for key in keys)
+
+    def get(self, user_id):
+        entry_key = f"{self.key_prefix}{user_id}"
+        found = self.cache.get_many([entry_key, self.all_key, self.generation_key(user_id)])
+        entry = found.get(entry_key)
+        if entry is None or entry[0] != (found.get(self.all_key), found.get(self.generation_key(user_id))):
+            return None
+        return entry[1]
+
+    def set(self, user_id, friend_ids, generation):
+        self.cache.set(f"{self.key_prefix}{user_id}", (generation, friend_ids), self.timeout)
+
+    def delete_many(self, user_ids):
+        self.cache.set_many({self.generation_key(user_id): new_token() for user_id in user_ids}, None)
+
+    def clear(self):
+        self.cache.set(self.all_key, new_token(), None)
+
+
+def new_token():
+    return uuid.uuid4().hex[:16]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if settings.FRIENDSHIP_CACHE_ALIAS:
+                    _backend = SharedFriendshipBackend(
+                        settings.FRIENDSHIP_CACHE_ALIAS, settings.FRIENDSHIP_CACHE_TIMEOUT
+                    )
+                else:
+                    _backend = LocalFriendshipBackend(settings.FRIENDSHIP_CACHE_MAX_USERS)
+    return _backend
+
+
+def load_friend_ids(user_id):
+    friend_ids = set()
+    for from_id, to_id in FriendRequest.objects.filter(
+        Q(from_user_id=user_id) | Q(to_user_id=user_id),
+        status="accepted"
+    ).values_list("from_user_id", "to_user_id"):
+        friend_ids.add(to_id if from_id == user_id else from_id)
+    return frozenset(friend_ids)
+
+
+def get_friend_ids(user_id):
+    user_id = int(user_id)
+    backend = get_backend()
+    friend_ids = backend.get(user_id)
+    if friend_ids is None:
+        generation = backend.generation(user_id)
+        friend_ids = load_friend_ids(user_id)
+        backend.set(user_id, friend_ids, generation)
+    return friend_ids
+
+
+def invalidate(*user_ids):
+    get_backend().delete_many([int(user_id) for user_id in user_ids])
+
+
+def friend_request_changed(sender, instance, **kwargs):
+    # Wait for the commit so a concurrent reader can't cache the old graph again
+    from_id, to_id = instance.from_user_id, instance.to_user_id
+    transaction.on_commit(lambda: invalidate(from_id, to_id))
@@ -0,0 +1,163 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from . import versions
+from .log import log
+from .models import Profile
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    # extension: (Pillow format, save options)
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+
+def decode(data, max_size):
+    """
+    Open an upload as an upright RGB image no larger than max_size on
+    either side. EXIF and every other chunk of metadata stay behind with
+    the source file.
+    """
+    image = Image.open(io.BytesIO(data))
+    if image.format == "JPEG":
+        # Let the JPEG decoder downscale while decoding
+        image.draft("RGB", (max_size, max_size))
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white; JPEG has no alpha and avatars are
+        # shown on light backgrounds
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    return image
+
+
+def encode(image, extension):
+    pillow_format, options = FORMATS[extension]
+    buffer = io.BytesIO()
+    image.save(buffer, pillow_format, **options)
+    return buffer.getvalue()
+
+
+def render_variants(data):
+    """
+    The sanitized full-size JPEG and a square crop per thumbnail size in
+    every format: ("full", "jpeg", bytes), (64, "webp", bytes), ...
+    """
+    image = decode(data, settings.PROFILE_PICTURE_MAX_SIZE)
+    yield "full", "jpeg", encode(image, "jpeg")
+    for size in settings.PROFILE_THUMBNAIL_SIZES:
+        thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        for extension in FORMATS:
+            yield size, extension, encode(thumbnail, extension)
+
+
+def variant_paths(variants):
+    return [path for formats in variants.values() for path in formats.values()]
+
+
+def process_profile_picture(profile_id, name, stale=()):
+    """
+    Replace profile `profile_id`'s uploaded picture `name` with a
+    sanitized copy and store its thumbnails. Does nothing if the picture
+    changed again in the meantime; that upload has its own job.
+    """
+    try:
+        with default_storage.open(name, "rb") as upload:
+            data = upload.read()
+    except FileNotFoundError:
+        return False
+    stem = os.path.splitext(os.path.basename(name))[0]
+    full_name, variants, written = None, {}, []
+    for size, extension, content in render_variants(data):
+        path = os.path.join("profile_pics", f"{stem}.{extension}" if size == "full" else f"{stem}_{size}.{extension}")
+        path = default_storage.save(path, ContentFile(content))
+        written.append(path)
+        if size == "full":
+            full_name = path
+        else:
+            variants.setdefault(str(size), {})[extension] = path
+
+    updated = Profile.objects.filter(id=profile_id, profile_picture=name).update(
+        profile_picture=full_name, profile_picture_variants=variants
+    )
+    if not updated:
+        # A newer upload won; what we wrote is garbage
+        stale = written
+    else:
+        versions.profiles_changed(Profile.objects.filter(id=profile_id).values_list("user_id", flat=True))
+        if full_name != name:
+            stale = [*stale, name]
+    for path in stale:
+        # Storages that overwrite may have reused an old name
+        if updated and path in written:
+            continue
+        default_storage.delete(path)
+    return bool(updated)
+
+
+def _run(profile_id, name, stale):
+    try:
+        process_profile_picture(profile_id, name, stale)
+    except Exception:
+        log(logger, logging.ERROR, "images.profile_picture_failed", exc_info=True, profile_id=profile_id, name=name)
+    finally:
+        # Worker threads outlive requests, so their connections are not
+        # cleaned up by the request cycle
+        close_old_connections()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.IMAGE_PROCESSING_WORKERS, thread_name_prefix="images"
+                )
+    return _executor
+
+
+def delete_on_commit(paths):
+    def delete():
+        for path in paths:
+            default_storage.delete(path)
+
+    transaction.on_commit(delete)
+
+
+def schedule_profile_picture(profile, stale=()):
+    """
+    Process profile's current picture once the surrounding transaction
+    commits: on a worker thread, or inline without IMAGE_PROCESSING_ASYNC.
+    `stale` lists files from the previous picture to delete afterwards.
+    """
+    profile_id, name, stale = profile.id, profile.profile_picture.name, list(stale)
+
+    def submit():
+        if settings.IMAGE_PROCESSING_ASYNC:
+            get_executor().submit(_run, profile_id, name, stale)
+        else:
+            process_profile_picture(profile_id, name, stale)
+
+    transaction.on_commit(submit)
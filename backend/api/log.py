@@ -0,0 +1,38 @@
+import json
+import logging
+import random
+from datetime import datetime, timezone
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, event and its fields."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            entry.setdefault(key, value)
+        sample_rate = getattr(record, "sample_rate", 1)
+        if sample_rate < 1:
+            # Lets whoever reads the logs scale counts back up
+            entry["sample_rate"] = sample_rate
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def log(logger, level, message, sample_rate=1, exc_info=None, **fields):
+    """
+    Log `message` with structured fields, keeping only `sample_rate` of the
+    calls. Disabled levels and dropped samples return before anything is
+    formatted, so hot paths can log at debug level for free.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return
+    logger.log(level, message, exc_info=exc_info, extra={"fields": fields, "sample_rate": sample_rate})
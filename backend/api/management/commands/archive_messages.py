@@ -0,0 +1,50 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api import archive, partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than MESSAGE_HOT_MONTHS months into compressed "
+        "archive files, a month at a time. On PostgreSQL it also creates the "
+        "next MESSAGE_PARTITION_MONTHS_AHEAD monthly partitions, so run it "
+        "from cron at least monthly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--before", help="Archive months before this one (YYYY-MM) instead of the MESSAGE_HOT_MONTHS cutoff"
+        )
+        parser.add_argument("--dry-run", action="store_true", help="List the months that would be archived")
+
+    def handle(self, *args, **options):
+        if options["before"]:
+            try:
+                before = datetime.strptime(options["before"], "%Y-%m").replace(tzinfo=timezone.utc)
+            except ValueError:
+                raise CommandError("--before must look like 2024-01")
+        else:
+            before = archive.cutoff()
+
+        if partitions.is_partitioned(connection) and not options["dry_run"]:
+            until = partitions.add_months(
+                partitions.month_start(datetime.now(timezone.utc)), settings.MESSAGE_PARTITION_MONTHS_AHEAD
+            )
+            for month in partitions.ensure_partitions(connection, until):
+                self.stdout.write(f"Created partition {partitions.partition_name(month)}")
+
+        months = archive.archivable_months(before)
+        if options["dry_run"]:
+            for month in months:
+                self.stdout.write(f"Would archive {month:%Y-%m}")
+            return
+        total = 0
+        for month in months:
+            count = archive.archive_month(month)
+            total += count
+            self.stdout.write(f"Archived {count} messages from {month:%Y-%m}")
+        self.stdout.write(f"Archived {total} messages from {len(months)} months.")
@@ -0,0 +1,98 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings, setup_databases, teardown_databases
+from rest_framework.test import APIClient
+
+from api.benchmarks import ENDPOINTS, Dataset
+from api.serializers import ChatTokenObtainPairSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Time every REST endpoint against seeded datasets of increasing size in "
+        "a throwaway test database. Prints a JSON report, and exits non-zero "
+        "if an endpoint goes over its query budget or its query count grows "
+        "with the data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10,100,1000", help="Comma-separated dataset sizes")
+        parser.add_argument("--repeat", type=int, default=20, help="Timed requests per endpoint and size")
+        parser.add_argument("--endpoints", help="Comma-separated subset of endpoint names")
+        parser.add_argument("--output", help="Also write the JSON report to this file")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        endpoints = ENDPOINTS
+        if options["endpoints"]:
+            wanted = set(options["endpoints"].split(","))
+            endpoints = [endpoint for endpoint in ENDPOINTS if endpoint.name in wanted]
+
+        overrides = override_settings(
+            CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+            EVENT_BUFFER_REDIS_URL=None,
+            ALLOWED_HOSTS=["testserver"],
+            # Time rendering; repeats would otherwise hit the response cache
+            CONDITIONAL_GET=False,
+        )
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        try:
+            with overrides:
+                report = self.run(sizes, endpoints, options["repeat"])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as handle:
+                handle.write(output + "\n")
+        self.stdout.write(output)
+        if report["failures"]:
+            raise CommandError("Query budget exceeded:\n" + "\n".join(report["failures"]))
+
+    def run(self, sizes, endpoints, repeat):
+        report = {"sizes": sizes, "repeat": repeat, "endpoints": {}, "failures": []}
+        datasets = [Dataset(size) for size in sizes]
+        for endpoint in endpoints:
+            results = {}
+            for dataset in datasets:
+                results[dataset.size] = self.measure(endpoint, dataset, repeat)
+                if results[dataset.size]["queries"] > endpoint.budget:
+                    report["failures"].append(
+                        f"{endpoint.name}: {results[dataset.size]['queries']} queries at size {dataset.size} "
+                        f"(budget {endpoint.budget})"
+                    )
+            if len({result["queries"] for result in results.values()}) > 1:
+                report["failures"].append(f"{endpoint.name}: query count grows with data {results}")
+            report["endpoints"][endpoint.name] = {"budget": endpoint.budget, "sizes": results}
+        return report
+
+    def measure(self, endpoint, dataset, repeat):
+        client = APIClient()
+        token = ChatTokenObtainPairSerializer.get_token(dataset.me).access_token
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+        endpoint.request(client, dataset)  # warm caches
+
+        timings = []
+        queries = 0
+        for _ in range(repeat):
+            path, data = endpoint.prepare(dataset)
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = getattr(client, endpoint.method)(path, data, format="json")
+                timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 300:
+                raise CommandError(f"{endpoint.name} returned {response.status_code}: {response.content[:200]!r}")
+            queries = max(queries, len(captured))
+
+        timings.sort()
+        return {
+            "queries": queries,
+            "median_ms": round(statistics.median(timings), 3),
+            "p95_ms": round(timings[min(len(timings) - 1, round(0.95 * len(timings)) - 1)], 3),
+            "min_ms": round(timings[0], 3),
+        }
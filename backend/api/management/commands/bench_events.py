@@ -0,0 +1,53 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api import events
+from api.models import Message
+from api.serializers import MessageSerializer
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark the real-time event encoding against the old per-recipient path."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=20000)
+        parser.add_argument("--recipients", type=int, default=2, help="Sockets each event is delivered to")
+
+    def handle(self, *args, **options):
+        count = options["messages"]
+        recipients = options["recipients"]
+        messages = [
+            Message(id=i, sender_id=1, receiver_id=2, content=f"message number {i} " * 4, timestamp=timezone.now())
+            for i in range(count)
+        ]
+
+        def previous_path(sent):
+            # MessageSerializer per event, json.dumps per recipient socket
+            for message in messages:
+                data = MessageSerializer(message).data
+                for _ in range(recipients):
+                    sent.append(json.dumps({"event": "new_message", "message": data}))
+
+        def envelope_path(sent):
+            # Encoded once, forwarded as-is to every recipient
+            for message in messages:
+                text = events.new_message(events.message_data(message))["text"]
+                for _ in range(recipients):
+                    sent.append(text)
+
+        results = {}
+        for name, run in (("previous", previous_path), ("envelope", envelope_path)):
+            started = time.perf_counter()
+            run([])
+            elapsed = time.perf_counter() - started
+            results[name] = {
+                "seconds": round(elapsed, 4),
+                "events_per_second": round(count / elapsed),
+                "us_per_event": round(elapsed / count * 1e6, 2),
+            }
+        results["speedup"] = round(results["previous"]["seconds"] / results["envelope"]["seconds"], 2)
+        results["json_backend"] = "orjson" if events.orjson is not None else "json"
+        self.stdout.write(json.dumps(results, indent=2))
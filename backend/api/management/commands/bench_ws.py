@@ -0,0 +1,367 @@
+import asyncio
+import json
+import random
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from api import typing_indicators, write_behind
+from api.models import FriendRequest
+
+
+WORKLOADS = ["connect_storm", "send_message", "typing", "disconnect_storm"]
+
+HOST = "testserver"
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(count, seconds, latencies):
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        "count": count,
+        "seconds": round(seconds, 4),
+        "per_second": round(count / seconds, 1) if seconds else None,
+        "latency_ms": {
+            name: None if value is None else round(value, 3)
+            for name, value in (
+                ("p50", percentile(latencies_ms, 50)),
+                ("p95", percentile(latencies_ms, 95)),
+                ("p99", percentile(latencies_ms, 99)),
+                ("max", max(latencies_ms) if latencies_ms else None),
+            )
+        },
+    }
+
+
+def friend_graph(count, degree, shape, rng):
+    """Undirected edges between user indexes 0..count-1."""
+    edges = set()
+    if shape == "ring":
+        for i in range(count):
+            for step in range(1, degree // 2 + 1):
+                edges.add(tuple(sorted((i, (i + step) % count))))
+    elif shape == "star":
+        # One hub friends with everyone, the rest sparsely connected
+        edges.update((0, i) for i in range(1, count))
+        for i in range(1, count):
+            for other in rng.sample(range(1, count), min(degree - 1, count - 1)):
+                if other != i:
+                    edges.add(tuple(sorted((i, other))))
+    else:
+        for i in range(count):
+            for other in rng.sample(range(count), min(degree, count)):
+                if other != i:
+                    edges.add(tuple(sorted((i, other))))
+    return edges
+
+
+def bench_settings(options):
+    return override_settings(
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 10000}}},
+        ALLOWED_HOSTS=[HOST],
+        PRESENCE_REDIS_URL=None,
+        EVENT_BUFFER_REDIS_URL=None,
+        FRIENDSHIP_CACHE_ALIAS=None,
+        MESSAGE_WRITE_BEHIND=options["write_behind"],
+    )
+
+
+class Client:
+    """One simulated browser tab: a socket plus a reader that timestamps arrivals."""
+
+    def __init__(self, bench, index, user_id, token):
+        self.bench = bench
+        self.index = index
+        self.user_id = user_id
+        self.token = token
+        self.friends = []
+        self.communicator = None
+        self.reader = None
+        self.ready = None
+
+    async def connect(self):
+        from backend.asgi import application
+
+        self.ready = asyncio.get_running_loop().create_future()
+        self.communicator = WebsocketCommunicator(
+            application,
+            f"/ws/friends/?token={self.token}",
+            headers=[(b"host", HOST.encode()), (b"origin", f"http://{HOST}".encode())],
+        )
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f"client {self.index} was refused")
+        self.reader = asyncio.get_running_loop().create_task(self.read())
+
+    async def read(self):
+        while True:
+            # A timeout would cancel the application, so wait indefinitely
+            # and let close() cancel the reader instead.
+            text = await self.communicator.receive_from(timeout=3600)
+            self.bench.received(self, json.loads(text), time.perf_counter())
+
+    async def send(self, data):
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+    async def close(self):
+        if self.reader:
+            self.reader.cancel()
+            await asyncio.gather(self.reader, return_exceptions=True)
+        await self.communicator.disconnect(timeout=30)
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test FriendConsumer in-process: start the ASGI application on an "
+        "in-memory channel layer and a throwaway test database, open many "
+        "simulated clients and report throughput and delivery latency as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument("--friends", type=int, default=10, help="Friends per user (graph degree)")
+        parser.add_argument("--graph", choices=["random", "ring", "star"], default="random")
+        parser.add_argument("--workloads", default=",".join(WORKLOADS), help=f"Comma-separated subset of {', '.join(WORKLOADS)}")
+        parser.add_argument("--messages", type=int, default=5, help="Messages sent per client")
+        parser.add_argument("--keystrokes", type=int, default=20, help="Typing events sent per client")
+        parser.add_argument("--concurrency", type=int, default=200, help="Clients acting at once")
+        parser.add_argument("--write-behind", action="store_true", help="Persist messages through the write-behind queue")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for deliveries per workload")
+        parser.add_argument("--output", help="Also write the JSON report to this file")
+        parser.add_argument("--baseline", help="Earlier report to compare against")
+
+    def handle(self, *args, **options):
+        workloads = [name.strip() for name in options["workloads"].split(",") if name.strip()]
+        unknown = set(workloads) - set(WORKLOADS)
+        if unknown:
+            raise ValueError(f"Unknown workloads: {', '.join(sorted(unknown))}")
+
+        overrides = bench_settings(options)
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        try:
+            with overrides:
+                report = async_to_sync(self.run)(options, workloads)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline:
+                report["compared_to_baseline"] = self.compare(json.load(baseline), report)
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as handle:
+                handle.write(output + "\n")
+        self.stdout.write(output)
+
+    @database_sync_to_async
+    def create_users(self, options):
+        from api.serializers import ChatTokenObtainPairSerializer
+
+        rng = random.Random(options["seed"])
+        User.objects.bulk_create([
+            User(username=f"bench{i}", password="!") for i in range(options["clients"])
+        ], batch_size=1000)
+        # bulk_create doesn't return ids on every backend
+        users = list(User.objects.filter(username__startswith="bench").order_by("id"))
+        edges = friend_graph(len(users), options["friends"], options["graph"], rng)
+        FriendRequest.objects.bulk_create([
+            FriendRequest(from_user=users[a], to_user=users[b], status="accepted") for a, b in edges
+        ], batch_size=1000)
+        tokens = [str(ChatTokenObtainPairSerializer.get_token(user).access_token) for user in users]
+        return users, edges, tokens
+
+    async def run(self, options, workloads):
+        rng = random.Random(options["seed"])
+        users, edges, tokens = await self.create_users(options)
+        self.clients = [Client(self, i, user.id, token) for i, (user, token) in enumerate(zip(users, tokens))]
+        for a, b in edges:
+            self.clients[a].friends.append(self.clients[b])
+            self.clients[b].friends.append(self.clients[a])
+        self.by_user = {client.user_id: client for client in self.clients}
+        self.semaphore = asyncio.Semaphore(options["concurrency"])
+        self.pending = {}
+        self.latencies = []
+
+        report = {
+            "config": {
+                key: options[key] for key in (
+                    "clients", "friends", "graph", "messages", "keystrokes", "concurrency", "write_behind", "seed"
+                )
+            },
+            "edges": len(edges),
+            "workloads": {},
+        }
+
+        # Every run connects and disconnects everyone; those two are only
+        # reported when asked for.
+        result = await self.connect_storm(options, rng)
+        if "connect_storm" in workloads:
+            report["workloads"]["connect_storm"] = result
+        for name in ("send_message", "typing"):
+            if name in workloads:
+                report["workloads"][name] = await getattr(self, name)(options, rng)
+        result = await self.disconnect_storm(options, rng)
+        if "disconnect_storm" in workloads:
+            report["workloads"]["disconnect_storm"] = result
+
+        report["counters"] = {
+            "typing": dict(typing_indicators.get_coalescer().stats),
+        }
+        if options["write_behind"]:
+            writer = write_behind.get_writer()
+            await writer.flush()
+            report["counters"]["write_behind"] = dict(writer.stats)
+
+        # Stop the presence sweeper, flusher and friends before the loop goes away
+        current = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is not current:
+                task.cancel()
+        return report
+
+    def received(self, client, data, now):
+        key = None
+        if data.get("event") == "new_message":
+            key = ("message", data["message"]["content"], client.user_id)
+        elif data.get("event") == "typing_indicator" and data.get("is_typing"):
+            key = ("typing", data["user_id"], client.user_id)
+        elif data.get("event") in ("sync", "bootstrap") and not client.ready.done():
+            # A cold connect gets a bootstrap, a resumed one a sync
+            client.ready.set_result(now)
+        if key in self.pending:
+            self.latencies.append(now - self.pending.pop(key))
+            if not self.pending:
+                self.drained.set()
+
+    async def measure(self, options, actions):
+        """Run the actions under the concurrency limit, then wait for every expected delivery."""
+        self.latencies = []
+        self.drained = asyncio.Event()
+
+        async def limited(action):
+            async with self.semaphore:
+                await action()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(action) for action in actions))
+        if self.pending:
+            try:
+                await asyncio.wait_for(self.drained.wait(), options["timeout"])
+            except asyncio.TimeoutError:
+                pass
+        elapsed = time.perf_counter() - started
+        lost = len(self.pending)
+        self.pending.clear()
+        return elapsed, lost
+
+    async def connect_storm(self, options, rng):
+        latencies = []
+
+        async def connect(client):
+            started = time.perf_counter()
+            await client.connect()
+            latencies.append(await client.ready - started)
+
+        async def limited(client):
+            async with self.semaphore:
+                await connect(client)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(client) for client in self.clients))
+        # Let the presence fan-out that follows each accept finish
+        await asyncio.sleep(0.5)
+        return summarize(len(self.clients), time.perf_counter() - started, latencies)
+
+    async def send_message(self, options, rng):
+        actions = []
+        counter = 0
+        for client in self.clients:
+            if not client.friends:
+                continue
+            for _ in range(options["messages"]):
+                counter += 1
+                friend = rng.choice(client.friends)
+                actions.append(self.message_action(client, friend, f"bench message {counter}"))
+        elapsed, lost = await self.measure(options, actions)
+        result = summarize(len(actions), elapsed, self.latencies)
+        result["lost"] = lost
+        return result
+
+    def message_action(self, client, friend, content):
+        async def action():
+            self.pending[("message", content, friend.user_id)] = time.perf_counter()
+            await client.send({"event": "send_message", "receiver_id": friend.user_id, "content": content})
+        return action
+
+    async def typing(self, options, rng):
+        before = dict(typing_indicators.get_coalescer().stats)
+        self.typing_pairs = []
+        actions = []
+        for client in self.clients:
+            if client.friends:
+                actions.append(self.typing_action(client, rng.choice(client.friends), options["keystrokes"]))
+        elapsed, lost = await self.measure(options, actions)
+        result = summarize(len(actions) * options["keystrokes"], elapsed, self.latencies)
+        stats = typing_indicators.get_coalescer().stats
+        result["forwarded"] = stats["forwarded"] - before["forwarded"]
+        result["suppressed"] = stats["suppressed"] - before["suppressed"]
+        result["lost"] = lost
+        # Clear the indicators so later workloads start clean
+        await asyncio.gather(*(
+            client.send({"event": "typing", "receiver_id": friend_id, "is_typing": False})
+            for client, friend_id in self.typing_pairs
+        ))
+        return result
+
+    def typing_action(self, client, friend, keystrokes):
+        self.typing_pairs.append((client, friend.user_id))
+
+        async def action():
+            # Latency is to the first indicator the friend sees
+            self.pending[("typing", client.user_id, friend.user_id)] = time.perf_counter()
+            for _ in range(keystrokes):
+                await client.send({"event": "typing", "receiver_id": friend.user_id, "is_typing": True})
+        return action
+
+    async def disconnect_storm(self, options, rng):
+        latencies = []
+
+        async def disconnect(client):
+            async with self.semaphore:
+                started = time.perf_counter()
+                await client.close()
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(disconnect(client) for client in self.clients))
+        return summarize(len(self.clients), time.perf_counter() - started, latencies)
+
+    def compare(self, baseline, report):
+        """Relative change per workload: positive means faster or more throughput."""
+        changes = {}
+        for name, result in report["workloads"].items():
+            before = baseline.get("workloads", {}).get(name)
+            if not before:
+                continue
+            change = {}
+            if before.get("per_second") and result.get("per_second"):
+                change["per_second"] = round(result["per_second"] / before["per_second"] - 1, 3)
+            for pct in ("p50", "p95", "p99"):
+                old, new = before["latency_ms"].get(pct), result["latency_ms"].get(pct)
+                if old and new:
+                    change[f"{pct}_latency"] = round(1 - new / old, 3)
+            changes[name] = change
+        return changes
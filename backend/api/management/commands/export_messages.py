@@ -0,0 +1,33 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from api import export
+
+
+class Command(BaseCommand):
+    help = (
+        "Write a user's profile, friend requests and full message history, "
+        "archived months included, as gzip-compressed NDJSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("--output", "-o", default="-", help="File to write, or - for stdout (default)")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options["username"]).first()
+        if user is None:
+            raise CommandError(f"No user named {options['username']!r}")
+        output = sys.stdout.buffer if options["output"] == "-" else open(options["output"], "wb")
+        written = 0
+        try:
+            for chunk in export.gzip_chunks(user.id):
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        if options["output"] != "-":
+            self.stdout.write(f"Wrote {written} bytes to {options['output']}")
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from api import images
+from api.models import Profile
+
+
+class Command(BaseCommand):
+    help = (
+        "Sanitize and thumbnail profile pictures uploaded before the image "
+        "pipeline existed (or all of them with --all, e.g. after changing "
+        "PROFILE_THUMBNAIL_SIZES)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Reprocess pictures that already have thumbnails")
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.exclude(profile_picture="").exclude(profile_picture__isnull=True)
+        if not options["all"]:
+            profiles = profiles.filter(profile_picture_variants={})
+        done = failed = 0
+        for profile in profiles.only("id", "profile_picture", "profile_picture_variants").iterator():
+            stale = images.variant_paths(profile.profile_picture_variants)
+            try:
+                processed = images.process_profile_picture(profile.id, profile.profile_picture.name, stale)
+            except Exception as exc:
+                processed = False
+                self.stderr.write(f"Profile {profile.id}: {exc!r}")
+            done += processed
+            failed += not processed
+        self.stdout.write(f"Processed {done} profile pictures, {failed} skipped or failed.")
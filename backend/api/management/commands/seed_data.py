@@ -0,0 +1,363 @@
+import math
+import multiprocessing
+import random
+import time
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from api import ids
+from api.models import Conversation, FriendRequest, Message, Profile
+
+
+FIRST_NAMES = [
+    "Ada", "Alex", "Amir", "Ana", "Ben", "Chen", "Chloe", "Dana", "David", "Elena", "Emma", "Finn",
+    "Grace", "Hana", "Ivan", "Jack", "Jade", "Jon", "Kai", "Lena", "Leo", "Lucas", "Maya", "Mia",
+    "Noah", "Nora", "Omar", "Priya", "Rosa", "Sam", "Sara", "Theo", "Uma", "Yusuf", "Zoe",
+]
+LAST_NAMES = [
+    "Bauer", "Costa", "Diaz", "Ehlers", "Fischer", "Garcia", "Hansen", "Ito", "Jensen", "Kim", "Lopez",
+    "Martin", "Nguyen", "Novak", "Okafor", "Patel", "Rossi", "Silva", "Smith", "Tanaka", "Weber", "Wong",
+]
+WORDS = (
+    "ok yeah no lol sure thanks hey hi what when where why how are you doing good great see it the a "
+    "to and tomorrow today tonight later now soon maybe call me back dinner lunch coffee work home late "
+    "running sorry haha nice cool meet at pm am this that weekend plans movie game sounds fun just got "
+    "done leaving on my way almost there can't wait love miss did send photo check out link"
+).split()
+
+# Share of each hour of the day in message traffic, quiet overnight and
+# busiest in the evening.
+HOURLY_WEIGHTS = [2, 1, 1, 1, 1, 2, 4, 6, 7, 7, 7, 8, 9, 8, 7, 7, 8, 9, 11, 12, 13, 12, 9, 5]
+
+# Per-conversation message counts are lognormal, so most pairs barely talk
+# and a few talk constantly.
+CONVERSATION_SIGMA = 1.5
+SESSION_MEAN_MESSAGES = 8
+REPLY_GAP_SECONDS = 25
+
+# Set in the parent before the pool forks so every worker reads the same
+# arrays without pickling them per task.
+_plan = {}
+
+
+def chunk_rng(seed, phase, chunk):
+    # String seeds hash deterministically, so every chunk draws the same
+    # values whichever process runs it.
+    return random.Random(f"{seed}:{phase}:{chunk}")
+
+
+def fast_writes():
+    # Seeded data can be regenerated, so trade durability for speed.
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL synchronous_commit TO OFF")
+
+
+def create_users(chunk):
+    plan = _plan
+    start = chunk * plan["batch_size"]
+    stop = min(start + plan["batch_size"], plan["users"])
+    rng = chunk_rng(plan["seed"], "users", chunk)
+    with transaction.atomic():
+        fast_writes()
+        users = User.objects.bulk_create(
+            [
+                User(username=plan["username"](index), password=plan["password"], date_joined=plan["until"])
+                for index in range(start, stop)
+            ],
+            batch_size=plan["batch_size"],
+        )
+        if users[0].pk is None:
+            users = User.objects.filter(username__in=[user.username for user in users]).order_by("username")
+        profiles = []
+        for user in users:
+            profile = Profile(user=user, first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES))
+            profile.set_search_names()
+            profiles.append(profile)
+        Profile.objects.bulk_create(profiles, batch_size=plan["batch_size"])
+    return {"users": stop - start}
+
+
+def friendships(chunk):
+    """
+    (index, friend_index, status) for every user in the chunk. Each user
+    befriends users that joined before them, picked with weight
+    (index + 1) ** -skew, so early users become hubs and the degree
+    distribution follows a power law.
+    """
+    plan = _plan
+    rng = chunk_rng(plan["seed"], "graph", chunk)
+    cumulative = plan["cumulative"]
+    start = chunk * plan["graph_chunk"]
+    edges = []
+    for index in range(start, min(start + plan["graph_chunk"], plan["users"])):
+        count = min(index, int(rng.expovariate(1 / plan["friends"]) + 0.5))
+        if count == index:
+            friends = range(index)
+        else:
+            friends = set()
+            while len(friends) < count:
+                friends.add(bisect_right(cumulative, rng.random() * cumulative[index - 1], 0, index))
+            friends = sorted(friends)
+        for friend in friends:
+            roll = rng.random()
+            status = "pending" if roll < plan["pending"] else "rejected" if roll < plan["pending"] + plan["rejected"] else "accepted"
+            edges.append((index, friend, status))
+    return edges
+
+
+def create_friendships(chunk):
+    ids = _plan["ids"]
+    edges = friendships(chunk)
+    with transaction.atomic():
+        fast_writes()
+        FriendRequest.objects.bulk_create(
+            [FriendRequest(from_user_id=ids[index], to_user_id=ids[friend], status=status) for index, friend, status in edges],
+            batch_size=_plan["batch_size"],
+        )
+    return {"friend_requests": len(edges), "accepted": sum(status == "accepted" for _, _, status in edges)}
+
+
+def conversation(plan, rng, low_id, high_id):
+    """
+    Yields Message rows between two users in time order: sessions of
+    back-and-forth replies, started at a time of day drawn from
+    HOURLY_WEIGHTS on random days within the window.
+    """
+    mean = plan["messages_per_pair"] * math.exp(-CONVERSATION_SIGMA ** 2 / 2)
+    count = int(mean * rng.lognormvariate(0, CONVERSATION_SIGMA) + rng.random())
+    if not count:
+        return
+    first_day = plan["until"] - timedelta(days=rng.randrange(plan["days"]) + 1)
+    span_days = max(1, (plan["until"] - first_day).days)
+    sessions = max(1, round(count / SESSION_MEAN_MESSAGES))
+    starts = sorted(
+        first_day
+        + timedelta(days=rng.randrange(span_days), hours=hour, seconds=rng.randrange(3600))
+        for hour in rng.choices(range(24), weights=HOURLY_WEIGHTS, k=sessions)
+    )
+    per_session, extra = divmod(count, sessions)
+    sender, receiver = (low_id, high_id) if rng.random() < 0.5 else (high_id, low_id)
+    timestamp = first_day
+    for session, start in enumerate(starts):
+        timestamp = max(timestamp + timedelta(milliseconds=1), start)
+        for _ in range(per_session + (session < extra)):
+            if rng.random() < 0.6:
+                sender, receiver = receiver, sender
+            timestamp += timedelta(seconds=rng.expovariate(1 / REPLY_GAP_SECONDS))
+            if timestamp >= plan["until"]:
+                return
+            words = min(40, max(1, int(rng.lognormvariate(1.5, 0.8))))
+            yield Message(sender_id=sender, receiver_id=receiver, content=" ".join(rng.choices(WORDS, k=words)), timestamp=timestamp)
+
+
+class PairState:
+    """Tracks what the Conversation row for a pair should hold once its messages are saved."""
+
+    def __init__(self, low_id, high_id):
+        self.low_id = low_id
+        self.high_id = high_id
+        self.last = None
+        # Replying implies having read everything before it, so each side's
+        # watermark is the last message they sent and their unread count is
+        # what arrived after that.
+        self.last_sent = {low_id: None, high_id: None}
+        self.unread = {low_id: 0, high_id: 0}
+
+    def add(self, message):
+        self.last = message
+        self.last_sent[message.sender_id] = message
+        self.unread[message.sender_id] = 0
+        self.unread[message.receiver_id] += 1
+
+    def row(self):
+        low_read, high_read = self.last_sent[self.low_id], self.last_sent[self.high_id]
+        return Conversation(
+            user_low_id=self.low_id,
+            user_high_id=self.high_id,
+            last_message_id=self.last.id,
+            last_message_at=self.last.timestamp,
+            low_unread_count=self.unread[self.low_id],
+            high_unread_count=self.unread[self.high_id],
+            low_last_read_id=low_read.id if low_read else 0,
+            high_last_read_id=high_read.id if high_read else 0,
+            updated_at=self.last.timestamp,
+        )
+
+
+def create_messages(chunk):
+    """
+    Streams the chunk's messages to the database in batches so memory stays
+    bounded by --batch-size, whatever a conversation's length. Conversation
+    rows wait for their last message's batch, since they point at its id.
+    """
+    plan = _plan
+    ids = plan["ids"]
+    rng = chunk_rng(plan["seed"], "messages", chunk)
+    stats = {"messages": 0, "conversations": 0}
+    batch, finished = [], []
+
+    def flush():
+        Message.objects.bulk_create(batch)
+        stats["messages"] += len(batch)
+        batch.clear()
+        Conversation.objects.bulk_create([pair.row() for pair in finished])
+        stats["conversations"] += len(finished)
+        finished.clear()
+
+    with transaction.atomic():
+        fast_writes()
+        for index, friend, status in friendships(chunk):
+            if status != "accepted":
+                continue
+            pair = PairState(*sorted((ids[index], ids[friend])))
+            for message in conversation(plan, rng, pair.low_id, pair.high_id):
+                pair.add(message)
+                batch.append(message)
+                if len(batch) >= plan["batch_size"]:
+                    flush()
+            if pair.last is not None:
+                finished.append(pair)
+        flush()
+    return stats
+
+
+def init_worker(counter, base_worker_id):
+    # Forked children would otherwise share the parent's generator and hand
+    # out the same ids in the same millisecond, so each takes its own
+    # worker id from base_worker_id upwards.
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    ids._generator = ids.MessageIdGenerator(base_worker_id + index)
+
+
+def worker_pool(workers):
+    context = multiprocessing.get_context("fork")
+    return context.Pool(
+        workers, initializer=init_worker, initargs=(context.Value("i", 0), ids.get_generator().worker_id)
+    )
+
+
+def max_workers():
+    # One message id worker id per process, from MESSAGE_WORKER_ID upwards
+    return (1 << ids.MessageIdGenerator.WORKER_BITS) - ids.get_generator().worker_id
+
+
+def run(task, chunks, workers):
+    """Runs task over chunks, in a pool of forked workers when workers > 1."""
+    totals = {}
+    if workers > 1:
+        # Children must open their own connections rather than share ours
+        connections.close_all()
+        with worker_pool(workers) as pool:
+            results = pool.imap_unordered(task, range(chunks))
+            for result in results:
+                for key, value in result.items():
+                    totals[key] = totals.get(key, 0) + value
+    else:
+        for chunk in range(chunks):
+            for key, value in task(chunk).items():
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic dataset: users with profiles, a power-law friendship "
+        "graph and message history with a realistic spread over time. The same "
+        "--seed and sizes always produce the same data; row ids may differ when "
+        "--workers is above 1."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument("--friends", type=float, default=10, help="Mean friend requests sent per user")
+        parser.add_argument("--messages", type=int, default=1000000, help="Approximate total messages")
+        parser.add_argument("--days", type=int, default=180, help="How far back message history goes")
+        parser.add_argument("--until", help="End of the history as YYYY-MM-DD (default: today)")
+        parser.add_argument("--pending", type=float, default=0.05, help="Share of friend requests left pending")
+        parser.add_argument("--rejected", type=float, default=0.02, help="Share of friend requests rejected")
+        parser.add_argument("--skew", type=float, default=0.5, help="Power-law exponent for picking friends")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--prefix", default="seed", help="Username prefix for generated users")
+        parser.add_argument("--password", default="password", help="Password for every generated user")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--workers", type=int, help="Processes to write with (default: CPU count)")
+
+    def handle(self, *args, **options):
+        users = options["users"]
+        if users < 2:
+            raise CommandError("--users must be at least 2")
+        prefix = options["prefix"]
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f"Users starting with {prefix!r} already exist; use another --prefix.")
+
+        workers = max(1, options["workers"] or min(multiprocessing.cpu_count(), max_workers()))
+        if connection.vendor == "sqlite" and workers > 1:
+            # SQLite takes one writer at a time, so more processes only add lock waits
+            self.stdout.write("SQLite allows a single writer, running in one process.")
+            workers = 1
+        if workers > max_workers():
+            raise CommandError(
+                f"--workers can be at most {max_workers()}: each worker needs its own message "
+                f"worker id, counting up from MESSAGE_WORKER_ID."
+            )
+        if connection.vendor == "sqlite" and not connection.in_atomic_block:
+            # SQLite refuses to change this inside a transaction
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA synchronous = OFF")
+
+        until = datetime.fromisoformat(options["until"]) if options["until"] else datetime.now()
+        until = until.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=dt_timezone.utc)
+        width = len(str(users - 1))
+        batch_size = options["batch_size"]
+        _plan.update(
+            seed=options["seed"],
+            users=users,
+            friends=options["friends"],
+            pending=options["pending"],
+            rejected=options["rejected"],
+            days=options["days"],
+            until=until,
+            batch_size=batch_size,
+            graph_chunk=max(1, int(batch_size // max(options["friends"], 1))),
+            # Zero-padded so username order is index order
+            username=lambda index: f"{prefix}{index:0{width}d}",
+            password=make_password(options["password"]),
+        )
+
+        started = time.perf_counter()
+        totals = self.phase("users", create_users, math.ceil(users / batch_size), workers)
+
+        _plan["ids"] = array(
+            "q", User.objects.filter(username__startswith=prefix).order_by("username").values_list("id", flat=True).iterator()
+        )
+        cumulative, total = array("d"), 0.0
+        for index in range(users):
+            total += (index + 1) ** -options["skew"]
+            cumulative.append(total)
+        _plan["cumulative"] = cumulative
+
+        graph_chunks = math.ceil(users / _plan["graph_chunk"])
+        totals.update(self.phase("friend requests", create_friendships, graph_chunks, workers))
+        _plan["messages_per_pair"] = options["messages"] / max(totals["accepted"], 1)
+        totals.update(self.phase("messages", create_messages, graph_chunks, workers))
+
+        elapsed = time.perf_counter() - started
+        summary = ", ".join(f"{value} {key.replace('_', ' ')}" for key, value in totals.items())
+        self.stdout.write(self.style.SUCCESS(f"Created {summary} in {elapsed:.1f}s"))
+
+    def phase(self, name, task, chunks, workers):
+        started = time.perf_counter()
+        totals = run(task, chunks, workers)
+        elapsed = time.perf_counter() - started
+        rows = sum(value for key, value in totals.items() if key != "accepted")
+        self.stdout.write(f"{name}: {totals} in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)")
+        return totals
@@ -0,0 +1,214 @@
+import functools
+import threading
+import time
+
+from channels import db as channels_db
+
+from . import profiling
+
+
+class Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class Metric:
+    """
+    A named metric with optional labels, rendered in the Prometheus text
+    format. Values live in this process only, so with several workers each
+    one is scraped separately.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._unlabelled = self.labels()
+        REGISTRY.append(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self.child_class(self._lock))
+        return child
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            labels = dict(zip(self.labelnames, key))
+            for suffix, extra, value in child.samples():
+                yield self.name + suffix, {**labels, **extra}, value
+
+
+class CounterChild:
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [("", {}, self.value)]
+
+
+class Counter(Metric):
+    kind = "counter"
+    child_class = CounterChild
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+
+class GaugeChild(CounterChild):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+    child_class = GaugeChild
+
+    def dec(self, amount=1):
+        self._unlabelled.dec(amount)
+
+    def set(self, value):
+        self._unlabelled.set(value)
+
+
+class HistogramChild:
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            samples.append(("_bucket", {"le": str(bound)}, cumulative))
+        samples.append(("_sum", {}, total))
+        samples.append(("_count", {}, cumulative))
+        return samples
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    child_class = HistogramChild
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def time(self):
+        return self._unlabelled.time()
+
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render():
+    """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            label_text = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+WS_CONNECTIONS = Gauge("chat_ws_connections", "Open WebSocket connections.")
+WS_CONNECTS = Counter("chat_ws_connects_total", "WebSocket connection attempts.", ["result"])
+WS_EVENTS_RECEIVED = Counter("chat_ws_events_received_total", "Frames received from clients, by type.", ["type"])
+WS_EVENTS_SENT = Counter("chat_ws_events_sent_total", "Events sent to clients, by type.", ["type"])
+WS_HANDLER_SECONDS = Histogram("chat_ws_handler_seconds", "Time spent in consumer handlers.", ["handler"])
+DB_SECONDS = Histogram(
+    "chat_database_sync_to_async_seconds",
+    "Time awaiting database_sync_to_async calls, thread pool wait included.",
+    ["function"],
+)
+GROUP_SEND_SECONDS = Histogram("chat_group_send_seconds", "Channel layer group_send latency, by event type.", ["type"])
+GROUP_SEND_ERRORS = Counter("chat_group_send_errors_total", "Channel layer group_send calls that raised.", ["type"])
+TYPING_EVENTS = Counter(
+    "chat_typing_events_total",
+    "Typing indicator events: received from clients, and forwarded, suppressed or expired by the coalescer.",
+    ["outcome"],
+)
+WRITE_BEHIND_DEPTH = Gauge("chat_write_behind_queue_depth", "Messages broadcast but not yet inserted.")
+WRITE_BEHIND_FULL = Counter(
+    "chat_write_behind_full_total", "Submits that found the write-behind queue full and waited for a flush."
+)
+WRITE_BEHIND_ROWS = Counter(
+    "chat_write_behind_rows_total", "Queued messages written, by result (flushed or failed).", ["result"]
+)
+
+
+def database_sync_to_async(func):
+    """
+    channels' database_sync_to_async, recording how long each call takes
+    and counting its queries against the current profile.
+    """
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        with profiling.recording():
+            return func(*args, **kwargs)
+
+    wrapped = channels_db.database_sync_to_async(run)
+    timer = DB_SECONDS.labels(function=getattr(func, "__name__", "unknown"))
+
+    @functools.wraps(func)
+    async def timed(*args, **kwargs):
+        with timer.time():
+            return await wrapped(*args, **kwargs)
+
+    return timed
+
+
+async def group_send(channel_layer, group, message):
+    event_type = message.get("type", "unknown")
+    try:
+        with GROUP_SEND_SECONDS.labels(type=event_type).time():
+            await channel_layer.group_send(group, message)
+    except Exception:
+        GROUP_SEND_ERRORS.labels(type=event_type).inc()
+        raise
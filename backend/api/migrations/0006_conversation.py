@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:58
+
+import api.models
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_friendrequest_from_new_message_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='profile_picture',
+            field=models.ImageField(blank=True, null=True, upload_to=api.models.profile_pic_upload_to),
+        ),
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('low_has_unread', models.BooleanField(default=False)),
+                ('high_has_unread', models.BooleanField(default=False)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.message')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', '-last_message_at'], name='conversation_low_recent_idx'), models.Index(fields=['user_high', '-last_message_at'], name='conversation_high_recent_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user_low', 'user_high'), name='conversation_unique_pair'), models.CheckConstraint(condition=models.Q(('user_low__lt', models.F('user_high'))), name='conversation_canonical_pair')],
+            },
+        ),
+    ]
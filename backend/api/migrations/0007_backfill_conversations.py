@@ -0,0 +1,65 @@
+from django.db import migrations
+from django.db.models import Max
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_conversations(apps, schema_editor):
+    Conversation = apps.get_model('api', 'Conversation')
+    FriendRequest = apps.get_model('api', 'FriendRequest')
+    Message = apps.get_model('api', 'Message')
+
+    conversations = {}
+
+    def conversation_for(user_id, other_id):
+        low, high = sorted((user_id, other_id))
+        key = (low, high)
+        if key not in conversations:
+            conversations[key] = Conversation(user_low_id=low, user_high_id=high)
+        return conversations[key]
+
+    # Every accepted friendship gets a row, carrying over the old unread flags.
+    # from_new_message means the to_user has unread messages and vice versa.
+    accepted = FriendRequest.objects.filter(status='accepted').values_list(
+        'from_user_id', 'to_user_id', 'from_new_message', 'to_new_message'
+    )
+    for from_id, to_id, from_new, to_new in accepted.iterator(chunk_size=BATCH_SIZE):
+        if from_id == to_id:
+            continue
+        conversation = conversation_for(from_id, to_id)
+        if from_new:
+            setattr(conversation, 'low_has_unread' if to_id < from_id else 'high_has_unread', True)
+        if to_new:
+            setattr(conversation, 'low_has_unread' if from_id < to_id else 'high_has_unread', True)
+
+    # Latest message per direction, folded into the canonical pair.
+    latest = Message.objects.order_by().values('sender_id', 'receiver_id').annotate(last_id=Max('id'))
+    for row in latest.iterator(chunk_size=BATCH_SIZE):
+        if row['sender_id'] == row['receiver_id']:
+            continue
+        conversation = conversation_for(row['sender_id'], row['receiver_id'])
+        if conversation.last_message_id is None or row['last_id'] > conversation.last_message_id:
+            conversation.last_message_id = row['last_id']
+
+    with_messages = [c for c in conversations.values() if c.last_message_id is not None]
+    for start in range(0, len(with_messages), BATCH_SIZE):
+        batch = with_messages[start:start + BATCH_SIZE]
+        timestamps = dict(
+            Message.objects.filter(id__in=[c.last_message_id for c in batch]).values_list('id', 'timestamp')
+        )
+        for conversation in batch:
+            conversation.last_message_at = timestamps[conversation.last_message_id]
+
+    Conversation.objects.bulk_create(conversations.values(), batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
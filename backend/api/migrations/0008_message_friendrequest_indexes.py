@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+from api.operations import AddIndexConcurrentlyIfSupported
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0007_backfill_conversations'),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyIfSupported(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'timestamp', 'id'], name='message_pair_recent_idx'),
+        ),
+        AddIndexConcurrentlyIfSupported(
+            model_name='friendrequest',
+            index=models.Index(fields=['from_user', 'status'], name='friendrequest_from_status_idx'),
+        ),
+        AddIndexConcurrentlyIfSupported(
+            model_name='friendrequest',
+            index=models.Index(fields=['to_user', 'status'], name='friendrequest_to_status_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:08
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+def normalize_name(value):
+    # Frozen copy of api.models.normalize_name
+    value = unicodedata.normalize("NFKD", value or "")
+    value = "".join(char for char in value if not unicodedata.combining(char))
+    return " ".join(value.lower().split())
+
+
+def backfill_search_names(apps, schema_editor):
+    Profile = apps.get_model('api', 'Profile')
+    batch = []
+    for profile in Profile.objects.only('id', 'first_name', 'last_name').iterator(chunk_size=1000):
+        profile.search_name = normalize_name(f"{profile.first_name} {profile.last_name}")
+        profile.search_name_reversed = normalize_name(f"{profile.last_name} {profile.first_name}")
+        batch.append(profile)
+        if len(batch) >= 1000:
+            Profile.objects.bulk_update(batch, ['search_name', 'search_name_reversed'])
+            batch = []
+    if batch:
+        Profile.objects.bulk_update(batch, ['search_name', 'search_name_reversed'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='search_name',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=61),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='search_name_reversed',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=61),
+        ),
+        migrations.RunPython(backfill_search_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:11
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_unread_counts(apps, schema_editor):
+    Conversation = apps.get_model('api', 'Conversation')
+    Message = apps.get_model('api', 'Message')
+
+    # Newest message id per direction
+    latest = {}
+    directions = Message.objects.order_by().values('sender_id', 'receiver_id').annotate(last_id=Max('id'))
+    for row in directions.iterator(chunk_size=BATCH_SIZE):
+        latest[(row['sender_id'], row['receiver_id'])] = row['last_id']
+
+    batch = []
+    for conversation in Conversation.objects.iterator(chunk_size=BATCH_SIZE):
+        for side, user_id, other_id in (
+            ('low', conversation.user_low_id, conversation.user_high_id),
+            ('high', conversation.user_high_id, conversation.user_low_id),
+        ):
+            if getattr(conversation, f'{side}_has_unread'):
+                # Replying means reading, so anything received after our own
+                # last message is what's still unread.
+                last_read_id = latest.get((user_id, other_id), 0)
+                unread_count = Message.objects.filter(
+                    sender_id=other_id, receiver_id=user_id, id__gt=last_read_id
+                ).count()
+            else:
+                last_read_id = latest.get((other_id, user_id), 0)
+                unread_count = 0
+            setattr(conversation, f'{side}_last_read_id', last_read_id)
+            setattr(conversation, f'{side}_unread_count', unread_count)
+        batch.append(conversation)
+        if len(batch) >= BATCH_SIZE:
+            Conversation.objects.bulk_update(batch, [
+                'low_last_read_id', 'low_unread_count', 'high_last_read_id', 'high_unread_count'
+            ])
+            batch = []
+    if batch:
+        Conversation.objects.bulk_update(batch, [
+            'low_last_read_id', 'low_unread_count', 'high_last_read_id', 'high_unread_count'
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_profile_search_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='high_last_read_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='high_unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='low_last_read_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='low_unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_unread_counts, migrations.RunPython.noop),
+        # Unread state now lives only in the counters and watermarks above
+        migrations.RemoveField(
+            model_name='conversation',
+            name='high_has_unread',
+        ),
+        migrations.RemoveField(
+            model_name='conversation',
+            name='low_has_unread',
+        ),
+        migrations.RemoveField(
+            model_name='friendrequest',
+            name='from_new_message',
+        ),
+        migrations.RemoveField(
+            model_name='friendrequest',
+            name='to_new_message',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:13
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+from api.operations import AddIndexConcurrentlyIfSupported
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0011_conversation_unread_counts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='friendrequest',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_low', 'updated_at'], name='conversation_low_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_high', 'updated_at'], name='conversation_high_updated_idx'),
+        ),
+        AddIndexConcurrentlyIfSupported(
+            model_name='message',
+            index=models.Index(fields=['sender', 'timestamp', 'id'], name='message_sender_recent_idx'),
+        ),
+        AddIndexConcurrentlyIfSupported(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'timestamp', 'id'], name='message_receiver_recent_idx'),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+from api import partitions
+
+
+# Partitions created up front; archive_messages keeps adding them
+MONTHS_AHEAD = 3
+
+
+def partition_messages(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        partitions.partition_table(schema_editor.connection, timezone.now(), MONTHS_AHEAD)
+
+
+def unpartition_messages(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        partitions.unpartition_table(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_profile_picture_variants'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={},
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.message'),
+        ),
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('path', models.CharField(max_length=255)),
+                ('offset', models.BigIntegerField()),
+                ('length', models.IntegerField()),
+                ('count', models.IntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_id', models.BigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_id', models.BigIntegerField()),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', 'user_high', 'last_timestamp'], name='archive_pair_recent_idx')],
+            },
+        ),
+        # After the foreign key from Conversation is gone
+        migrations.RunPython(partition_messages, unpartition_messages),
+    ]
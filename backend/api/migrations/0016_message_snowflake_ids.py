@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:05
+
+import api.ids
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_rooms'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='id',
+            field=models.BigIntegerField(default=api.ids.next_message_id, editable=False, primary_key=True, serialize=False),
+        ),
+    ]
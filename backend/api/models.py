@@ -1,6 +1,10 @@
-from django.db import models
+from django.db import connection, models
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth.models import User
+from django.dispatch import Signal
 from django.utils import timezone
+from .ids import next_message_id
+import unicodedata
 import uuid
 import os
 
@@ -13,17 +17,74 @@ def profile_pic_upload_to(instance, filename):
     # Save it in the profile_pics folder
     return os.path.join('profile_pics', filename)
 
+def normalize_name(value):
+    # Lowercase, strip accents and collapse whitespace so "  José  Núñez"
+    # and "jose nunez" compare equal in the search columns.
+    value = unicodedata.normalize("NFKD", value or "")
+    value = "".join(char for char in value if not unicodedata.combining(char))
+    return " ".join(value.lower().split())
+
+
+class ProfileQuerySet(models.QuerySet):
+    def search(self, query):
+        """
+        Prefix search on the normalized "first last" and "last first"
+        columns, ranked exact match first, then first-name prefix, then
+        last-name prefix. Both branches are index range scans.
+        """
+        term = normalize_name(query)
+        if not term:
+            return self.none()
+        forward = self._prefix("search_name", term)
+        return self.filter(forward | self._prefix("search_name_reversed", term)).annotate(
+            search_rank=models.Case(
+                models.When(models.Q(search_name=term) | models.Q(search_name_reversed=term), then=0),
+                models.When(forward, then=1),
+                default=2,
+                output_field=models.IntegerField(),
+            )
+        ).order_by("search_rank", "search_name", "id")
+
+    def _prefix(self, field, term):
+        if connection.vendor == "postgresql":
+            # Served by the varchar_pattern_ops index Django adds for db_index
+            return models.Q(**{f"{field}__startswith": term})
+        # LIKE can't use the index on SQLite; a binary range scan can
+        return models.Q(**{f"{field}__gte": term, f"{field}__lt": term + "\U0010ffff"})
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     first_name = models.CharField(max_length=30)
     last_name = models.CharField(max_length=30)
     profile_picture = models.ImageField(upload_to=profile_pic_upload_to, blank=True, null=True)
+    # Square thumbnails of profile_picture by size and format, e.g.
+    # {"64": {"webp": "profile_pics/<name>_64.webp", "jpeg": ...}}. Filled in
+    # by api/images.py after an upload; empty until then.
+    profile_picture_variants = models.JSONField(default=dict, blank=True, editable=False)
     is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(default=timezone.now)
+    # Maintained in save() for UserSearchView
+    search_name = models.CharField(max_length=61, blank=True, default="", db_index=True, editable=False)
+    search_name_reversed = models.CharField(max_length=61, blank=True, default="", db_index=True, editable=False)
+
+    objects = ProfileQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.user.username}'s profile"
 
+    def set_search_names(self):
+        # save() does this; call it directly before bulk_create
+        self.search_name = normalize_name(f"{self.first_name} {self.last_name}")
+        self.search_name_reversed = normalize_name(f"{self.last_name} {self.first_name}")
+
+    def save(self, *args, **kwargs):
+        self.set_search_names()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"first_name", "last_name"} & set(update_fields):
+            kwargs["update_fields"] = set(update_fields) | {"search_name", "search_name_reversed"}
+        super().save(*args, **kwargs)
+
 
 class FriendRequest(models.Model):
     from_user = models.ForeignKey(User, related_name="sent_friend_requests", on_delete=models.CASCADE)
@@ -33,26 +94,305 @@ class FriendRequest(models.Model):
         choices=[("pending", "Pending"), ("accepted", "Accepted"), ("rejected", "Rejected")],
         default="pending"
     )
-    from_new_message = models.BooleanField(default=False)
-    to_new_message = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Lets clients sync request changes since a cursor
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ("from_user", "to_user")
+        indexes = [
+            models.Index(fields=["from_user", "status"], name="friendrequest_from_status_idx"),
+            models.Index(fields=["to_user", "status"], name="friendrequest_to_status_idx"),
+        ]
 
     def __str__(self):
         return f"{self.from_user} → {self.to_user} ({self.status})"
 
     
 class Message(models.Model):
+    # Time-ordered ids from one source for every insert path, see api/ids.py
+    id = models.BigIntegerField(primary_key=True, default=next_message_id, editable=False)
     sender = models.ForeignKey(User, related_name="sent_messages", on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name="received_messages", on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    # Set by the application rather than auto_now_add so messages persisted
+    # in bulk keep the time they were broadcast with.
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
 
+    # No default ordering: every query that needs one says so, and the rest
+    # don't pay for a sort. On PostgreSQL the table is partitioned by month
+    # of timestamp (migration 0014); old months move to the archive, see
+    # api/archive.py.
     class Meta:
-        ordering = ["timestamp"]
+        indexes = [
+            # Serves both directions of a conversation and the (timestamp, id)
+            # keyset used by MessageCursorPagination.
+            models.Index(fields=["sender", "receiver", "timestamp", "id"], name="message_pair_recent_idx"),
+            # Everything a user sent or received since a sync cursor
+            models.Index(fields=["sender", "timestamp", "id"], name="message_sender_recent_idx"),
+            models.Index(fields=["receiver", "timestamp", "id"], name="message_receiver_recent_idx"),
+        ]
 
     def __str__(self):
         return f"{self.sender.username} → {self.receiver.username}: {self.content[:30]}"
+
+
+# Sent with user_ids after Conversation rows change through the manager's
+# update()-based methods, which don't send post_save.
+conversations_changed = Signal()
+
+
+class ConversationManager(models.Manager):
+    def for_user(self, user_id):
+        return self.filter(models.Q(user_low_id=user_id) | models.Q(user_high_id=user_id))
+
+    def for_pair(self, user_id, other_id):
+        low, high = sorted((int(user_id), int(other_id)))
+        conversation, created = self.get_or_create(user_low_id=low, user_high_id=high)
+        return conversation
+
+    def record_message(self, message):
+        # Called inside the transaction that inserted the message so the
+        # inbox never points at a message that was rolled back.
+        self.record_messages([message])
+
+    def find_pair(self, user_id, other_id):
+        low, high = sorted((int(user_id), int(other_id)))
+        return self.filter(user_low_id=low, user_high_id=high).first()
+
+    def record_messages(self, messages):
+        # One pass per conversation, using its newest message and bumping
+        # the unread counter of every side that received something.
+        latest = {}
+        received = {}
+        for message in messages:
+            if message.sender_id == message.receiver_id:
+                continue
+            pair = tuple(sorted((message.sender_id, message.receiver_id)))
+            current = latest.get(pair)
+            if current is None or (message.timestamp, message.id) > (current.timestamp, current.id):
+                latest[pair] = message
+            counts = received.setdefault(pair, {})
+            counts[message.receiver_id] = counts.get(message.receiver_id, 0) + 1
+
+        for pair, message in latest.items():
+            conversation = self.for_pair(*pair)
+            self.filter(
+                models.Q(last_message_at__isnull=True) | models.Q(last_message_at__lte=message.timestamp),
+                pk=conversation.pk,
+            ).update(
+                last_message=message,
+                last_message_at=message.timestamp,
+            )
+            self.filter(pk=conversation.pk).update(updated_at=timezone.now(), **{
+                conversation.unread_count_field_for(receiver_id): models.F(conversation.unread_count_field_for(receiver_id)) + count
+                for receiver_id, count in received[pair].items()
+            })
+        if latest:
+            conversations_changed.send(sender=Conversation, user_ids={user_id for pair in latest for user_id in pair})
+
+    def mark_read(self, user_id, watermarks):
+        """
+        Advance user_id's read watermark in several conversations with one
+        UPDATE. watermarks maps the other user's id to the last message id
+        that was read, or None for everything. Watermarks never move
+        backwards. Returns the number of conversations changed.
+        """
+        user_id = int(user_id)
+        watermarks = {int(other_id): message_id for other_id, message_id in watermarks.items() if int(other_id) != user_id}
+        if not watermarks:
+            return 0
+
+        # The canonical pair ordering says which side of each row is ours
+        sides = {"low": ("user_low_id", "user_high_id"), "high": ("user_high_id", "user_low_id")}
+        rows = models.Q()
+        updates = {}
+        for side, (own_field, other_field) in sides.items():
+            others = [other_id for other_id in watermarks if (side == "low") == (user_id < other_id)]
+            if not others:
+                continue
+
+            last_read_field = f"{side}_last_read_id"
+            unread_field = f"{side}_unread_count"
+            last_read_whens = []
+            unread_whens = []
+            for other_id in others:
+                pair = models.Q(**{own_field: user_id, other_field: other_id})
+                message_id = watermarks[other_id]
+                if message_id is None:
+                    # Everything up to the newest message, whoever sent it
+                    changed = pair & (
+                        models.Q(**{f"{unread_field}__gt": 0}) |
+                        models.Q(**{f"{last_read_field}__lt": Coalesce("last_message_id", 0)})
+                    )
+                    last_read = Greatest(
+                        models.F(last_read_field), Coalesce("last_message_id", 0),
+                        output_field=models.BigIntegerField(),
+                    )
+                    unread = models.Value(0)
+                else:
+                    message_id = int(message_id)
+                    changed = pair & models.Q(**{f"{last_read_field}__lt": message_id})
+                    still_unread = Message.objects.filter(
+                        sender_id=other_id, receiver_id=user_id, id__gt=message_id
+                    ).order_by().values("receiver_id").annotate(count=models.Count("id")).values("count")
+                    last_read = models.Value(message_id)
+                    unread = Coalesce(models.Subquery(still_unread), 0)
+                rows |= changed
+                last_read_whens.append(models.When(changed, then=last_read))
+                unread_whens.append(models.When(changed, then=unread))
+
+            updates[last_read_field] = models.Case(
+                *last_read_whens, default=models.F(last_read_field), output_field=models.BigIntegerField()
+            )
+            updates[unread_field] = models.Case(
+                *unread_whens, default=models.F(unread_field), output_field=models.PositiveIntegerField()
+            )
+
+        changed = self.filter(rows).update(updated_at=timezone.now(), **updates)
+        if changed:
+            conversations_changed.send(sender=Conversation, user_ids={user_id})
+        return changed
+
+
+class Conversation(models.Model):
+    """
+    One row per pair of users, keyed by (user_low, user_high) with
+    user_low.id < user_high.id, holding the latest message and the unread
+    count and read watermark for each side, so the inbox can be read
+    without scanning Message.
+    """
+    user_low = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    user_high = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    # A plain reference: the message may have been archived, and a
+    # partitioned table can't be the target of a foreign key.
+    last_message = models.ForeignKey(
+        Message, related_name="+", null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    # Per side: how many received messages are unread, and the id of the
+    # last message that side has read.
+    low_unread_count = models.PositiveIntegerField(default=0)
+    high_unread_count = models.PositiveIntegerField(default=0)
+    low_last_read_id = models.BigIntegerField(default=0)
+    high_last_read_id = models.BigIntegerField(default=0)
+    # Bumped by every counter or watermark change, for delta sync. Rows
+    # are changed with update(), so it is set explicitly rather than auto_now.
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    objects = ConversationManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user_low", "user_high"], name="conversation_unique_pair"),
+            models.CheckConstraint(condition=models.Q(user_low__lt=models.F("user_high")), name="conversation_canonical_pair"),
+        ]
+        indexes = [
+            models.Index(fields=["user_low", "-last_message_at"], name="conversation_low_recent_idx"),
+            models.Index(fields=["user_high", "-last_message_at"], name="conversation_high_recent_idx"),
+            models.Index(fields=["user_low", "updated_at"], name="conversation_low_updated_idx"),
+            models.Index(fields=["user_high", "updated_at"], name="conversation_high_updated_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_low_id} ↔ {self.user_high_id}"
+
+    def other_user_id(self, user_id):
+        return self.user_high_id if int(user_id) == self.user_low_id else self.user_low_id
+
+    def side_for(self, user_id):
+        return "low" if int(user_id) == self.user_low_id else "high"
+
+    def unread_count_field_for(self, user_id):
+        return f"{self.side_for(user_id)}_unread_count"
+
+    def unread_count_for(self, user_id):
+        return getattr(self, self.unread_count_field_for(user_id))
+
+    def last_read_id_for(self, user_id):
+        return getattr(self, f"{self.side_for(user_id)}_last_read_id")
+
+
+class MessageArchive(models.Model):
+    """
+    Where one conversation's messages from one archived month live: a gzip
+    member of `length` bytes at `offset` in the archive file at `path`
+    (see api/archive.py). Rerunning archive_messages over a month that
+    gained late rows adds another segment rather than rewriting this one.
+    """
+    user_low = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    user_high = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    month = models.DateField()
+    path = models.CharField(max_length=255)
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
+    count = models.IntegerField()
+    # (timestamp, id) of the oldest and newest message in the segment, for
+    # picking the segments a page needs without opening them
+    first_timestamp = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_id = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_low", "user_high", "last_timestamp"], name="archive_pair_recent_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_low_id} ↔ {self.user_high_id} {self.month:%Y-%m} ({self.count})"
+
+
+class Room(models.Model):
+    """
+    A group conversation. Members are RoomMember rows; every member's
+    sockets join the room's channel-layer group, so a message is one
+    group_send however many members there are (see api/rooms.py).
+    """
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(User, related_name="+", null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Set from RoomMessage inserts, for ordering the room list
+    last_message_id = models.BigIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class RoomMember(models.Model):
+    room = models.ForeignKey(Room, related_name="members", on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name="room_memberships", on_delete=models.CASCADE)
+    joined_at = models.DateTimeField(default=timezone.now)
+    # Id of the last message this member has read. Unread counts are
+    # derived from it, so sending a message never writes member rows.
+    last_read_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["room", "user"], name="room_member_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "room"], name="room_member_user_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} in {self.room_id}"
+
+
+class RoomMessage(models.Model):
+    room = models.ForeignKey(Room, related_name="messages", on_delete=models.CASCADE)
+    sender = models.ForeignKey(User, related_name="room_messages", null=True, on_delete=models.SET_NULL)
+    content = models.TextField()
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            # History pages (MessageCursorPagination's (timestamp, id) keyset)
+            models.Index(fields=["room", "timestamp", "id"], name="roommessage_recent_idx"),
+            # Unread counts: messages after a member's watermark
+            models.Index(fields=["room", "id"], name="roommessage_room_id_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.sender_id} in {self.room_id}: {self.content[:30]}"
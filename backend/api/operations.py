@@ -0,0 +1,38 @@
+from django.db.migrations.operations import AddIndex
+
+
+class AddIndexConcurrentlyIfSupported(AddIndex):
+    """
+    AddIndex that uses CREATE INDEX CONCURRENTLY on PostgreSQL so building an
+    index on a large live table does not block writes. Other backends get a
+    regular CREATE INDEX. Migrations using it must set atomic = False.
+    """
+    atomic = False
+
+    def describe(self):
+        return "Create index %s on field(s) %s of model %s (concurrently where supported)" % (
+            self.index.name,
+            ", ".join(self.index.fields),
+            self.model_name,
+        )
+
+    def _concurrently(self, schema_editor):
+        return schema_editor.connection.vendor == "postgresql"
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if self._concurrently(schema_editor):
+            schema_editor.add_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.add_index(model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if self._concurrently(schema_editor):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.remove_index(model, self.index)
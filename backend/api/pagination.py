@@ -0,0 +1,186 @@
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return (timestamp, id) from an encoded cursor. Raises ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except TypeError as exc:
+        raise ValueError(str(exc))
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination over (timestamp, id), newest first.
+
+    `?before=<cursor>` walks back into older history and `?after=<cursor>`
+    fetches anything newer than what the client already has. Every page is a
+    single range scan on the index, so its cost does not depend on how long
+    the conversation is.
+
+    Views with a get_archive() method get older pages continued from the
+    archive (api/archive.py) once the table runs out.
+    """
+    before_query_param = "before"
+    after_query_param = "after"
+    page_size_query_param = "page_size"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_page_size(self, request):
+        page_size = settings.MESSAGE_PAGE_SIZE
+        requested = request.query_params.get(self.page_size_query_param)
+        if requested:
+            try:
+                page_size = int(requested)
+            except ValueError:
+                pass
+        return max(1, min(page_size, settings.MESSAGE_MAX_PAGE_SIZE))
+
+    def encode_cursor(self, message):
+        return encode_cursor(message.timestamp, message.id)
+
+    def decode_cursor(self, cursor):
+        try:
+            return decode_cursor(cursor)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+
+        if after:
+            timestamp, message_id = self.decode_cursor(after)
+            queryset = queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+            ).order_by("timestamp", "id")
+        else:
+            if before:
+                timestamp, message_id = self.decode_cursor(before)
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+                )
+            queryset = queryset.order_by("-timestamp", "-id")
+
+        # One extra row tells us whether another page exists
+        rows = list(queryset[:self.page_size + 1])
+        archive = view.get_archive() if hasattr(view, "get_archive") else None
+        if archive is not None and after:
+            # Anything newer than the cursor that was archived comes first
+            archived = archive.after(self.decode_cursor(after), self.page_size + 1)
+            rows = (archived + rows)[:self.page_size + 1]
+        elif archive is not None and len(rows) <= self.page_size:
+            # Deep scrollback: continue below the oldest row still in the table
+            if rows:
+                key = (rows[-1].timestamp, rows[-1].id)
+            else:
+                key = self.decode_cursor(before) if before else None
+            rows += archive.before(key, self.page_size + 1 - len(rows))
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+
+        if after:
+            rows.reverse()
+            self.has_older = True
+            self.has_newer = has_more
+        else:
+            self.has_older = has_more
+            self.has_newer = bool(before)
+
+        self.page = rows
+        return rows
+
+    def get_next_link(self):
+        # Older messages
+        if not self.page or not self.has_older:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, self.before_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_previous_link(self):
+        # Newer messages
+        if not self.page or not self.has_newer:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(self.page[0]))
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+            "results": data,
+        })
+
+
+class SearchPagination(BasePagination):
+    """
+    limit/offset pages without a COUNT query: one extra row is fetched to
+    tell whether a next page exists.
+    """
+    limit_query_param = "limit"
+    offset_query_param = "offset"
+
+    def get_limit(self, request):
+        limit = settings.SEARCH_PAGE_SIZE
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, limit))
+        except ValueError:
+            pass
+        return max(1, min(limit, settings.SEARCH_MAX_PAGE_SIZE))
+
+    def get_offset(self, request):
+        try:
+            return max(0, int(request.query_params.get(self.offset_query_param, 0)))
+        except ValueError:
+            return 0
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.offset = self.get_offset(request)
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        return rows[:self.limit]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_previous_link(self):
+        if self.offset <= 0:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        offset = max(0, self.offset - self.limit)
+        if offset == 0:
+            return remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.offset_query_param, offset)
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+            "results": data,
+        })
@@ -0,0 +1,178 @@
+"""
+Monthly range partitions of api_message on PostgreSQL.
+
+The table is partitioned by month of "timestamp" (UTC). Rows outside
+every monthly partition land in a DEFAULT partition, so an insert never
+fails for lack of a partition; create_partition() moves such rows out
+when their month gets its own. Other databases keep one plain table;
+none of its indexes leads with "timestamp", so archiving a month there
+scans the whole table. That is acceptable for the SQLite development
+setup, and PostgreSQL never needs the scan.
+
+Used by migration 0014 and by api/archive.py, so nothing here imports
+models.
+"""
+from datetime import datetime, timezone
+
+
+TABLE = "api_message"
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+# Created on the parent, so every partition gets them
+INDEXES = [
+    ("message_pair_recent_idx", '(sender_id, receiver_id, "timestamp", id)'),
+    ("message_sender_recent_idx", '(sender_id, "timestamp", id)'),
+    ("message_receiver_recent_idx", '(receiver_id, "timestamp", id)'),
+]
+
+COLUMNS = 'id, content, "timestamp", receiver_id, sender_id'
+
+
+def month_start(value):
+    value = value.astimezone(timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month):
+    return f"{TABLE}_p{month:%Y_%m}"
+
+
+def is_partitioned(connection):
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def partitions(connection):
+    """Monthly partitions currently attached, as {month: table name}."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s)",
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    prefix = f"{TABLE}_p"
+    result = {}
+    for name in names:
+        if name.startswith(prefix):
+            year, month = name[len(prefix):].split("_")
+            result[datetime(int(year), int(month), 1, tzinfo=timezone.utc)] = name
+    return result
+
+
+def default_months(cursor):
+    """Months that have rows sitting in the default partition."""
+    cursor.execute(
+        f"SELECT DISTINCT date_trunc('month', \"timestamp\" AT TIME ZONE 'UTC') FROM {DEFAULT_PARTITION}"
+    )
+    return [row[0].replace(tzinfo=timezone.utc) for row in cursor.fetchall()]
+
+
+def create_partition(cursor, month):
+    name, start, end = partition_name(month), month.isoformat(), add_months(month, 1).isoformat()
+    bounds = f"FOR VALUES FROM ('{start}') TO ('{end}')"
+    cursor.execute(
+        f'SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE "timestamp" >= %s AND "timestamp" < %s)',
+        [start, end],
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} {bounds}")
+        return
+    # PostgreSQL refuses a new partition while the default one holds rows
+    # in its range, so those rows move over with the default detached
+    cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}")
+    cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} {bounds}")
+    cursor.execute(
+        f'INSERT INTO {name} ({COLUMNS}) SELECT {COLUMNS} FROM {DEFAULT_PARTITION} '
+        f'WHERE "timestamp" >= %s AND "timestamp" < %s',
+        [start, end],
+    )
+    cursor.execute(f'DELETE FROM {DEFAULT_PARTITION} WHERE "timestamp" >= %s AND "timestamp" < %s', [start, end])
+    cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+
+
+def ensure_partitions(connection, until):
+    """
+    Give every month up to `until`, and every month with rows in the
+    default partition, a partition of its own. Months already archived
+    are not recreated unless rows for them turn up again.
+    """
+    existing = partitions(connection)
+    with connection.cursor() as cursor:
+        wanted = set(default_months(cursor))
+        month = add_months(max(existing), 1) if existing else month_start(until)
+        while month <= until:
+            wanted.add(month)
+            month = add_months(month, 1)
+        for month in sorted(wanted - existing.keys()):
+            create_partition(cursor, month)
+    return sorted(wanted - existing.keys())
+
+
+def drop_partition(cursor, month):
+    name = partition_name(month)
+    cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+    cursor.execute(f"DROP TABLE {name}")
+
+
+def partition_table(connection, now, months_ahead):
+    """Rebuild api_message as a partitioned table, with partitions from its oldest row to months_ahead."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned")
+        # The primary key of a partitioned table must include the partition
+        # key, so it can't enforce unique ids on its own; api/ids.py keeps
+        # them unique (0016 drops the identity default created here).
+        cursor.execute(f"""
+            CREATE TABLE {TABLE} (
+                id bigint GENERATED BY DEFAULT AS IDENTITY,
+                content text NOT NULL,
+                "timestamp" timestamp with time zone NOT NULL,
+                receiver_id integer NOT NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED,
+                sender_id integer NOT NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED,
+                -- Named so it can't collide with the old table's api_message_pkey
+                CONSTRAINT {TABLE}_id_timestamp_pk PRIMARY KEY (id, "timestamp")
+            ) PARTITION BY RANGE ("timestamp")
+        """)
+        cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT")
+        cursor.execute(f'SELECT min("timestamp") FROM {TABLE}_unpartitioned')
+        oldest = cursor.fetchone()[0] or now
+        month, last = month_start(oldest), add_months(month_start(now), months_ahead)
+        while month <= last:
+            create_partition(cursor, month)
+            month = add_months(month, 1)
+        copy_rows(cursor, f"{TABLE}_unpartitioned")
+
+
+def unpartition_table(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {TABLE}_partitioned")
+        cursor.execute(f"""
+            CREATE TABLE {TABLE} (
+                id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                content text NOT NULL,
+                "timestamp" timestamp with time zone NOT NULL,
+                receiver_id integer NOT NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED,
+                sender_id integer NOT NULL REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED
+            )
+        """)
+        copy_rows(cursor, f"{TABLE}_partitioned")
+
+
+def copy_rows(cursor, source):
+    cursor.execute(f"INSERT INTO {TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM {source}")
+    # Dropping the source drops its indexes, freeing their names
+    cursor.execute(f"DROP TABLE {source}")
+    for name, columns in INDEXES:
+        cursor.execute(f"CREATE INDEX {name} ON {TABLE} {columns}")
+    cursor.execute(
+        f"SELECT setval(pg_get_serial_sequence('{TABLE}', 'id'), coalesce(max(id), 0) + 1, false) FROM {TABLE}"
+    )
@@ -0,0 +1,318 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import BooleanField, Case, DateTimeField, Value, When
+from django.utils import timezone
+
+from .models import Profile
+from . import events, friendships, versions
+from .broadcast import group_send_many, user_group
+from .log import log
+from .metrics import database_sync_to_async
+
+
+logger = logging.getLogger(__name__)
+
+
+# Identifies this process in logs; connections are tracked per channel name.
+WORKER_ID = uuid.uuid4().hex
+
+
+class LocalPresenceBackend:
+    """
+    Connection registry for a single process. Each user maps to the channels
+    they have open and when each one expires unless refreshed.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id, channel_name, expires_at, now):
+        with self._lock:
+            channels = self._connections.setdefault(user_id, {})
+            self._drop_expired(channels, now)
+            channels[channel_name] = expires_at
+            return len(channels)
+
+    def remove(self, user_id, channel_name, now):
+        with self._lock:
+            channels = self._connections.get(user_id, {})
+            channels.pop(channel_name, None)
+            self._drop_expired(channels, now)
+            if not channels:
+                self._connections.pop(user_id, None)
+            return len(channels)
+
+    def refresh(self, connections, expires_at):
+        with self._lock:
+            for user_id, channel_name in connections:
+                channels = self._connections.get(user_id)
+                if channels and channel_name in channels:
+                    channels[channel_name] = expires_at
+
+    def statuses(self, user_ids, now):
+        with self._lock:
+            return {
+                user_id: any(expires_at > now for expires_at in self._connections.get(user_id, {}).values())
+                for user_id in user_ids
+            }
+
+    def expire(self, now):
+        went_offline = []
+        with self._lock:
+            for user_id, channels in list(self._connections.items()):
+                self._drop_expired(channels, now)
+                if not channels:
+                    del self._connections[user_id]
+                    went_offline.append(user_id)
+        return went_offline
+
+    def _drop_expired(self, channels, now):
+        for channel_name, expires_at in list(channels.items()):
+            if expires_at <= now:
+                del channels[channel_name]
+
+
+class RedisPresenceBackend:
+    """
+    Shares connection counts between workers.
+
+    presence:conns:<user_id> is a sorted set of channel names scored by
+    expiry, and presence:users scores each online user by their latest
+    expiry so status lookups are one ZSCORE per user and the sweeper can
+    find stale users with a single range query.
+    """
+
+    users_key = "presence:users"
+
+    ADD_SCRIPT = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[4])
+    return redis.call('ZCARD', KEYS[1])
+    """
+
+    REMOVE_SCRIPT = """
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+    local remaining = redis.call('ZCARD', KEYS[1])
+    if remaining == 0 then
+        redis.call('ZREM', KEYS[2], ARGV[3])
+    end
+    return remaining
+    """
+
+    EXPIRE_SCRIPT = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    local latest = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+    if #latest == 0 then
+        return redis.call('ZREM', KEYS[2], ARGV[2])
+    end
+    redis.call('ZADD', KEYS[2], latest[2], ARGV[2])
+    return 0
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self._add = self.client.register_script(self.ADD_SCRIPT)
+        self._remove = self.client.register_script(self.REMOVE_SCRIPT)
+        self._expire = self.client.register_script(self.EXPIRE_SCRIPT)
+
+    def conns_key(self, user_id):
+        return f"presence:conns:{user_id}"
+
+    def add(self, user_id, channel_name, expires_at, now):
+        return self._add(
+            keys=[self.conns_key(user_id), self.users_key],
+            args=[channel_name, expires_at, now, user_id],
+        )
+
+    def remove(self, user_id, channel_name, now):
+        return self._remove(
+            keys=[self.conns_key(user_id), self.users_key],
+            args=[channel_name, now, user_id],
+        )
+
+    def refresh(self, connections, expires_at):
+        if not connections:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for user_id, channel_name in connections:
+            pipe.zadd(self.conns_key(user_id), {channel_name: expires_at}, xx=True)
+            pipe.zadd(self.users_key, {user_id: expires_at}, xx=True)
+        pipe.execute()
+
+    def statuses(self, user_ids, now):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zscore(self.users_key, user_id)
+        return {
+            user_id: score is not None and score > now
+            for user_id, score in zip(user_ids, pipe.execute())
+        }
+
+    def expire(self, now):
+        went_offline = []
+        for member in self.client.zrangebyscore(self.users_key, "-inf", now):
+            user_id = int(member)
+            if self._expire(keys=[self.conns_key(user_id), self.users_key], args=[now, user_id]):
+                went_offline.append(user_id)
+        return went_offline
+
+
+class LastSeenWriter:
+    """
+    Coalesces is_online/last_seen changes and writes them in bulk, so a
+    burst of connects and disconnects costs one UPDATE per batch instead of
+    one row save per event.
+    """
+
+    batch_size = 500
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def record(self, user_id, is_online, when=None):
+        with self._lock:
+            self._pending[user_id] = (is_online, when or timezone.now())
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            Profile.objects.filter(user_id__in=[user_id for user_id, _ in batch]).update(
+                is_online=Case(
+                    *[When(user_id=user_id, then=Value(is_online)) for user_id, (is_online, _) in batch],
+                    output_field=BooleanField(),
+                ),
+                last_seen=Case(
+                    *[When(user_id=user_id, then=Value(when)) for user_id, (_, when) in batch],
+                    output_field=DateTimeField(),
+                ),
+            )
+        # last_seen is only shown while a user is offline, and coming online
+        # already changes the presence part of every ETag (versions.etag),
+        # so only going offline needs new versions
+        went_offline = [user_id for user_id, (is_online, _) in items if not is_online]
+        if went_offline:
+            versions.profiles_changed(went_offline)
+        return len(items)
+
+
+class PresenceTracker:
+    def __init__(self, backend):
+        self.backend = backend
+        self.writer = LastSeenWriter()
+        self.local_connections = {}
+        self._local_lock = threading.Lock()
+        self._sweeper = None
+
+    @property
+    def ttl(self):
+        return settings.PRESENCE_TTL
+
+    def connect(self, user_id, channel_name):
+        """Register a live socket. Returns True if the user just came online."""
+        now = time.time()
+        with self._local_lock:
+            self.local_connections[channel_name] = user_id
+        count = self.backend.add(user_id, channel_name, now + self.ttl, now)
+        if count == 1:
+            self.writer.record(user_id, True)
+        return count == 1
+
+    def disconnect(self, user_id, channel_name):
+        """Drop a socket. Returns True if it was the user's last one."""
+        with self._local_lock:
+            self.local_connections.pop(channel_name, None)
+        remaining = self.backend.remove(user_id, channel_name, time.time())
+        if remaining == 0:
+            self.writer.record(user_id, False)
+        return remaining == 0
+
+    def statuses(self, user_ids):
+        return self.backend.statuses([int(user_id) for user_id in user_ids], time.time())
+
+    def is_online(self, user_id):
+        return self.statuses([user_id])[int(user_id)]
+
+    def heartbeat(self):
+        with self._local_lock:
+            connections = [(user_id, channel_name) for channel_name, user_id in self.local_connections.items()]
+        self.backend.refresh(connections, time.time() + self.ttl)
+
+    def sweep(self):
+        """Expire connections whose worker stopped refreshing them."""
+        went_offline = self.backend.expire(time.time())
+        for user_id in went_offline:
+            self.writer.record(user_id, False)
+        return went_offline
+
+    def ensure_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self.run_sweeper())
+
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_SWEEP_INTERVAL)
+            try:
+                await sync_to_async(self.heartbeat, thread_sensitive=False)()
+                went_offline = await sync_to_async(self.sweep, thread_sensitive=False)()
+                if went_offline:
+                    await notify_expired(went_offline)
+                await database_sync_to_async(self.writer.flush)()
+            except Exception:
+                log(logger, logging.ERROR, "presence.sweep_failed", exc_info=True, worker=WORKER_ID)
+
+
+async def notify_expired(user_ids):
+    # Friends of users whose worker died never got an offline event
+    @database_sync_to_async
+    def load(user_ids):
+        usernames = dict(User.objects.filter(id__in=user_ids).values_list("id", "username"))
+        return [(user_id, usernames.get(user_id), friendships.get_friend_ids(user_id)) for user_id in user_ids]
+
+    for user_id, username, friend_ids in await load(user_ids):
+        await group_send_many(
+            [user_group(friend_id) for friend_id in friend_ids],
+            events.online_status(user_id, username, False)
+        )
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                if settings.PRESENCE_REDIS_URL:
+                    backend = RedisPresenceBackend(settings.PRESENCE_REDIS_URL)
+                else:
+                    backend = LocalPresenceBackend()
+                _tracker = PresenceTracker(backend)
+                # The sweeper only flushes every PRESENCE_SWEEP_INTERVAL
+                atexit.register(_tracker.writer.flush)
+    return _tracker
+
+
+def statuses(user_ids):
+    return get_tracker().statuses(user_ids)
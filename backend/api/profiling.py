@@ -0,0 +1,134 @@
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+from .log import log
+
+
+logger = logging.getLogger(__name__)
+
+# The profile for the HTTP request or consumer event being handled. It is
+# copied into the threads database_sync_to_async runs on, so queries made
+# there are counted against the event that caused them.
+current = contextvars.ContextVar("db_profile", default=None)
+
+# Longest statement text kept per query
+MAX_SQL_LENGTH = 1000
+
+
+class QueryProfile:
+    """
+    Database execute wrapper (see connection.execute_wrapper) that counts
+    queries and their time. Statements are kept without their parameters,
+    up to DB_PROFILE_MAX_TRACE of them.
+    """
+
+    def __init__(self, **fields):
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = []
+        # Logged with the report; callers add to it as they learn more
+        self.fields = fields
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if len(self.queries) < settings.DB_PROFILE_MAX_TRACE:
+                self.queries.append((elapsed, sql[:MAX_SQL_LENGTH]))
+
+    @property
+    def ms(self):
+        return round(self.seconds * 1000, 3)
+
+    def slowest(self, count):
+        return [
+            {"ms": round(elapsed * 1000, 3), "sql": sql}
+            for elapsed, sql in sorted(self.queries, key=lambda query: query[0], reverse=True)[:count]
+        ]
+
+    def trace(self):
+        return [{"ms": round(elapsed * 1000, 3), "sql": sql} for elapsed, sql in self.queries]
+
+
+@contextmanager
+def recording():
+    """Count this thread's queries against the current profile, if there is one."""
+    profile = current.get()
+    if profile is None:
+        yield
+        return
+    with connection.execute_wrapper(profile):
+        yield
+
+
+@contextmanager
+def profile(name, **fields):
+    """
+    Make a new profile current while the block executes and report it as
+    the block exits. Queries are counted where recording() is active: in
+    database_sync_to_async calls, and around the view in the middleware.
+    Async code must not enter recording() itself, since the event loop
+    thread's connection is shared by every consumer on it.
+    """
+    if not settings.DB_PROFILE:
+        yield None
+        return
+    query_profile = QueryProfile(**fields)
+    token = current.set(query_profile)
+    started = time.perf_counter()
+    try:
+        yield query_profile
+    finally:
+        current.reset(token)
+        report(name, query_profile, time.perf_counter() - started)
+
+
+def report(name, query_profile, seconds):
+    duration_ms = round(seconds * 1000, 3)
+    fields = dict(query_profile.fields)
+    slow = duration_ms >= settings.DB_PROFILE_SLOW_MS or query_profile.count >= settings.DB_PROFILE_MAX_QUERIES
+    if not slow:
+        log(logger, logging.DEBUG, "db.profile", name=name, duration_ms=duration_ms,
+            queries=query_profile.count, db_ms=query_profile.ms, **fields)
+        return
+    if random.random() < settings.DB_PROFILE_TRACE_SAMPLE_RATE:
+        fields["trace"] = query_profile.trace()
+    log(
+        logger, logging.WARNING, "db.slow", name=name, duration_ms=duration_ms,
+        queries=query_profile.count, db_ms=query_profile.ms,
+        slowest=query_profile.slowest(settings.DB_PROFILE_TOP_QUERIES), **fields,
+    )
+
+
+class DBProfileMiddleware:
+    """
+    Profiles every HTTP request's queries. Slow or query-heavy requests are
+    logged with their slowest statements; with DB_PROFILE_HEADERS the counts
+    are also returned as X-DB-Queries, X-DB-Time-Ms and Server-Timing.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with profile("http", method=request.method, path=request.path) as query_profile, recording():
+            response = self.get_response(request)
+            if query_profile is not None:
+                query_profile.fields["status"] = response.status_code
+                if request.resolver_match is not None:
+                    query_profile.fields["route"] = request.resolver_match.url_name
+        if query_profile is not None and settings.DB_PROFILE_HEADERS:
+            response["X-DB-Queries"] = str(query_profile.count)
+            response["X-DB-Time-Ms"] = str(query_profile.ms)
+            response["Server-Timing"] = f'db;dur={query_profile.ms};desc="{query_profile.count} queries"'
+        return response
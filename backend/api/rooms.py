@@ -0,0 +1,131 @@
+"""
+Group conversations.
+
+Every socket of every member joins the room's channel-layer group
+(room_<id>) when it connects, and again when its user is added, so a
+message is published with a single group_send whatever the room's size.
+Room events are not sequenced per user like send_to_users events; a
+client that was away catches up from the room's paginated history.
+
+Membership is cached both ways (room -> member ids, user -> room ids)
+and invalidated after commit whenever a RoomMember row changes.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+
+from . import events, metrics
+from .broadcast import notify_users
+from .models import Room, RoomMember, RoomMessage
+
+
+MEMBERS_PREFIX = "room_members:"
+ROOMS_PREFIX = "user_rooms:"
+
+
+def room_group(room_id):
+    return f"room_{room_id}"
+
+
+def get_cache():
+    return caches[settings.ROOM_CACHE_ALIAS]
+
+
+def get_member_ids(room_id):
+    key = f"{MEMBERS_PREFIX}{int(room_id)}"
+    member_ids = get_cache().get(key)
+    if member_ids is None:
+        member_ids = frozenset(RoomMember.objects.filter(room_id=room_id).values_list("user_id", flat=True))
+        get_cache().set(key, member_ids, settings.ROOM_CACHE_TIMEOUT)
+    return member_ids
+
+
+def get_room_ids(user_id):
+    key = f"{ROOMS_PREFIX}{int(user_id)}"
+    room_ids = get_cache().get(key)
+    if room_ids is None:
+        room_ids = frozenset(RoomMember.objects.filter(user_id=user_id).values_list("room_id", flat=True))
+        get_cache().set(key, room_ids, settings.ROOM_CACHE_TIMEOUT)
+    return room_ids
+
+
+def is_member(user_id, room_id):
+    return int(user_id) in get_member_ids(room_id)
+
+
+def invalidate(room_id, user_ids):
+    get_cache().delete_many(
+        [f"{MEMBERS_PREFIX}{int(room_id)}"] + [f"{ROOMS_PREFIX}{int(user_id)}" for user_id in user_ids]
+    )
+
+
+def member_changed(sender, instance, **kwargs):
+    # Wait for the commit so a concurrent reader can't cache the old membership again
+    room_id, user_id = instance.room_id, instance.user_id
+    transaction.on_commit(lambda: invalidate(room_id, [user_id]))
+
+
+def add_members(room, user_ids):
+    """Add users to room, skipping existing members. Returns the ids added."""
+    added = sorted({int(user_id) for user_id in user_ids} - get_member_ids(room.id))
+    with transaction.atomic():
+        RoomMember.objects.bulk_create(
+            [RoomMember(room=room, user_id=user_id) for user_id in added], ignore_conflicts=True
+        )
+        # bulk_create sends no post_save
+        transaction.on_commit(lambda: invalidate(room.id, added))
+    if added:
+        # Their sockets join the group when this arrives (FriendConsumer.room_joined)
+        notify_users(added, events.room_joined(room.id, room.name))
+        publish(room.id, events.room_members(room.id, added=added))
+    return added
+
+
+def remove_member(room, user_id):
+    deleted, _ = RoomMember.objects.filter(room=room, user_id=user_id).delete()
+    if deleted:
+        publish(room.id, events.room_members(room.id, removed=[int(user_id)]))
+        notify_users([user_id], events.room_left(room.id))
+    return bool(deleted)
+
+
+def create_room(creator_id, name, member_ids):
+    user_ids = {int(creator_id), *(int(user_id) for user_id in member_ids)}
+    with transaction.atomic():
+        room = Room.objects.create(name=name, created_by_id=creator_id)
+        RoomMember.objects.bulk_create([RoomMember(room=room, user_id=user_id) for user_id in user_ids])
+        transaction.on_commit(lambda: invalidate(room.id, user_ids))
+    notify_users(user_ids, events.room_joined(room.id, room.name))
+    return room
+
+
+def record_message(room_id, sender_id, content):
+    with transaction.atomic():
+        message = RoomMessage.objects.create(room_id=room_id, sender_id=sender_id, content=content)
+        Room.objects.filter(pk=room_id).filter(
+            Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.timestamp)
+        ).update(last_message_id=message.id, last_message_at=message.timestamp)
+        # Sending means having read everything up to here
+        RoomMember.objects.filter(room_id=room_id, user_id=sender_id, last_read_id__lt=message.id).update(
+            last_read_id=message.id
+        )
+    return message
+
+
+def mark_read(room_id, user_id, message_id):
+    """Advance user_id's watermark in room_id; it never moves backwards. One UPDATE."""
+    return RoomMember.objects.filter(room_id=room_id, user_id=user_id, last_read_id__lt=message_id).update(
+        last_read_id=message_id
+    )
+
+
+async def apublish(room_id, message, channel_layer=None):
+    await metrics.group_send(channel_layer or get_channel_layer(), room_group(room_id), message)
+
+
+def publish(room_id, message):
+    # Sync entry point for the REST views
+    async_to_sync(apublish)(room_id, message)
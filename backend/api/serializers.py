@@ -1,8 +1,12 @@
+from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError as DjangoValidationError
-from .models import Profile, FriendRequest, Message
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from django.db import models
+from .models import Profile, FriendRequest, Message, Room, RoomMember, RoomMessage
+from . import images, presence
 
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(
@@ -35,28 +39,93 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class PresenceListSerializer(serializers.ListSerializer):
+    # Looks up online status for the whole page in one presence call
+    def to_representation(self, data):
+        profiles = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        self.child.presence_statuses = presence.statuses([profile.user_id for profile in profiles])
+        try:
+            return super().to_representation(profiles)
+        finally:
+            self.child.presence_statuses = None
+
+
+class PresenceMixin:
+    presence_statuses = None
+
+    def get_is_online(self, obj):
+        if self.presence_statuses is not None and obj.user_id in self.presence_statuses:
+            return self.presence_statuses[obj.user_id]
+        return presence.get_tracker().is_online(obj.user_id)
+
+
+class ProfilePictureMixin:
+    def get_profile_picture_urls(self, obj):
+        # {"64": {"webp": url, "jpeg": url}, ...}; lists should use these
+        # rather than the full-size profile_picture
+        storage = obj.profile_picture.storage
+        return {
+            size: {extension: storage.url(path) for extension, path in formats.items()}
+            for size, formats in obj.profile_picture_variants.items()
+        }
+
+
+class ChatTokenObtainPairSerializer(TokenObtainPairSerializer):
+    # Lets the socket and claims-only views know the username without a query
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['username'] = user.username
+        return token
+
+
+class ProfileSerializer(ProfilePictureMixin, PresenceMixin, serializers.ModelSerializer):
     username = serializers.CharField(source='user.username', read_only=True)
     user_id = serializers.IntegerField(source='user.id', read_only=True)
-    is_online = serializers.BooleanField(read_only=True)  # <-- add this
+    is_online = serializers.SerializerMethodField()
+    profile_picture_urls = serializers.SerializerMethodField()
 
     class Meta:
         model = Profile
-        fields = ['id', 'username', 'first_name', 'last_name', 'profile_picture', 'is_online', 'last_seen', 'user_id']
+        fields = [
+            'id', 'username', 'first_name', 'last_name', 'profile_picture', 'profile_picture_urls',
+            'is_online', 'last_seen', 'user_id',
+        ]
+        list_serializer_class = PresenceListSerializer
 
     def create(self, validated_data):
         user = self.context['user']
         profile = Profile.objects.create(user=user, **validated_data)
+        if profile.profile_picture:
+            images.schedule_profile_picture(profile)
+        return profile
+
+    def update(self, instance, validated_data):
+        if "profile_picture" not in validated_data:
+            return super().update(instance, validated_data)
+        # The old picture's files go once the new one is processed, so
+        # clients never point at a deleted thumbnail
+        stale = images.variant_paths(instance.profile_picture_variants)
+        if instance.profile_picture:
+            stale.append(instance.profile_picture.name)
+        instance.profile_picture_variants = {}
+        profile = super().update(instance, validated_data)
+        if profile.profile_picture:
+            images.schedule_profile_picture(profile, stale)
+        else:
+            images.delete_on_commit(stale)
         return profile
     
 
 
-class NestedProfileSerializer(serializers.ModelSerializer):
+class NestedProfileSerializer(ProfilePictureMixin, PresenceMixin, serializers.ModelSerializer):
     username = serializers.CharField(source='user.username', read_only=True)
+    is_online = serializers.SerializerMethodField()
+    profile_picture_urls = serializers.SerializerMethodField()
 
     class Meta:
         model = Profile
-        fields = ['username', 'first_name', 'last_name', 'profile_picture', 'is_online', 'last_seen']
+        fields = ['username', 'first_name', 'last_name', 'profile_picture', 'profile_picture_urls', 'is_online', 'last_seen']
 
         
 
@@ -75,14 +144,74 @@ class FriendRequestSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = FriendRequest
-        fields = ["id", "from_user", "to_user", "status", "from_new_message", "to_new_message", "created_at"]
+        fields = ["id", "from_user", "to_user", "status", "created_at"]
 
         
 
 class MessageSerializer(serializers.ModelSerializer):
     receiver = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
     sender = serializers.PrimaryKeyRelatedField(read_only=True)
+    is_read = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
         fields = ["id", "sender", "receiver", "content", "timestamp", "is_read"]
+
+    def get_is_read(self, obj):
+        # Read once the receiver's watermark has passed it
+        conversation = self.context.get("conversation")
+        return conversation is not None and obj.id <= conversation.last_read_id_for(obj.receiver_id)
+
+
+class ReadMarkerSerializer(serializers.Serializer):
+    friend_id = serializers.IntegerField()
+    # Last message read; omitted or null means everything
+    message_id = serializers.IntegerField(required=False, allow_null=True)
+
+
+class RoomSerializer(serializers.ModelSerializer):
+    # Friends of the creator to add alongside them
+    member_ids = serializers.ListField(child=serializers.IntegerField(), write_only=True, required=False)
+    # Annotated by RoomListCreateView for the caller
+    unread_count = serializers.IntegerField(read_only=True, default=0)
+    last_read_id = serializers.IntegerField(read_only=True, default=0)
+
+    class Meta:
+        model = Room
+        fields = [
+            "id", "name", "created_by", "created_at", "last_message_id", "last_message_at",
+            "member_ids", "unread_count", "last_read_id",
+        ]
+        read_only_fields = ["created_by", "created_at", "last_message_id", "last_message_at"]
+
+    def validate_member_ids(self, value):
+        if len(set(value)) + 1 > settings.ROOM_MAX_MEMBERS:
+            raise serializers.ValidationError(f"A room holds at most {settings.ROOM_MAX_MEMBERS} members.")
+        return value
+
+
+class RoomMemberSerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source="user.username", read_only=True)
+    first_name = serializers.CharField(source="user.profile.first_name", read_only=True, default="")
+    last_name = serializers.CharField(source="user.profile.last_name", read_only=True, default="")
+
+    class Meta:
+        model = RoomMember
+        fields = ["user_id", "username", "first_name", "last_name", "joined_at", "last_read_id"]
+
+
+class RoomMessageSerializer(serializers.ModelSerializer):
+    sender = serializers.PrimaryKeyRelatedField(read_only=True)
+    room = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    class Meta:
+        model = RoomMessage
+        fields = ["id", "room", "sender", "content", "timestamp"]
+
+
+class RoomMembersSerializer(serializers.Serializer):
+    user_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+
+class RoomReadSerializer(serializers.Serializer):
+    message_id = serializers.IntegerField()
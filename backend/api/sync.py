@@ -0,0 +1,71 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Conversation, FriendRequest, Message
+from .pagination import decode_cursor, encode_cursor
+from .serializers import FriendRequestSerializer
+from . import events
+
+
+def conversation_state(conversation, user_id):
+    friend_id = conversation.other_user_id(user_id)
+    return {
+        "friend_id": friend_id,
+        "unread_count": conversation.unread_count_for(user_id),
+        "last_read_id": conversation.last_read_id_for(user_id),
+        "friend_last_read_id": conversation.last_read_id_for(friend_id),
+        "last_message_id": conversation.last_message_id,
+    }
+
+
+def delta(user_id, cursor=None):
+    """
+    Everything that changed for user_id since cursor: messages sent or
+    received, conversations whose unread counts or watermarks moved, and
+    friend requests that were created, accepted or rejected.
+
+    Messages are a keyset walk over (timestamp, id) capped at
+    SYNC_MAX_MESSAGES; "has_more" says to call again with the returned
+    cursor. Without a cursor only a fresh cursor is returned, since the
+    client loads its initial state through the regular endpoints.
+
+    The returned cursor trails the clock by SYNC_GRACE_SECONDS so rows that
+    commit late (write-behind batches, slow transactions) are not skipped.
+    Anything in that window comes back again, so clients dedupe by id.
+    """
+    now = timezone.now()
+    floor = now - timedelta(seconds=settings.SYNC_GRACE_SECONDS)
+    result = {"messages": [], "conversations": [], "friend_requests": [], "has_more": False}
+    if cursor is None:
+        result["cursor"] = encode_cursor(floor, 0)
+        return result
+
+    since, since_id = decode_cursor(cursor)
+
+    limit = settings.SYNC_MAX_MESSAGES
+    messages = list(
+        Message.objects.filter(Q(sender_id=user_id) | Q(receiver_id=user_id)).filter(
+            Q(timestamp__gt=since) | Q(timestamp=since, id__gt=since_id)
+        ).order_by("timestamp", "id")[:limit + 1]
+    )
+    result["has_more"] = len(messages) > limit
+    messages = messages[:limit]
+    result["messages"] = [events.message_data(message) for message in messages]
+
+    conversations = Conversation.objects.for_user(user_id).filter(updated_at__gte=since)
+    result["conversations"] = [conversation_state(conversation, user_id) for conversation in conversations]
+
+    friend_requests = FriendRequest.objects.filter(
+        Q(from_user_id=user_id) | Q(to_user_id=user_id), updated_at__gte=since
+    ).select_related("from_user__profile", "to_user__profile")
+    result["friend_requests"] = list(FriendRequestSerializer(friend_requests, many=True).data)
+
+    if result["has_more"]:
+        last = messages[-1]
+        result["cursor"] = encode_cursor(last.timestamp, last.id)
+    else:
+        result["cursor"] = encode_cursor(max(floor, since), 0 if floor > since else since_id)
+    return result
@@ -1,3 +1,1539 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import random
+import shutil
+import tempfile
+from contextlib import nullcontext
+from importlib import import_module
+from unittest import mock
+from datetime import datetime, timedelta, timezone as dt_timezone
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Max, Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .authentication import CachedJWTAuthentication, ClaimsJWTAuthentication, JWTAuthMiddleware
+from . import (
+    archive, bootstrap, broadcast, delivery, events, friendships, ids, metrics, presence, profiling, rooms, sync,
+    typing_indicators, versions, write_behind,
+)
+from .benchmarks import ENDPOINTS, Dataset
+from .consumers import FriendConsumer
+from .management.commands import bench_ws, seed_data
+from .models import Conversation, FriendRequest, Message, MessageArchive, Profile, RoomMember
+from .pagination import decode_cursor, encode_cursor
+from .serializers import ChatTokenObtainPairSerializer, MessageSerializer
+
+
+def reset_caches():
+    # Row ids are reused between tests, so per-user cache entries left by
+    # one test would be read back as another user's in the next.
+    cache.clear()
+    friendships.get_backend().clear()
+
+
+def authed_client(user):
+    client = APIClient()
+    token = ChatTokenObtainPairSerializer.get_token(user).access_token
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+    return client
+
+
+def seed_worker_ids(count):
+    # Runs in a seed_data pool worker
+    return ids.get_generator().worker_id, [ids.next_message_id() for _ in range(count)]
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+)
+class MessageIdTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        FriendRequest.objects.create(from_user=self.alice, to_user=self.bob, status="accepted")
+        reset_caches()
+
+    def test_queued_and_rest_messages_share_one_ordered_id_source(self):
+        writer = write_behind.get_writer()
+        queued = writer.build(self.bob.id, self.alice.id, "over the socket")
+        response = authed_client(self.bob).post(
+            "/api/messages/", {"receiver": self.alice.id, "content": "over REST"}, format="json"
+        )
+        writer.write([queued])
+
+        # Built first, so lower, even though it was inserted last
+        self.assertLess(queued.id, response.data["id"])
+        Conversation.objects.mark_read(self.alice.id, {self.bob.id: queued.id})
+        conversation = Conversation.objects.find_pair(self.alice.id, self.bob.id)
+        self.assertEqual(conversation.unread_count_for(self.alice.id), 1)
+        page = authed_client(self.alice).get(f"/api/messages/{self.bob.id}/").data["results"]
+        self.assertEqual({message["content"]: message["is_read"] for message in page},
+                         {"over the socket": True, "over REST": False})
+
+    def test_worker_id_must_fit(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ids.MessageIdGenerator(1 << ids.MessageIdGenerator.WORKER_BITS)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+)
+class FriendRequestTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        self.request = FriendRequest.objects.create(from_user=self.alice, to_user=self.bob)
+        reset_caches()
+        self.client = authed_client(self.bob)
+
+    def test_request_is_accepted_once(self):
+        self.assertEqual(self.client.put(f"/api/friends/accept/{self.request.id}/").status_code, 200)
+        self.assertEqual(friendships.get_friend_ids(self.bob.id), {self.alice.id})
+
+        self.assertEqual(self.client.put(f"/api/friends/accept/{self.request.id}/").status_code, 400)
+        self.assertEqual(self.client.delete(f"/api/friends/reject/{self.request.id}/").status_code, 400)
+        self.assertEqual(FriendRequest.objects.get(id=self.request.id).status, "accepted")
+
+    def test_rejected_request_cannot_be_accepted(self):
+        self.assertEqual(self.client.delete(f"/api/friends/reject/{self.request.id}/").status_code, 204)
+
+        self.assertEqual(self.client.put(f"/api/friends/accept/{self.request.id}/").status_code, 400)
+        self.assertEqual(FriendRequest.objects.get(id=self.request.id).status, "rejected")
+        self.assertEqual(friendships.get_friend_ids(self.bob.id), frozenset())
+
+
+class FriendshipCacheTests(TestCase):
+    def setUp(self):
+        reset_caches()
+
+    def backends(self):
+        return [friendships.LocalFriendshipBackend(10), friendships.SharedFriendshipBackend("default", 60)]
+
+    def test_accepting_a_request_invalidates_both_users(self):
+        alice = User.objects.create_user(username="alice", password="pw")
+        bob = User.objects.create_user(username="bob", password="pw")
+        request = FriendRequest.objects.create(from_user=alice, to_user=bob)
+        self.assertEqual(friendships.get_friend_ids(alice.id), frozenset())
+        self.assertEqual(friendships.get_friend_ids(bob.id), frozenset())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            request.status = "accepted"
+            request.save()
+
+        self.assertEqual(friendships.get_friend_ids(alice.id), {bob.id})
+        self.assertEqual(friendships.get_friend_ids(bob.id), {alice.id})
+
+    def test_deleting_a_friendship_invalidates_both_users(self):
+        alice = User.objects.create_user(username="alice", password="pw")
+        bob = User.objects.create_user(username="bob", password="pw")
+        request = FriendRequest.objects.create(from_user=alice, to_user=bob, status="accepted")
+        reset_caches()
+        self.assertEqual(friendships.get_friend_ids(alice.id), {bob.id})
+
+        with self.assertNumQueries(0):
+            friendships.get_friend_ids(alice.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            request.delete()
+
+        self.assertEqual(friendships.get_friend_ids(alice.id), frozenset())
+        self.assertEqual(friendships.get_friend_ids(bob.id), frozenset())
+
+    def test_local_backend_evicts_least_recently_used(self):
+        backend = friendships.LocalFriendshipBackend(2)
+        for user_id in (1, 2):
+            backend.set(user_id, frozenset({user_id + 10}), backend.generation(user_id))
+        backend.get(1)
+        backend.set(3, frozenset({13}), backend.generation(3))
+
+        self.assertEqual(backend.get(1), {11})
+        self.assertIsNone(backend.get(2))
+        self.assertEqual(backend.get(3), {13})
+
+    def test_load_that_races_an_invalidation_is_not_cached(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                generation = backend.generation(1)
+                # The graph changes while the loader is still reading
+                backend.delete_many([1])
+                backend.set(1, frozenset({2}), generation)
+                self.assertIsNone(backend.get(1))
+
+                backend.set(1, frozenset({3}), backend.generation(1))
+                self.assertEqual(backend.get(1), {3})
+
+    def test_shared_clear_leaves_the_rest_of_the_alias(self):
+        backend = friendships.SharedFriendshipBackend("default", 60)
+        backend.set(1, frozenset({2}), backend.generation(1))
+        cache.set("unrelated", "kept")
+
+        backend.clear()
+
+        self.assertIsNone(backend.get(1))
+        self.assertEqual(cache.get("unrelated"), "kept")
+
+
+class ConversationTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        reset_caches()
+
+    def test_record_message_keeps_newest_and_counts_unread(self):
+        now = datetime.now(dt_timezone.utc)
+        newer = Message.objects.create(sender=self.alice, receiver=self.bob, content="newer", timestamp=now)
+        older = Message.objects.create(
+            sender=self.bob, receiver=self.alice, content="older", timestamp=now - timedelta(minutes=1)
+        )
+        Conversation.objects.record_message(newer)
+        # Recorded late, e.g. by the write-behind queue, so it must not become the preview
+        Conversation.objects.record_message(older)
+        Conversation.objects.record_message(
+            Message.objects.create(sender=self.alice, receiver=self.alice, content="self")
+        )
+
+        conversation = Conversation.objects.get()
+        self.assertEqual((conversation.user_low_id, conversation.user_high_id), (self.alice.id, self.bob.id))
+        self.assertEqual(conversation.last_message_id, newer.id)
+        self.assertEqual(conversation.unread_count_for(self.bob.id), 1)
+        self.assertEqual(conversation.unread_count_for(self.alice.id), 1)
+
+    def test_record_messages_batches_per_pair(self):
+        messages = [
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=str(i)) for i in range(3)
+        ]
+        Conversation.objects.record_messages(messages)
+
+        conversation = Conversation.objects.find_pair(self.bob.id, self.alice.id)
+        self.assertEqual(conversation.last_message_id, messages[-1].id)
+        self.assertEqual(conversation.unread_count_for(self.bob.id), 3)
+        self.assertEqual(conversation.unread_count_for(self.alice.id), 0)
+
+
+class ConversationBackfillTests(TransactionTestCase):
+    """Runs 0007 against rows written with the pre-Conversation schema."""
+
+    migrate_from = [("api", "0006_conversation")]
+    migrate_to = [("api", "0007_backfill_conversations")]
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.leaf = self.executor.loader.graph.leaf_nodes("api")
+        self.executor.migrate(self.migrate_from)
+        self.executor.loader.build_graph()
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.leaf)
+
+    def test_backfill_builds_one_row_per_pair(self):
+        apps = self.executor.loader.project_state(self.migrate_from).apps
+        HistoricalUser = apps.get_model("auth", "User")
+        HistoricalFriendRequest = apps.get_model("api", "FriendRequest")
+        HistoricalMessage = apps.get_model("api", "Message")
+        alice = HistoricalUser.objects.create(username="alice")
+        bob = HistoricalUser.objects.create(username="bob")
+        carol = HistoricalUser.objects.create(username="carol")
+        # Bob sent the request, and alice has unread messages from him
+        HistoricalFriendRequest.objects.create(from_user=bob, to_user=alice, status="accepted", from_new_message=True)
+        HistoricalFriendRequest.objects.create(from_user=alice, to_user=carol, status="pending")
+        HistoricalMessage.objects.create(sender=alice, receiver=bob, content="first")
+        last = HistoricalMessage.objects.create(sender=bob, receiver=alice, content="second")
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.migrate_to)
+        Historical = executor.loader.project_state(self.migrate_to).apps.get_model("api", "Conversation")
+
+        conversation = Historical.objects.get()
+        self.assertEqual((conversation.user_low_id, conversation.user_high_id), (alice.id, bob.id))
+        self.assertEqual(conversation.last_message_id, last.id)
+        self.assertEqual(conversation.last_message_at, last.timestamp)
+        self.assertTrue(conversation.low_has_unread)
+        self.assertFalse(conversation.high_has_unread)
+
+
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        reset_caches()
+        # Same timestamp throughout, so only the id tiebreak orders them
+        timestamp = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        self.messages = [
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=str(i), timestamp=timestamp)
+            for i in range(5)
+        ]
+        self.client = authed_client(self.alice)
+        self.url = f"/api/messages/{self.bob.id}/"
+
+    def contents(self, response):
+        return [message["content"] for message in response.data["results"]]
+
+    def test_before_walks_back_without_gaps_or_repeats(self):
+        response = self.client.get(self.url, {"page_size": 2})
+        seen = self.contents(response)
+        self.assertIsNone(response.data["previous"])
+        while response.data["next"]:
+            response = self.client.get(response.data["next"])
+            self.assertIsNotNone(response.data["previous"])
+            seen += self.contents(response)
+        self.assertEqual(seen, ["4", "3", "2", "1", "0"])
+
+    def test_after_returns_newer_messages_oldest_first(self):
+        cursor = encode_cursor(self.messages[1].timestamp, self.messages[1].id)
+        response = self.client.get(self.url, {"after": cursor, "page_size": 2})
+        self.assertEqual(self.contents(response), ["3", "2"])
+        self.assertIsNotNone(response.data["previous"])
+
+        response = self.client.get(response.data["previous"])
+        self.assertEqual(self.contents(response), ["4"])
+        self.assertIsNone(response.data["previous"])
+
+    @override_settings(MESSAGE_MAX_PAGE_SIZE=3)
+    def test_page_size_is_clamped(self):
+        self.assertEqual(len(self.client.get(self.url, {"page_size": 100}).data["results"]), 3)
+        self.assertEqual(len(self.client.get(self.url, {"page_size": 0}).data["results"]), 1)
+        self.assertEqual(len(self.client.get(self.url, {"page_size": "many"}).data["results"]), 3)
+
+    def test_invalid_cursor_is_not_found(self):
+        for cursor in ("not-a-cursor", encode_cursor(self.messages[0].timestamp, 1)[:-4] + "!!!!"):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get(self.url, {"before": cursor}).status_code, 404)
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        Profile.objects.create(user=self.alice, first_name="Alice", last_name="A")
+        reset_caches()
+        self.tracker = presence.PresenceTracker(presence.LocalPresenceBackend())
+
+    def test_user_stays_online_until_last_tab_closes(self):
+        self.assertTrue(self.tracker.connect(self.alice.id, "tab-1"))
+        self.assertFalse(self.tracker.connect(self.alice.id, "tab-2"))
+        self.assertEqual(self.tracker.writer.flush(), 1)
+        self.assertTrue(Profile.objects.get(user=self.alice).is_online)
+
+        self.assertFalse(self.tracker.disconnect(self.alice.id, "tab-1"))
+        self.assertTrue(self.tracker.is_online(self.alice.id))
+        self.assertTrue(self.tracker.disconnect(self.alice.id, "tab-2"))
+        self.assertFalse(self.tracker.is_online(self.alice.id))
+
+        self.assertEqual(self.tracker.writer.flush(), 1)
+        self.assertFalse(Profile.objects.get(user=self.alice).is_online)
+
+    @override_settings(PRESENCE_REDIS_URL=None)
+    def test_pending_last_seen_is_flushed_at_exit(self):
+        with mock.patch.object(presence, "_tracker", None), mock.patch("api.presence.atexit.register") as register:
+            tracker = presence.get_tracker()
+            tracker.connect(self.alice.id, "tab-1")
+
+            register.assert_called_once_with(tracker.writer.flush)
+            # What the interpreter runs on shutdown
+            register.call_args.args[0]()
+        self.assertTrue(Profile.objects.get(user=self.alice).is_online)
+
+    def test_connection_that_stops_refreshing_expires(self):
+        with override_settings(PRESENCE_TTL=-1):
+            self.tracker.connect(self.alice.id, "tab-1")
+        self.assertFalse(self.tracker.is_online(self.alice.id))
+        self.assertEqual(self.tracker.sweep(), [self.alice.id])
+        self.assertEqual(self.tracker.sweep(), [])
+
+    def test_heartbeat_keeps_local_connections_alive(self):
+        with override_settings(PRESENCE_TTL=-1):
+            self.tracker.connect(self.alice.id, "tab-1")
+        self.tracker.heartbeat()
+
+        self.assertTrue(self.tracker.is_online(self.alice.id))
+        self.assertEqual(self.tracker.sweep(), [])
+
+
+class BroadcastTests(TestCase):
+    def test_every_group_gets_the_message_once(self):
+        layer = InMemoryChannelLayer()
+
+        async def run():
+            channels = [await layer.new_channel() for _ in range(2)]
+            for user_id, channel in enumerate(channels):
+                await layer.group_add(broadcast.user_group(user_id), channel)
+            await broadcast.group_send_many(["user_0", "user_1", "user_0"], {"type": "ping"}, layer)
+            received = [await layer.receive(channel) for channel in channels]
+            for channel in channels:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(layer.receive(channel), 0.05)
+            return received
+
+        self.assertEqual(async_to_sync(run)(), [{"type": "ping"}, {"type": "ping"}])
+
+    @override_settings(BROADCAST_CONCURRENCY=2)
+    def test_sends_overlap_up_to_the_limit(self):
+        class SlowLayer:
+            def __init__(self):
+                self.in_flight = self.peak = 0
+                self.sent = []
+
+            async def group_send(self, group, message):
+                self.in_flight += 1
+                self.peak = max(self.peak, self.in_flight)
+                await asyncio.sleep(0.01)
+                self.sent.append(group)
+                self.in_flight -= 1
+
+        layer = SlowLayer()
+        async_to_sync(broadcast.group_send_many)([f"user_{i}" for i in range(6)], {"type": "ping"}, layer)
+
+        self.assertEqual(sorted(layer.sent), [f"user_{i}" for i in range(6)])
+        self.assertEqual(layer.peak, 2)
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        reset_caches()
+        self.writer = write_behind.MessageWriteBehind(batch_size=10, interval=60, max_queue=2)
+
+    def test_bad_row_is_dropped_without_losing_the_batch(self):
+        existing = Message.objects.create(sender=self.alice, receiver=self.bob, content="already here")
+        good = self.writer.build(self.alice.id, self.bob.id, "good")
+        bad = self.writer.build(self.alice.id, self.bob.id, None)
+        collided = self.writer.build(self.bob.id, self.alice.id, "collided")
+        collided.id = existing.id
+        flushed = metrics.WRITE_BEHIND_ROWS.labels(result="flushed").value
+        failed = metrics.WRITE_BEHIND_ROWS.labels(result="failed").value
+
+        with self.assertLogs("api.write_behind", "ERROR"):
+            written = self.writer.write([good, bad, collided])
+
+        self.assertEqual(written, [good, collided])
+        self.assertNotEqual(collided.id, existing.id)
+        self.assertEqual(set(Message.objects.values_list("content", flat=True)), {"already here", "good", "collided"})
+        self.assertEqual(self.writer.stats["failed"], 1)
+        self.assertEqual(metrics.WRITE_BEHIND_ROWS.labels(result="flushed").value - flushed, 2)
+        self.assertEqual(metrics.WRITE_BEHIND_ROWS.labels(result="failed").value - failed, 1)
+        conversation = Conversation.objects.find_pair(self.alice.id, self.bob.id)
+        self.assertEqual(conversation.unread_count_for(self.bob.id), 1)
+        self.assertEqual(conversation.unread_count_for(self.alice.id), 1)
+
+    def test_full_queue_flushes_and_drain_writes_the_rest(self):
+        async def submit(count):
+            for i in range(count):
+                await self.writer.submit(self.writer.build(self.alice.id, self.bob.id, str(i)))
+            self.writer._flusher.cancel()
+
+        full = metrics.WRITE_BEHIND_FULL.labels().value
+        async_to_sync(submit)(3)
+        # The third submit found the queue full and wrote the first two
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(self.writer.depth, 1)
+        self.assertEqual(metrics.WRITE_BEHIND_FULL.labels().value - full, 1)
+        self.assertEqual(metrics.WRITE_BEHIND_DEPTH.labels().value, 1)
+
+        self.writer.drain()
+        self.assertEqual(self.writer.depth, 0)
+        self.assertEqual(metrics.WRITE_BEHIND_DEPTH.labels().value, 0)
+        self.assertIn("chat_write_behind_queue_depth 0", metrics.render())
+        self.assertEqual(sorted(Message.objects.values_list("content", flat=True)), ["0", "1", "2"])
+        self.assertEqual(Conversation.objects.get().unread_count_for(self.bob.id), 3)
+
+
+class AuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", password="pw")
+        reset_caches()
+
+    def authenticate(self, authentication, token):
+        request = APIRequestFactory().get("/api/friends/", HTTP_AUTHORIZATION=f"Bearer {token}")
+        return authentication.authenticate(request)[0]
+
+    def test_claims_user_needs_no_query(self):
+        token = ChatTokenObtainPairSerializer.get_token(self.user).access_token
+        with self.assertNumQueries(0):
+            user = self.authenticate(ClaimsJWTAuthentication(), token)
+            self.assertEqual((user.id, user.username), (self.user.id, "alice"))
+
+    def test_token_without_username_falls_back_to_cached_row(self):
+        token = AccessToken.for_user(self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(ClaimsJWTAuthentication(), token).username, "alice")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(ClaimsJWTAuthentication(), token).username, "alice")
+
+    def test_cached_user_sees_deactivation(self):
+        token = ChatTokenObtainPairSerializer.get_token(self.user).access_token
+        self.assertEqual(self.authenticate(CachedJWTAuthentication(), token), self.user)
+
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(CachedJWTAuthentication(), token)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+)
+class SocketAuthenticationTests(TransactionTestCase):
+    def connect(self, query_string):
+        async def run():
+            communicator = WebsocketCommunicator(JWTAuthMiddleware(FriendConsumer.as_asgi()), f"/ws/friends/?{query_string}")
+            connected, code = await communicator.connect()
+            first = await communicator.receive_json_from() if connected else None
+            await communicator.disconnect()
+            return connected, code, first
+
+        return async_to_sync(run)()
+
+    def test_invalid_token_is_closed_with_4001(self):
+        for query_string in ("", "token=not-a-jwt"):
+            with self.subTest(query_string=query_string):
+                self.assertEqual(self.connect(query_string)[:2], (False, 4001))
+
+    def test_valid_token_connects_as_its_user(self):
+        user = User.objects.create_user(username="alice", password="pw")
+        Profile.objects.create(user=user, first_name="Alice", last_name="A")
+        token = ChatTokenObtainPairSerializer.get_token(user).access_token
+
+        with self.assertLogs("api", "INFO"):
+            connected, _, first = self.connect(f"token={token}")
+
+        self.assertTrue(connected)
+        self.assertEqual(first["event"], "bootstrap")
+        self.assertEqual(first["profile"]["user_id"], user.id)
+
+    def test_disconnect_after_a_failed_connect(self):
+        user = User.objects.create_user(username="alice", password="pw")
+        tracker = mock.Mock()
+
+        async def run(scope_user):
+            consumer = FriendConsumer()
+            consumer.scope = {"type": "websocket", "user": scope_user}
+            consumer.channel_layer = get_channel_layer()
+            consumer.channel_name = await consumer.channel_layer.new_channel()
+            consumer.close = mock.AsyncMock()
+            with self.assertRaises(RuntimeError) if scope_user else nullcontext():
+                await consumer.connect()
+            await consumer.disconnect(1006)
+
+        with mock.patch("api.consumers.rooms.get_room_ids", side_effect=RuntimeError), \
+                mock.patch("api.consumers.presence.get_tracker", return_value=tracker):
+            async_to_sync(run)(None)
+            with self.assertLogs("api", "INFO"):
+                async_to_sync(run)(user)
+
+        # Never announced, so there is no socket to take out of presence
+        tracker.disconnect.assert_not_called()
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+)
+class EventTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        reset_caches()
+
+    def test_message_data_matches_the_serializer(self):
+        message = Message.objects.create(sender=self.alice, receiver=self.bob, content="héllo ✓")
+        self.assertEqual(events.message_data(message), dict(MessageSerializer(message).data))
+
+        layer_message = events.new_message(events.message_data(message))
+        self.assertEqual(layer_message["type"], "chat_message")
+        self.assertIn("héllo ✓", layer_message["text"])
+        self.assertEqual(json.loads(layer_message["text"]), {
+            "event": "new_message", "message": dict(MessageSerializer(message).data),
+        })
+
+    def test_consumer_forwards_the_encoded_text(self):
+        layer_message = events.typing_indicator(self.bob.id, "bob", True)
+
+        async def run():
+            communicator = WebsocketCommunicator(FriendConsumer.as_asgi(), "/ws/friends/")
+            communicator.scope["user"] = self.alice
+            await communicator.connect()
+            # The bootstrap snapshot
+            await communicator.receive_from()
+            await get_channel_layer().group_send(broadcast.user_group(self.alice.id), layer_message)
+            received = await communicator.receive_from()
+            await communicator.disconnect()
+            return received
+
+        with self.assertLogs("api", "INFO"):
+            self.assertEqual(async_to_sync(run)(), layer_message["text"])
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+)
+class SendMessageTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        self.carol = User.objects.create_user(username="carol", password="pw")
+        FriendRequest.objects.create(from_user=self.alice, to_user=self.bob, status="accepted")
+        reset_caches()
+
+    def send(self, *frames):
+        async def run():
+            communicator = WebsocketCommunicator(FriendConsumer.as_asgi(), "/ws/friends/")
+            communicator.scope["user"] = self.alice
+            await communicator.connect()
+            # The bootstrap snapshot
+            await communicator.receive_from()
+            replies = []
+            for frame in frames:
+                await communicator.send_json_to(frame)
+                replies.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return replies
+
+        with self.assertLogs("api", "INFO"):
+            return async_to_sync(run)()
+
+    def test_both_paths_accept_only_friends(self):
+        for write_behind_enabled in (False, True):
+            with self.subTest(write_behind=write_behind_enabled), override_settings(MESSAGE_WRITE_BEHIND=write_behind_enabled):
+                replies = self.send(
+                    {"event": "send_message", "receiver_id": self.carol.id, "content": "stranger"},
+                    {"event": "send_message", "receiver_id": 999999, "content": "nobody"},
+                    {"event": "send_message", "receiver_id": "bob", "content": "not an id"},
+                    {"event": "send_message", "receiver_id": self.bob.id, "content": "friend"},
+                )
+
+                self.assertEqual([reply.get("error") for reply in replies[:3]], [
+                    "You can only message friends", "You can only message friends", "Invalid receiver",
+                ])
+                self.assertEqual(replies[3]["event"], "new_message")
+                self.assertEqual(replies[3]["message"]["receiver"], self.bob.id)
+        write_behind.get_writer().drain()
+        self.assertEqual(list(Message.objects.values_list("receiver_id", flat=True)), [self.bob.id] * 2)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.me = self.make_user("me", "Ann", "Searcher")
+        reset_caches()
+
+    def make_user(self, username, first_name, last_name):
+        user = User.objects.create_user(username=username, password="pw")
+        Profile.objects.create(user=user, first_name=first_name, last_name=last_name)
+        return user
+
+    def test_exact_then_first_name_then_last_name_matches(self):
+        self.make_user("surname", "Zed", "Annable")
+        self.make_user("prefix", "Annabel", "Lee")
+        self.make_user("exact", "Ann", "")
+        self.make_user("other", "Bob", "Smith")
+
+        ranked = Profile.objects.search("  ÁNN ").values_list("user__username", flat=True)
+        self.assertEqual(list(ranked), ["exact", "me", "prefix", "surname"])
+        self.assertFalse(Profile.objects.search("   ").exists())
+
+    def test_search_skips_self_friends_and_pending_requests(self):
+        friend = self.make_user("friend", "Anna", "Friend")
+        requested = self.make_user("requested", "Anna", "Requested")
+        requester = self.make_user("requester", "Anna", "Requester")
+        rejected = self.make_user("rejected", "Anna", "Rejected")
+        stranger = self.make_user("stranger", "Anna", "Stranger")
+        FriendRequest.objects.create(from_user=self.me, to_user=friend, status="accepted")
+        FriendRequest.objects.create(from_user=self.me, to_user=requested)
+        FriendRequest.objects.create(from_user=requester, to_user=self.me)
+        FriendRequest.objects.create(from_user=rejected, to_user=self.me, status="rejected")
+
+        response = authed_client(self.me).get("/api/users/search/", {"q": "ann"})
+        self.assertEqual({profile["user_id"] for profile in response.data["results"]}, {rejected.id, stranger.id})
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+)
+class MarkReadTests(TestCase):
+    def setUp(self):
+        # The reader sits on the high side of one conversation and the low side of the other
+        self.low = User.objects.create_user(username="low", password="pw")
+        self.reader = User.objects.create_user(username="reader", password="pw")
+        self.high = User.objects.create_user(username="high", password="pw")
+        reset_caches()
+        self.from_low = [self.send(self.low, self.reader, str(i)) for i in range(3)]
+        self.from_high = [self.send(self.high, self.reader, str(i)) for i in range(2)]
+
+    def send(self, sender, receiver, content):
+        message = Message.objects.create(sender=sender, receiver=receiver, content=content)
+        Conversation.objects.record_message(message)
+        return message
+
+    def unread(self, other):
+        return Conversation.objects.find_pair(self.reader.id, other.id).unread_count_for(self.reader.id)
+
+    def test_both_sides_are_updated_in_one_query(self):
+        with self.assertNumQueries(1):
+            updated = Conversation.objects.mark_read(self.reader.id, {
+                self.low.id: self.from_low[1].id, self.high.id: None, self.reader.id: None,
+            })
+
+        self.assertEqual(updated, 2)
+        self.assertEqual(self.unread(self.low), 1)
+        self.assertEqual(self.unread(self.high), 0)
+        conversation = Conversation.objects.find_pair(self.reader.id, self.high.id)
+        self.assertEqual(conversation.last_read_id_for(self.reader.id), self.from_high[-1].id)
+        self.assertEqual(conversation.unread_count_for(self.high.id), 0)
+
+    def test_watermark_never_moves_backwards(self):
+        Conversation.objects.mark_read(self.reader.id, {self.low.id: self.from_low[1].id})
+
+        self.assertEqual(Conversation.objects.mark_read(self.reader.id, {self.low.id: self.from_low[0].id}), 0)
+        conversation = Conversation.objects.find_pair(self.reader.id, self.low.id)
+        self.assertEqual(conversation.last_read_id_for(self.reader.id), self.from_low[1].id)
+        self.assertEqual(conversation.unread_count_for(self.reader.id), 1)
+        # Nothing left to do once everything is read
+        self.assertEqual(Conversation.objects.mark_read(self.reader.id, {self.low.id: None}), 1)
+        self.assertEqual(Conversation.objects.mark_read(self.reader.id, {self.low.id: None}), 0)
+
+    def test_endpoint_accepts_a_list_of_markers(self):
+        response = authed_client(self.reader).post("/api/messages/read/", [
+            {"friend_id": self.low.id}, {"friend_id": self.high.id, "message_id": self.from_high[0].id},
+        ], format="json")
+
+        self.assertEqual(response.data, {"updated": 2})
+        self.assertEqual((self.unread(self.low), self.unread(self.high)), (0, 1))
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        Profile.objects.create(user=self.alice, first_name="Alice", last_name="A")
+        Profile.objects.create(user=self.bob, first_name="Bob", last_name="B")
+        reset_caches()
+        self.start = datetime.now(dt_timezone.utc) - timedelta(hours=1)
+        self.messages = []
+        for minute in range(3):
+            message = Message.objects.create(
+                sender=self.bob, receiver=self.alice, content=str(minute),
+                timestamp=self.start + timedelta(minutes=minute + 1),
+            )
+            Conversation.objects.record_message(message)
+            self.messages.append(message)
+        self.request = FriendRequest.objects.create(from_user=self.bob, to_user=self.alice, status="accepted")
+
+    def test_first_call_only_returns_a_cursor(self):
+        data = sync.delta(self.alice.id)
+        self.assertEqual((data["messages"], data["conversations"], data["friend_requests"]), ([], [], []))
+        self.assertLess(decode_cursor(data["cursor"])[0], datetime.now(dt_timezone.utc))
+
+    @override_settings(SYNC_MAX_MESSAGES=2)
+    def test_delta_walks_messages_in_pages(self):
+        first = sync.delta(self.alice.id, encode_cursor(self.start, 0))
+        self.assertTrue(first["has_more"])
+        self.assertEqual([message["content"] for message in first["messages"]], ["0", "1"])
+        self.assertEqual(first["conversations"], [{
+            "friend_id": self.bob.id, "unread_count": 3, "last_read_id": 0,
+            "friend_last_read_id": 0, "last_message_id": self.messages[-1].id,
+        }])
+        self.assertEqual([request["id"] for request in first["friend_requests"]], [self.request.id])
+
+        second = sync.delta(self.alice.id, first["cursor"])
+        self.assertFalse(second["has_more"])
+        self.assertEqual([message["content"] for message in second["messages"]], ["2"])
+
+        # Nothing new: the next cursor returns no messages
+        self.assertEqual(sync.delta(self.alice.id, second["cursor"])["messages"], [])
+
+    def test_endpoint_rejects_a_malformed_cursor(self):
+        client = authed_client(self.alice)
+        self.assertEqual(client.get("/api/sync/", {"since": "garbage"}).status_code, 400)
+        self.assertEqual(len(client.get("/api/sync/", {"since": encode_cursor(self.start, 0)}).data["messages"]), 3)
+
+
+@override_settings(TYPING_RESEND_INTERVAL=3, TYPING_TIMEOUT=8)
+class TypingCoalescerTests(TestCase):
+    def setUp(self):
+        self.coalescer = typing_indicators.TypingCoalescer()
+
+    def test_only_state_changes_and_resends_are_forwarded(self):
+        forwarded = [
+            self.coalescer.update(1, 2, "alice", is_typing, now)
+            for is_typing, now in [(True, 100), (True, 101), (True, 102.9), (True, 103), (False, 104), (False, 105)]
+        ]
+        self.assertEqual(forwarded, [True, False, False, True, True, False])
+        self.assertEqual(self.coalescer.stats, {"received": 6, "forwarded": 3, "suppressed": 3, "expired": 0})
+
+    def test_outcomes_are_exported(self):
+        def exported():
+            return {outcome: metrics.TYPING_EVENTS.labels(outcome=outcome).value
+                    for outcome in ("received", "forwarded", "suppressed", "expired")}
+
+        before = exported()
+        # A clock starting at 0 is a real time, not a missing one
+        self.coalescer.update(1, 2, "alice", True, 0)
+        self.coalescer.update(1, 2, "alice", True, 1)
+        self.assertEqual(self.coalescer.expire(9), [(1, 2, "alice")])
+
+        after = exported()
+        self.assertEqual({outcome: after[outcome] - before[outcome] for outcome in after},
+                         {"received": 2, "forwarded": 1, "suppressed": 1, "expired": 1})
+        self.assertIn('chat_typing_events_total{outcome="suppressed"}', metrics.render())
+
+    def test_quiet_sender_expires(self):
+        self.coalescer.update(1, 2, "alice", True, 100)
+        self.coalescer.update(1, 2, "alice", True, 101)
+        self.coalescer.update(3, 2, "carol", True, 104)
+
+        self.assertEqual(self.coalescer.expire(108.9), [])
+        self.assertEqual(self.coalescer.expire(109), [(1, 2, "alice")])
+        # Expired, so the next keystroke is forwarded again
+        self.assertTrue(self.coalescer.update(1, 2, "alice", True, 110))
+
+    def test_stop_sender_clears_every_receiver(self):
+        for receiver_id in (2, 3):
+            self.coalescer.update(1, receiver_id, "alice", True, 100)
+        self.coalescer.update(4, 2, "dave", True, 100)
+
+        self.assertEqual(sorted(self.coalescer.stop_sender(1)), [2, 3])
+        self.assertEqual(self.coalescer.stop_sender(1), [])
+        self.assertFalse(self.coalescer.update(1, 2, "alice", False, 101))
+        self.assertTrue(self.coalescer.update(4, 2, "dave", False, 101))
+
+
+class QueryPlanTests(TestCase):
+    """
+    Runs EXPLAIN on the hot queries and checks they are served by the
+    composite indexes. Works on SQLite and PostgreSQL.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username="alice", password="pw")
+        cls.bob = User.objects.create_user(username="bob", password="pw")
+        cls.carol = User.objects.create_user(username="carol", password="pw")
+        FriendRequest.objects.create(from_user=cls.alice, to_user=cls.bob, status="accepted")
+        FriendRequest.objects.create(from_user=cls.carol, to_user=cls.alice)
+        Message.objects.bulk_create([
+            Message(sender=cls.alice, receiver=cls.bob, content=str(i)) for i in range(20)
+        ] + [
+            Message(sender=cls.bob, receiver=cls.alice, content=str(i)) for i in range(20)
+        ])
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            # The test tables are tiny, so make the planner prove it can use the index
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_conversation_history_uses_pair_index(self):
+        queryset = Message.objects.filter(
+            (Q(sender=self.alice) & Q(receiver=self.bob)) |
+            (Q(sender=self.bob) & Q(receiver=self.alice))
+        ).order_by("-timestamp", "-id")[:50]
+        self.assertUsesIndex(queryset, "message_pair_recent_idx")
+
+    def test_single_direction_uses_pair_index(self):
+        queryset = Message.objects.filter(sender=self.alice, receiver=self.bob).order_by("-timestamp")
+        self.assertUsesIndex(queryset, "message_pair_recent_idx")
+
+    def test_outgoing_requests_use_from_status_index(self):
+        queryset = FriendRequest.objects.filter(from_user=self.alice, status="pending")
+        self.assertUsesIndex(queryset, "friendrequest_from_status_idx")
+
+    def test_incoming_requests_use_to_status_index(self):
+        queryset = FriendRequest.objects.filter(to_user=self.alice, status="pending")
+        self.assertUsesIndex(queryset, "friendrequest_to_status_idx")
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+    # Budgets are for rendering, not for serving a cached response
+    CONDITIONAL_GET=False,
+)
+class QueryBudgetTests(TestCase):
+    """
+    Runs every endpoint in api/urls.py against a small and a larger dataset
+    and fails if it goes over its query budget, or if the number of queries
+    grows with the data (an N+1). Budgets live in api/benchmarks.py.
+    """
+
+    sizes = (2, 25)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.datasets = [Dataset(size) for size in cls.sizes]
+
+    def setUp(self):
+        reset_caches()
+
+    def count_queries(self, endpoint, dataset):
+        client = authed_client(dataset.me)
+        # Warm the user and friendship caches as a running server would be
+        endpoint.request(client, dataset)
+        path, data = endpoint.prepare(dataset)
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, endpoint.method)(path, data, format="json")
+        self.assertLess(response.status_code, 300, f"{endpoint.name}: {response.status_code} {response.content[:200]!r}")
+        return [query["sql"] for query in queries.captured_queries]
+
+    def test_endpoints_stay_within_query_budget(self):
+        for endpoint in ENDPOINTS:
+            with self.subTest(endpoint=endpoint.name):
+                counts = {}
+                for dataset in self.datasets:
+                    queries = self.count_queries(endpoint, dataset)
+                    counts[dataset.size] = len(queries)
+                    self.assertLessEqual(
+                        len(queries), endpoint.budget,
+                        f"{endpoint.name} ran {len(queries)} queries with {dataset.size} rows "
+                        f"(budget {endpoint.budget}):\n" + "\n".join(queries)
+                    )
+                self.assertEqual(
+                    len(set(counts.values())), 1,
+                    f"{endpoint.name} query count grows with data: {counts}"
+                )
+
+
+class BootstrapTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.datasets = [Dataset(size) for size in (2, 25)]
+
+    def setUp(self):
+        reset_caches()
+
+    def test_snapshot_has_first_screen_in_fixed_queries(self):
+        counts = set()
+        for dataset in self.datasets:
+            with CaptureQueriesContext(connection) as queries:
+                data = bootstrap.snapshot(dataset.me.id)
+            counts.add(len(queries))
+
+            self.assertEqual(data["profile"]["user_id"], dataset.me.id)
+            self.assertEqual(len(data["friends"]), dataset.size)
+            self.assertTrue(all(friend["unread_count"] == 3 for friend in data["friends"]))
+            self.assertEqual({request["from_user"]["id"] for request in data["incoming"]},
+                             {user.id for user in dataset.requesters})
+            self.assertEqual({request["to_user"]["id"] for request in data["outgoing"]},
+                             {user.id for user in dataset.requested})
+        self.assertEqual(len(counts), 1, counts)
+        self.assertLessEqual(counts.pop(), 5)
+
+
+class BenchWsTests(TransactionTestCase):
+    """Runs the bench_ws harness at toy size so a protocol change can't leave it hanging."""
+
+    def test_friend_graph_shapes(self):
+        rng = random.Random(1)
+        ring = bench_ws.friend_graph(6, 2, "ring", rng)
+        self.assertEqual(ring, {(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (0, 5)})
+
+        star = bench_ws.friend_graph(6, 2, "star", rng)
+        self.assertTrue({(0, i) for i in range(1, 6)} <= star)
+        for shape in ("ring", "star", "random"):
+            edges = bench_ws.friend_graph(20, 4, shape, rng)
+            self.assertTrue(all(low < high < 20 for low, high in edges), shape)
+
+    def test_summary_and_comparison(self):
+        summary = bench_ws.summarize(100, 2, [i / 1000 for i in range(1, 101)])
+        self.assertEqual(summary["per_second"], 50)
+        self.assertEqual(summary["latency_ms"], {"p50": 50, "p95": 95, "p99": 99, "max": 100})
+
+        faster = {"workloads": {"typing": {**summary, "per_second": 100, "latency_ms": {"p50": 25, "p95": 95, "p99": 99}}}}
+        changes = bench_ws.Command().compare({"workloads": {"typing": summary}}, faster)
+        self.assertEqual(changes["typing"], {"per_second": 1.0, "p50_latency": 0.5, "p95_latency": 0.0, "p99_latency": 0.0})
+
+    def test_harness_completes_every_workload(self):
+        command = bench_ws.Command()
+        options = vars(command.create_parser("manage.py", "bench_ws").parse_args(
+            ["--clients", "6", "--friends", "2", "--messages", "1", "--keystrokes", "2", "--timeout", "5"]
+        ))
+        workloads = bench_ws.WORKLOADS
+
+        # The harness imports the ASGI app, whose django.setup() would
+        # reconfigure logging in the middle of assertLogs
+        import_module("backend.asgi")
+
+        async def run():
+            return await asyncio.wait_for(command.run(options, workloads), 30)
+
+        with bench_ws.bench_settings(options), self.assertLogs("api", "INFO"):
+            report = async_to_sync(run)()
+
+        self.assertEqual(set(report["workloads"]), set(workloads))
+        self.assertEqual(report["workloads"]["connect_storm"]["count"], 6)
+        self.assertEqual(report["workloads"]["send_message"]["lost"], 0)
+
+
+class DeliveryTests(TestCase):
+    def setUp(self):
+        buffer = mock.patch.object(delivery, "_buffer", delivery.LocalEventBuffer(size=3, ttl=60))
+        buffer.start()
+        self.addCleanup(buffer.stop)
+
+    def send(self, *user_ids):
+        return {
+            user_id: json.loads(message["text"])["seq"]
+            for user_id, message in delivery.sequence(user_ids, events.conversation_read([9])).items()
+        }
+
+    def missed_seqs(self, user_id, after=None):
+        head, texts = delivery.missed(user_id, after)
+        return head, None if texts is None else [json.loads(text)["seq"] for text in texts]
+
+    def test_each_user_gets_their_own_sequence(self):
+        self.assertEqual(self.send(1, 2, 1), {1: 1, 2: 1})
+        self.assertEqual(self.send(1), {1: 2})
+
+        message = delivery.sequence([2], events.conversation_read([9]))[2]
+        self.assertEqual(message["type"], "conversation_read")
+        self.assertEqual(json.loads(message["text"]), {"seq": 2, "event": "conversation_read", "friend_ids": [9]})
+
+    def test_missed_resumes_from_the_last_ack(self):
+        for _ in range(3):
+            self.send(1)
+        self.assertEqual(self.missed_seqs(1), (3, [1, 2, 3]))
+
+        delivery.get_buffer().ack(1, 2)
+        self.assertEqual(self.missed_seqs(1), (3, [3]))
+        # An ack past the head is clamped, not trusted
+        delivery.get_buffer().ack(1, 10)
+        self.assertEqual(delivery.missed(1), (3, []))
+
+    def test_idle_users_are_pruned(self):
+        buffer = delivery.LocalEventBuffer(size=3, ttl=60)
+        with mock.patch("api.delivery.time") as clock:
+            for now, user_id in ((100, 1), (130, 2), (150, 1)):
+                clock.time.return_value = now
+                buffer.append([user_id], '{"event":"x"}')
+
+            clock.time.return_value = 195
+            buffer.append([3], '{"event":"x"}')
+            # User 2 went idle at 190; user 1 was refreshed at 150
+            self.assertEqual(list(buffer._users), [1, 3])
+
+            clock.time.return_value = 400
+            self.assertEqual(buffer.since(4, None), (0, 0, []))
+            self.assertEqual(list(buffer._users), [4])
+
+    def test_gaps_the_buffer_cannot_fill_need_a_sync(self):
+        for _ in range(5):
+            self.send(1)
+        # Sequences 1 and 2 were trimmed
+        self.assertEqual(self.missed_seqs(1, 0), (5, None))
+        self.assertEqual(self.missed_seqs(1, 2), (5, [3, 4, 5]))
+        # A client ahead of the counters saw a buffer that has since been lost
+        self.assertEqual(self.missed_seqs(1, 8), (5, None))
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+    PRESENCE_REDIS_URL=None,
+)
+class ReplayTests(TransactionTestCase):
+    def test_replay_frame_fills_a_gap(self):
+        user = User.objects.create_user(username="gappy", password="pw")
+        sent = [
+            json.loads(delivery.sequence([user.id], events.online_status(user.id, "friend", online))[user.id]["text"])
+            for online in (True, False, True)
+        ]
+        seqs = [event["seq"] for event in sent]
+
+        async def run():
+            since = encode_cursor(datetime.now(dt_timezone.utc), 0)
+            communicator = WebsocketCommunicator(FriendConsumer.as_asgi(), f"/ws/friends/?seq={seqs[-1]}&since={since}")
+            communicator.scope["user"] = user
+            await communicator.connect()
+            # The client handled the first and last events; the middle one went missing
+            await communicator.send_to(text_data=json.dumps({"type": "replay", "seq": seqs[0]}))
+            replayed = [json.loads(await communicator.receive_from()) for _ in seqs[1:]]
+            await communicator.disconnect()
+            return replayed
+
+        with self.assertLogs("api", "INFO"):
+            replayed = async_to_sync(run)()
+        self.assertEqual(replayed, sent[1:])
+
+
+class MetricsTests(TestCase):
+    def test_scrape_renders_prometheus_text(self):
+        metrics.WS_EVENTS_RECEIVED.labels(type="ping").inc()
+        metrics.WS_HANDLER_SECONDS.labels(handler="receive").observe(0.003)
+
+        response = APIClient().get("/api/metrics/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        body = response.content.decode()
+        self.assertIn("# TYPE chat_ws_events_received_total counter", body)
+        self.assertRegex(body, r'chat_ws_events_received_total\{type="ping"\} [1-9]')
+        self.assertIn('chat_ws_handler_seconds_bucket{handler="receive",le="0.005"}', body)
+        self.assertIn('chat_ws_handler_seconds_bucket{handler="receive",le="+Inf"}', body)
+
+    @override_settings(METRICS_TOKEN="scrape-secret")
+    def test_scrape_requires_token_when_configured(self):
+        client = APIClient()
+        self.assertEqual(client.get("/api/metrics/").status_code, 401)
+        client.credentials(HTTP_AUTHORIZATION="Bearer scrape-secret")
+        self.assertEqual(client.get("/api/metrics/").status_code, 200)
+
+
+class SeedDataTests(TestCase):
+    def seed(self, prefix, **options):
+        options = {"users": 30, "friends": 3, "messages": 300, "days": 20, "until": "2025-06-01",
+                   "batch_size": 7, "workers": 1, "prefix": prefix, **options}
+        call_command("seed_data", stdout=io.StringIO(), **options)
+        return User.objects.filter(username__startswith=prefix)
+
+    def test_generates_a_consistent_dataset(self):
+        users = self.seed("seed")
+        user_ids = set(users.values_list("id", flat=True))
+        self.assertEqual(len(user_ids), 30)
+        self.assertEqual(Profile.objects.filter(user_id__in=user_ids).exclude(search_name="").count(), 30)
+
+        requests = list(FriendRequest.objects.filter(from_user_id__in=user_ids).values_list("from_user_id", "to_user_id", "status"))
+        pairs = [tuple(sorted((from_id, to_id))) for from_id, to_id, _ in requests]
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertTrue(all(low != high for low, high in pairs))
+        friends = {pair for pair, (_, _, status) in zip(pairs, requests) if status == "accepted"}
+
+        messages = Message.objects.filter(sender_id__in=user_ids).order_by("timestamp", "id")
+        self.assertGreater(messages.count(), 0)
+        self.assertLess(messages.aggregate(latest=Max("timestamp"))["latest"], datetime(2025, 6, 1, tzinfo=dt_timezone.utc))
+        self.assertTrue({tuple(sorted(pair)) for pair in messages.values_list("sender_id", "receiver_id")} <= friends)
+
+        for conversation in Conversation.objects.filter(user_low_id__in=user_ids):
+            with self.subTest(conversation=str(conversation)):
+                history = messages.filter(
+                    Q(sender_id=conversation.user_low_id, receiver_id=conversation.user_high_id) |
+                    Q(sender_id=conversation.user_high_id, receiver_id=conversation.user_low_id)
+                )
+                self.assertEqual(conversation.last_message_id, history.last().id)
+                for user_id in (conversation.user_low_id, conversation.user_high_id):
+                    unread = history.filter(receiver_id=user_id, id__gt=conversation.last_read_id_for(user_id))
+                    self.assertEqual(conversation.unread_count_for(user_id), unread.count())
+
+    def test_pool_workers_never_share_message_ids(self):
+        with seed_data.worker_pool(4) as pool:
+            results = pool.map(seed_worker_ids, [500] * 8)
+
+        base = ids.get_generator().worker_id
+        self.assertEqual({worker_id for worker_id, _ in results}, {base, base + 1, base + 2, base + 3})
+        generated = [message_id for _, message_ids in results for message_id in message_ids]
+        self.assertEqual(len(generated), len(set(generated)))
+
+    def test_workers_must_fit_the_worker_id_space(self):
+        with mock.patch.object(seed_data.connection, "vendor", "postgresql"), self.assertRaises(CommandError):
+            self.seed("seed", workers=seed_data.max_workers() + 1)
+
+    def test_same_seed_gives_the_same_data(self):
+        def shape(users):
+            index = {user_id: i for i, user_id in enumerate(users.order_by("username").values_list("id", flat=True))}
+            requests = FriendRequest.objects.filter(from_user_id__in=index)
+            return (
+                sorted((index[from_id], index[to_id], status) for from_id, to_id, status in
+                       requests.values_list("from_user_id", "to_user_id", "status")),
+                sorted(Message.objects.filter(sender_id__in=index).values_list("content", "timestamp")),
+            )
+
+        self.assertEqual(shape(self.seed("first")), shape(self.seed("second")))
+        with self.assertRaises(CommandError):
+            self.seed("first")
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="profiled", password="pw")
+        # Saving the user warms its friend ids; start the request cold
+        reset_caches()
+        self.client = authed_client(self.user)
+
+    @override_settings(DB_PROFILE_HEADERS=True)
+    def test_http_response_reports_queries(self):
+        response = self.client.get("/api/friends/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-DB-Queries"], "1")
+        self.assertIn("X-DB-Time-Ms", response)
+        self.assertTrue(response["Server-Timing"].startswith("db;dur="))
+
+    @override_settings(DB_PROFILE_MAX_QUERIES=1, DB_PROFILE_TRACE_SAMPLE_RATE=1)
+    def test_query_heavy_request_is_logged_with_trace(self):
+        with self.assertLogs("api.profiling", "WARNING") as logs:
+            self.client.get("/api/friends/")
+
+        record = logs.records[0]
+        self.assertEqual(record.getMessage(), "db.slow")
+        self.assertEqual(record.fields["route"], "friends-list")
+        self.assertEqual(record.fields["queries"], 1)
+        self.assertIn("api_friendrequest", record.fields["slowest"][0]["sql"])
+        self.assertEqual(len(record.fields["trace"]), 1)
+
+    def test_database_sync_to_async_counts_against_current_event(self):
+        @metrics.database_sync_to_async
+        def load():
+            return list(User.objects.filter(id=self.user.id))
+
+        async def handle():
+            with profiling.profile("ws.receive") as query_profile:
+                await load()
+                await load()
+            return query_profile
+
+        self.assertEqual(async_to_sync(handle)().count, 2)
+
+
+class ProfilePictureTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        storage = override_settings(
+            MEDIA_ROOT=media_root,
+            MEDIA_URL="/media/",
+            STORAGES={
+                "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+                "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+            },
+            IMAGE_PROCESSING_ASYNC=False,
+            PROFILE_THUMBNAIL_SIZES=[64, 128],
+        )
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+        self.user = User.objects.create_user(username="pictured", password="pw")
+        self.client = authed_client(self.user)
+
+    def upload(self):
+        # Tall photo with a camera tag and orientation 6 (rotate 90 degrees)
+        exif = Image.Exif()
+        exif[0x0110] = "Secret Camera"
+        exif[0x0112] = 6
+        buffer = io.BytesIO()
+        Image.new("RGB", (400, 300), (200, 30, 30)).save(buffer, "JPEG", exif=exif)
+        picture = SimpleUploadedFile("me.jpg", buffer.getvalue(), content_type="image/jpeg")
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                "/api/profile/", {"first_name": "Pic", "last_name": "Tured", "profile_picture": picture}, format="multipart"
+            )
+        self.assertEqual(response.status_code, 200, response.content)
+        return Profile.objects.get(user=self.user)
+
+    def test_upload_is_sanitized_and_thumbnailed(self):
+        profile = self.upload()
+
+        with default_storage.open(profile.profile_picture.name) as full:
+            image = Image.open(full)
+            self.assertEqual(image.size, (300, 400))
+            self.assertEqual(len(image.getexif()), 0)
+        self.assertEqual(set(profile.profile_picture_variants), {"64", "128"})
+        for size, formats in profile.profile_picture_variants.items():
+            self.assertEqual(set(formats), {"webp", "jpeg"})
+            for extension, path in formats.items():
+                with default_storage.open(path) as thumbnail:
+                    image = Image.open(thumbnail)
+                    self.assertEqual(image.size, (int(size), int(size)))
+                    self.assertEqual(image.format, extension.upper())
+
+        data = self.client.get("/api/profile/").json()
+        self.assertTrue(data["profile_picture_urls"]["64"]["webp"].startswith("/media/profile_pics/"))
+
+    def test_replacing_picture_removes_old_files(self):
+        old = self.upload()
+        old_paths = [old.profile_picture.name] + [
+            path for formats in old.profile_picture_variants.values() for path in formats.values()
+        ]
+
+        new = self.upload()
+
+        self.assertNotEqual(new.profile_picture.name, old.profile_picture.name)
+        for path in old_paths:
+            self.assertFalse(default_storage.exists(path), path)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+)
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        Profile.objects.create(user=self.alice, first_name="Alice", last_name="A")
+        Profile.objects.create(user=self.bob, first_name="Bob", last_name="B")
+        FriendRequest.objects.create(from_user=self.alice, to_user=self.bob, status="accepted")
+        reset_caches()
+        self.client = authed_client(self.alice)
+
+    def revalidate(self, path, tag):
+        return self.client.get(path, HTTP_IF_NONE_MATCH=tag)
+
+    def test_unchanged_resource_is_not_modified(self):
+        first = self.client.get("/api/friends/")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first["Cache-Control"], "private, no-cache")
+
+        with CaptureQueriesContext(connection) as queries:
+            again = self.revalidate("/api/friends/", first["ETag"])
+
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again["ETag"], first["ETag"])
+        self.assertEqual(len(queries), 0)
+
+    def test_friend_profile_change_changes_etag(self):
+        first = self.client.get("/api/friends/")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile = Profile.objects.get(user=self.bob)
+            profile.first_name = "Robert"
+            profile.save()
+
+        again = self.revalidate("/api/friends/", first["ETag"])
+        self.assertEqual(again.status_code, 200)
+        self.assertNotEqual(again["ETag"], first["ETag"])
+        self.assertEqual(again.json()[0]["first_name"], "Robert")
+
+    def test_message_changes_inbox_etag(self):
+        first = self.client.get("/api/has_new_message/")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(sender=self.bob, receiver=self.alice, content="hi")
+            Conversation.objects.record_message(message)
+
+        again = self.revalidate("/api/has_new_message/", first["ETag"])
+        self.assertEqual(again.status_code, 200)
+        self.assertNotEqual(again["ETag"], first["ETag"])
+
+    def test_friend_coming_online_changes_etag(self):
+        first = self.client.get("/api/friends/")
+
+        tracker = presence.get_tracker()
+        tracker.connect(self.bob.id, "conditional-get-test")
+        self.addCleanup(tracker.disconnect, self.bob.id, "conditional-get-test")
+
+        self.assertEqual(self.revalidate("/api/friends/", first["ETag"]).status_code, 200)
+
+    def test_only_going_offline_bumps_friends_versions(self):
+        writer = presence.LastSeenWriter()
+        before = versions.get_versions(self.alice.id, ["graph"])
+
+        writer.record(self.bob.id, True)
+        with self.captureOnCommitCallbacks(execute=True):
+            writer.flush()
+        self.assertEqual(versions.get_versions(self.alice.id, ["graph"]), before)
+
+        writer.record(self.bob.id, False)
+        with self.captureOnCommitCallbacks(execute=True):
+            writer.flush()
+        self.assertNotEqual(versions.get_versions(self.alice.id, ["graph"]), before)
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        reset_caches()
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root)
+        storage = override_settings(STORAGES={
+            "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+            "message_archive": {
+                "BACKEND": "django.core.files.storage.FileSystemStorage",
+                "OPTIONS": {"location": archive_root},
+            },
+        })
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+        self.alice = User.objects.create_user(username="alice", password="pw")
+        self.bob = User.objects.create_user(username="bob", password="pw")
+        self.carol = User.objects.create_user(username="carol", password="pw")
+        old = datetime(2025, 1, 10, tzinfo=dt_timezone.utc)
+        Message.objects.bulk_create(
+            [Message(sender=self.alice, receiver=self.bob, content=f"old {i}", timestamp=old + timedelta(hours=i)) for i in range(5)]
+            + [Message(sender=self.carol, receiver=self.alice, content="other pair", timestamp=old)]
+            + [Message(sender=self.bob, receiver=self.alice, content=f"new {i}") for i in range(3)]
+        )
+        self.client = authed_client(self.alice)
+
+    def test_archived_month_leaves_the_table(self):
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs("api.archive", "INFO"):
+            self.assertEqual(archive.archive_month(datetime(2025, 1, 1, tzinfo=dt_timezone.utc)), 6)
+
+        self.assertEqual(Message.objects.count(), 3)
+        segments = MessageArchive.objects.order_by("user_low_id")
+        self.assertEqual([segment.count for segment in segments], [5, 1])
+        self.assertEqual(len({segment.path for segment in segments}), 1)
+
+    def test_scrollback_continues_into_the_archive(self):
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs("api.archive", "INFO"):
+            archive.archive_month(datetime(2025, 1, 1, tzinfo=dt_timezone.utc))
+
+        contents, url = [], f"/api/messages/{self.bob.id}/?page_size=2"
+        while url:
+            page = self.client.get(url).json()
+            contents += [message["content"] for message in page["results"]]
+            url = page["next"]
+        self.assertEqual(contents, [f"new {i}" for i in (2, 1, 0)] + [f"old {i}" for i in (4, 3, 2, 1, 0)])
+
+        # And forward again from deep in the archive
+        cursor = encode_cursor(datetime(2025, 1, 10, 2, 30, tzinfo=dt_timezone.utc), 0)
+        page = self.client.get(f"/api/messages/{self.bob.id}/", {"after": cursor, "page_size": 3}).json()
+        self.assertEqual([message["content"] for message in page["results"]], ["new 0", "old 4", "old 3"])
+
+
+    def test_worker_sees_a_month_archived_elsewhere(self):
+        url = f"/api/messages/{self.bob.id}/?page_size=20"
+        self.assertEqual(len(self.client.get(url).json()["results"]), 8)
+
+        # archive_messages runs in its own process, so its commit hooks
+        # never reach this worker
+        with self.assertLogs("api.archive", "INFO"):
+            archive.archive_month(datetime(2025, 1, 1, tzinfo=dt_timezone.utc))
+
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(len(self.client.get(url).json()["results"]), 8)
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.datasets = [Dataset(size) for size in (2, 10)]
+
+    def setUp(self):
+        reset_caches()
+
+    def read(self, dataset):
+        response = authed_client(dataset.me).get("/api/export/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        with CaptureQueriesContext(connection) as queries:
+            body = b"".join(response.streaming_content)
+        lines = [json.loads(line) for line in gzip.decompress(body).decode().splitlines()]
+        return lines, len(queries)
+
+    def test_room_messages_sent_in_a_room_left_are_kept(self):
+        dataset = self.datasets[0]
+        message = rooms.record_message(dataset.room.id, dataset.me.id, "before leaving")
+        RoomMember.objects.filter(room=dataset.room, user=dataset.me).delete()
+
+        lines, _ = self.read(dataset)
+
+        self.assertFalse(any(line["type"] == "room_membership" for line in lines))
+        self.assertEqual([line["id"] for line in lines if line["type"] == "room_message"], [message.id])
+
+    def test_export_streams_whole_history_in_fixed_queries(self):
+        counts = set()
+        for dataset in self.datasets:
+            lines, count = self.read(dataset)
+            counts.add(count)
+
+            self.assertEqual(lines[0]["type"], "export")
+            self.assertEqual(lines[0]["user_id"], dataset.me.id)
+            self.assertEqual(sum(line["type"] == "friend_request" for line in lines), 3 * dataset.size)
+            messages = [line for line in lines if line["type"] == "message"]
+            self.assertEqual(len(messages), 6 * dataset.size)
+            self.assertEqual(messages, sorted(messages, key=lambda line: (line["timestamp"], line["id"])))
+            memberships = [line for line in lines if line["type"] == "room_membership"]
+            self.assertEqual([(line["room"], line["name"]) for line in memberships], [(dataset.room.id, dataset.room.name)])
+            room_messages = [line for line in lines if line["type"] == "room_message"]
+            self.assertEqual(len(room_messages), 3 * dataset.size)
+            self.assertEqual({line["room"] for line in room_messages}, {dataset.room.id})
+        self.assertEqual(len(counts), 1, counts)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    EVENT_BUFFER_REDIS_URL=None,
+)
+class RoomTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = Dataset(25)
+
+    def setUp(self):
+        reset_caches()
+        self.room = self.dataset.room
+
+    def test_message_is_one_group_send_for_every_member(self):
+        layer = get_channel_layer()
+        channels = [async_to_sync(layer.new_channel)() for _ in range(3)]
+        for channel in channels:
+            async_to_sync(layer.group_add)(rooms.room_group(self.room.id), channel)
+        sends = metrics.GROUP_SEND_SECONDS.labels(type="room_message")
+        before = sum(sends.counts)
+
+        response = authed_client(self.dataset.friend).post(
+            f"/api/rooms/{self.room.id}/messages/", {"content": "hi all"}, format="json"
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sum(sends.counts) - before, 1)
+        for channel in channels:
+            event = json.loads(async_to_sync(layer.receive)(channel)["text"])
+            self.assertEqual(event["event"], "room_message")
+            self.assertEqual(event["message"]["id"], response.data["id"])
+
+    def test_unread_count_follows_watermark(self):
+        client = authed_client(self.dataset.me)
+        [room] = client.get("/api/rooms/").data
+        self.assertEqual(room["unread_count"], 3 * self.dataset.size)
+
+        newest = self.room.messages.latest("id").id
+        self.assertEqual(client.post(f"/api/rooms/{self.room.id}/read/", {"message_id": newest}, format="json").data,
+                         {"updated": 1})
+        [room] = client.get("/api/rooms/").data
+        self.assertEqual((room["unread_count"], room["last_read_id"]), (0, newest))
+
+        # Watermarks never move backwards
+        self.assertEqual(client.post(f"/api/rooms/{self.room.id}/read/", {"message_id": 1}, format="json").data,
+                         {"updated": 0})
+
+    def test_history_is_paginated_and_members_only(self):
+        client = authed_client(self.dataset.me)
+        page = client.get(f"/api/rooms/{self.room.id}/messages/", {"page_size": 10}).data
+        self.assertEqual(len(page["results"]), 10)
+        self.assertIsNotNone(page["next"])
+        older = client.get(page["next"]).data
+        self.assertLess(older["results"][-1]["id"], page["results"][0]["id"])
+
+        stranger = authed_client(self.dataset.strangers[0])
+        self.assertEqual(stranger.get(f"/api/rooms/{self.room.id}/messages/").status_code, 404)
+
+    def test_rooms_are_made_with_friends_only(self):
+        client = authed_client(self.dataset.me)
+        response = client.post(
+            "/api/rooms/", {"name": "Nope", "member_ids": [self.dataset.strangers[0].id]}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+        friend_ids = [friend.id for friend in self.dataset.friends[:3]]
+        response = client.post("/api/rooms/", {"name": "Trio", "member_ids": friend_ids}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(rooms.get_member_ids(response.data["id"]), {self.dataset.me.id, *friend_ids})
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import threading
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import events, metrics
+from .broadcast import user_group
+from .log import log
+
+
+logger = logging.getLogger(__name__)
+
+
+class TypingCoalescer:
+    """
+    Collapses typing events per (sender, receiver) pair so only state
+    changes reach the channel layer.
+
+    A "typing" event is forwarded when the sender starts typing, and again
+    at most every TYPING_RESEND_INTERVAL seconds while they keep going so
+    the receiver's indicator doesn't go stale. "Stopped" is forwarded only
+    if "typing" was. A sender who goes quiet for TYPING_TIMEOUT seconds is
+    stopped by the sweeper, so a closed tab can't leave the dots on.
+    """
+
+    def __init__(self):
+        # (sender_id, receiver_id) -> [username, last_forwarded, last_seen]
+        self._typing = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.stats = {"received": 0, "forwarded": 0, "suppressed": 0, "expired": 0}
+
+    def update(self, sender_id, receiver_id, username, is_typing, now=None):
+        """Record a typing event. Returns True if it should be forwarded."""
+        if now is None:
+            now = time.monotonic()
+        key = (sender_id, receiver_id)
+        with self._lock:
+            self.stats["received"] += 1
+            state = self._typing.get(key)
+            if is_typing:
+                if state and now - state[1] < settings.TYPING_RESEND_INTERVAL:
+                    state[2] = now
+                    forward = False
+                else:
+                    self._typing[key] = [username, now, now]
+                    forward = True
+            else:
+                forward = self._typing.pop(key, None) is not None
+            self.stats["forwarded" if forward else "suppressed"] += 1
+        metrics.TYPING_EVENTS.labels(outcome="received").inc()
+        metrics.TYPING_EVENTS.labels(outcome="forwarded" if forward else "suppressed").inc()
+        return forward
+
+    def stop_sender(self, sender_id):
+        """Forget everyone sender_id was typing to; returns their ids."""
+        with self._lock:
+            keys = [key for key in self._typing if key[0] == sender_id]
+            for key in keys:
+                del self._typing[key]
+        return [receiver_id for _, receiver_id in keys]
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            expired = [
+                (key, state[0]) for key, state in self._typing.items()
+                if now - state[2] >= settings.TYPING_TIMEOUT
+            ]
+            for key, _ in expired:
+                del self._typing[key]
+            self.stats["expired"] += len(expired)
+        if expired:
+            metrics.TYPING_EVENTS.labels(outcome="expired").inc(len(expired))
+        return [(sender_id, receiver_id, username) for (sender_id, receiver_id), username in expired]
+
+    def ensure_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self.run_sweeper())
+
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(settings.TYPING_TIMEOUT / 2)
+            try:
+                channel_layer = get_channel_layer()
+                for sender_id, receiver_id, username in self.expire():
+                    await metrics.group_send(
+                        channel_layer, user_group(receiver_id), events.typing_indicator(sender_id, username, False)
+                    )
+            except Exception:
+                log(logger, logging.ERROR, "typing.sweep_failed", exc_info=True)
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+
+def get_coalescer():
+    global _coalescer
+    if _coalescer is None:
+        with _coalescer_lock:
+            if _coalescer is None:
+                _coalescer = TypingCoalescer()
+    return _coalescer
@@ -11,8 +11,15 @@ from .views import (
     FriendsListView,
     UserSearchView,
     FriendsListWithMessagesView,
-    ChangeNewMessageView,
-    ChangeNewMessageTrueView
+    MarkReadView,
+    SyncView,
+    MetricsView,
+    ExportView,
+    RoomListCreateView,
+    RoomDetailView,
+    RoomMembersView,
+    RoomMessageListCreateView,
+    RoomReadView,
 )
 
 urlpatterns = [
@@ -27,6 +34,14 @@ urlpatterns = [
     path("messages/<int:friend_id>/", MessageListView.as_view(), name="message-list"),
     path("messages/", MessageCreateView.as_view(), name="message-create"),
     path("has_new_message/", FriendsListWithMessagesView.as_view(), name="has-new-message"),
-    path('change_new_message/', ChangeNewMessageView.as_view(), name='change_new_message'),
-    path('change_new_message_true/', ChangeNewMessageTrueView.as_view(), name='change_new_message_true'),
+    path("messages/read/", MarkReadView.as_view(), name="mark-read"),
+    path("sync/", SyncView.as_view(), name="sync"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
+    path("export/", ExportView.as_view(), name="export"),
+    path("rooms/", RoomListCreateView.as_view(), name="rooms"),
+    path("rooms/<int:pk>/", RoomDetailView.as_view(), name="room-detail"),
+    path("rooms/<int:pk>/members/", RoomMembersView.as_view(), name="room-members"),
+    path("rooms/<int:pk>/members/<int:user_id>/", RoomMembersView.as_view(), name="room-member"),
+    path("rooms/<int:pk>/messages/", RoomMessageListCreateView.as_view(), name="room-messages"),
+    path("rooms/<int:pk>/read/", RoomReadView.as_view(), name="room-read"),
 ]
\ No newline at end of file
@@ -0,0 +1,149 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import friendships, presence
+from .models import FriendRequest
+
+
+VERSION_PREFIX = "version:"
+RESPONSE_PREFIX = "response:"
+
+# Scopes are versioned per user:
+#   profile  the user's own profile
+#   graph    friends and pending requests in either direction, with the
+#            other users' profiles
+#   inbox    the user's conversations: unread counts and read watermarks
+
+
+def get_cache():
+    return caches[settings.RESPONSE_CACHE_ALIAS]
+
+
+def new_token():
+    return uuid.uuid4().hex[:16]
+
+
+def get_versions(user_id, scopes):
+    """
+    The current version token of each scope for user_id. Tokens are random
+    rather than counters, so a version lost to eviction or a cache restart
+    comes back as a new value instead of repeating an old one.
+    """
+    cache = get_cache()
+    keys = [f"{VERSION_PREFIX}{scope}:{user_id}" for scope in scopes]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            # add() keeps whichever token a concurrent request stored first
+            cache.add(key, new_token(), None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump(scope, user_ids):
+    """Give scope a new version for each user, after the current transaction commits."""
+    user_ids = {int(user_id) for user_id in user_ids}
+    if not user_ids:
+        return
+    transaction.on_commit(
+        lambda: get_cache().set_many({f"{VERSION_PREFIX}{scope}:{user_id}": new_token() for user_id in user_ids}, None)
+    )
+
+
+def related_user_ids(user_ids):
+    """Everyone who sees these users' profiles: friends and pending requests either way."""
+    user_ids = {int(user_id) for user_id in user_ids}
+    related = set()
+    for user_id in user_ids:
+        related |= friendships.get_friend_ids(user_id)
+    for from_id, to_id in FriendRequest.objects.filter(
+        Q(from_user_id__in=user_ids) | Q(to_user_id__in=user_ids), status="pending"
+    ).values_list("from_user_id", "to_user_id"):
+        related.add(to_id if from_id in user_ids else from_id)
+    return related
+
+
+def profiles_changed(user_ids):
+    bump("profile", user_ids)
+    bump("graph", related_user_ids(user_ids))
+
+
+# Signal receivers, connected in apps.py
+
+def profile_saved(sender, instance, **kwargs):
+    profiles_changed([instance.user_id])
+
+
+def user_saved(sender, instance, **kwargs):
+    # The username is shown wherever the profile is
+    profiles_changed([instance.pk])
+
+
+def friend_request_changed(sender, instance, **kwargs):
+    bump("graph", [instance.from_user_id, instance.to_user_id])
+
+
+def conversations_changed(sender, user_ids, **kwargs):
+    bump("inbox", user_ids)
+
+
+def etag(user_id, tokens, members):
+    """
+    Weak ETag over the user, the scope versions and the online status of
+    every user in the body. Presence lives outside the database, so it is
+    folded in here rather than bumping versions on every connect.
+    """
+    online = presence.statuses(members)
+    digest = hashlib.blake2b(digest_size=12)
+    digest.update(f"{user_id}|{'|'.join(tokens)}|".encode())
+    digest.update(",".join(str(member) for member in sorted(members) if online.get(member)).encode())
+    return f'W/"{digest.hexdigest()}"'
+
+
+def conditional_response(request, name, scopes, members, render):
+    """
+    Serve a GET for one of the user's versioned resources. Returns 304 when
+    If-None-Match still matches, a cached body when one exists for the
+    current ETag, and otherwise calls render() (a DRF Response) and caches
+    what it returns. members(data) lists the user ids whose presence shows
+    up in the body.
+    """
+    if not settings.CONDITIONAL_GET:
+        return render()
+    user_id = request.user.id
+    cache = get_cache()
+    tokens = get_versions(user_id, scopes)
+    key = f"{RESPONSE_PREFIX}{name}:{user_id}:{'.'.join(tokens)}"
+
+    cached = cache.get(key)
+    if cached is not None:
+        tag = etag(user_id, tokens, cached["members"])
+        if tag in [value.strip() for value in request.headers.get("If-None-Match", "").split(",")]:
+            return headers(Response(status=status.HTTP_304_NOT_MODIFIED), tag)
+        if tag == cached["etag"]:
+            return headers(Response(cached["data"]), tag)
+
+    response = render()
+    if response.status_code != status.HTTP_200_OK:
+        return response
+    user_ids = members(response.data)
+    tag = etag(user_id, tokens, user_ids)
+    # Keyed by the versions read before rendering: if one moved meanwhile
+    # the next request looks under the new key and renders again.
+    cache.set(key, {"etag": tag, "members": user_ids, "data": response.data}, settings.RESPONSE_CACHE_TIMEOUT)
+    return headers(response, tag)
+
+
+def headers(response, tag):
+    response["ETag"] = tag
+    # Let browsers keep the body but always revalidate it
+    response["Cache-Control"] = "private, no-cache"
+    response["Vary"] = "Authorization"
+    return response
@@ -1,18 +1,26 @@
+import hmac
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.contrib.auth.models import User
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
-from .serializers import UserSerializer, ProfileSerializer, FriendRequestSerializer, MessageSerializer
-from .models import Profile, FriendRequest, Message
+from .serializers import UserSerializer, ProfileSerializer, FriendRequestSerializer, MessageSerializer, ReadMarkerSerializer
+from .serializers import RoomSerializer, RoomMemberSerializer, RoomMessageSerializer, RoomMembersSerializer, RoomReadSerializer
+from .models import Profile, FriendRequest, Message, Conversation, Room, RoomMember, RoomMessage
+from .pagination import MessageCursorPagination, SearchPagination
+from . import archive, bootstrap, events, export, friendships, metrics, rooms, sync, versions
+from .broadcast import notify_users
+from .authentication import ClaimsJWTAuthentication
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework.views import APIView
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from django.db.models import Value
-from django.db.models.functions import Concat
-from django.db.models import Q
-from datetime import datetime, timezone as dt_timezone
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from rest_framework.exceptions import NotFound
+from django.db import transaction
+from django.utils import timezone
 
 
 class CreateUserView(generics.CreateAPIView):
@@ -33,39 +41,25 @@ class TestAuthView(generics.GenericAPIView):
 
 
 
-class UserSearchView(APIView):
+class UserSearchView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
+    serializer_class = ProfileSerializer
+    pagination_class = SearchPagination
 
-    def get(self, request):
-        query = request.GET.get("q", "")
-        if not query:
-            return Response([], status=200)
-        
-        # Annotate full_name for searching
-        profiles = Profile.objects.annotate(
-            full_name=Concat('first_name', Value(' '), 'last_name')
-        ).filter(
-            full_name__icontains=query
-        ).exclude(user=request.user)  # exclude self
-
-        # Exclude users with pending or accepted friend requests
-        existing_requests = FriendRequest.objects.filter(
-            Q(from_user=request.user) | Q(to_user=request.user),
-            status__in=["pending", "accepted"]
-        )
-
-        # Collect the IDs of users who already have a request/are friends
-        excluded_user_ids = set()
-        for req in existing_requests:
-            if req.from_user == request.user:
-                excluded_user_ids.add(req.to_user.id)
-            else:
-                excluded_user_ids.add(req.from_user.id)
-
-        profiles = profiles.exclude(user__id__in=excluded_user_ids)
-
-        return Response(ProfileSerializer(profiles, many=True).data)
+    def get_queryset(self):
+        user_id = self.request.user.id
+        query = self.request.query_params.get("q", "")
 
+        # Friends and pending requests in either direction, as subqueries
+        related = FriendRequest.objects.filter(status__in=["pending", "accepted"])
+        return Profile.objects.search(query).exclude(
+            user_id=user_id  # exclude self
+        ).exclude(
+            user_id__in=related.filter(from_user_id=user_id).values("to_user_id")
+        ).exclude(
+            user_id__in=related.filter(to_user_id=user_id).values("from_user_id")
+        ).select_related("user")
 
 
 class ProfileView(generics.RetrieveUpdateAPIView):
@@ -77,8 +71,14 @@ class ProfileView(generics.RetrieveUpdateAPIView):
 
     def get_object(self):
         # returns the profile of the currently authenticated user
-        profile, created = Profile.objects.get_or_create(user=self.request.user)
+        profile, created = Profile.objects.select_related("user").get_or_create(user=self.request.user)
         return profile
+
+    def get(self, request, *args, **kwargs):
+        return versions.conditional_response(
+            request, "profile", ["profile"], lambda data: [data["user_id"]],
+            lambda: super(ProfileView, self).get(request, *args, **kwargs)
+        )
     
 
 # Send Friend Request
@@ -99,17 +99,19 @@ class SendFriendRequestView(generics.CreateAPIView):
         if FriendRequest.objects.filter(from_user=request.user, to_user=to_user, status="pending").exists():
             return Response({"error": "Friend request already sent"}, status=status.HTTP_400_BAD_REQUEST)
 
-        friend_request = FriendRequest.objects.create(from_user=request.user, to_user=to_user)
+        # A rejected request is kept so syncing clients see it go; sending
+        # again revives it.
+        friend_request = FriendRequest.objects.filter(from_user=request.user, to_user=to_user, status="rejected").first()
+        if friend_request:
+            friend_request.status = "pending"
+            friend_request.save()
+        else:
+            friend_request = FriendRequest.objects.create(from_user=request.user, to_user=to_user)
 
         # Send WebSocket notification to the recipient
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"user_{to_user.id}",
-            {
-                "type": "friend_request",
-                "from_user": request.user.username,
-                "request_id": friend_request.id
-            }
+        notify_users(
+            [to_user.id],
+            events.friend_request(request.user.username, friend_request.id)
         )
 
         return Response(FriendRequestSerializer(friend_request).data, status=status.HTTP_201_CREATED)
@@ -118,37 +120,25 @@ class SendFriendRequestView(generics.CreateAPIView):
 class AcceptFriendRequestView(generics.UpdateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = FriendRequestSerializer
-    queryset = FriendRequest.objects.all()
+    queryset = FriendRequest.objects.select_related("from_user__profile", "to_user__profile")
 
     def update(self, request, *args, **kwargs):
         friend_request = self.get_object()
-        if friend_request.to_user != request.user:
+        if friend_request.to_user_id != request.user.id:
             return Response({"error": "Not authorized"}, status=status.HTTP_403_FORBIDDEN)
+        # Rejected requests are kept, and an accept must only notify once
+        if friend_request.status != "pending":
+            return Response({"error": "Friend request is not pending"}, status=status.HTTP_400_BAD_REQUEST)
 
         friend_request.status = "accepted"
         friend_request.save()
 
         # Send WebSocket notification to both users
-        channel_layer = get_channel_layer()
-        # Notify the acceptor (to_user)
-        async_to_sync(channel_layer.group_send)(
-            f"user_{friend_request.to_user.id}",
-            {
-                "type": "friend_request_accepted",
-                "from_user": friend_request.from_user.username,
-                "to_user": friend_request.to_user.username,
-                "request_id": friend_request.id
-            }
-        )
-        # Notify the sender (from_user)
-        async_to_sync(channel_layer.group_send)(
-            f"user_{friend_request.from_user.id}",
-            {
-                "type": "friend_request_accepted",
-                "from_user": friend_request.from_user.username,
-                "to_user": friend_request.to_user.username,
-                "request_id": friend_request.id
-            }
+        notify_users(
+            [friend_request.to_user_id, friend_request.from_user_id],
+            events.friend_request_accepted(
+                friend_request.from_user.username, friend_request.to_user.username, friend_request.id
+            )
         )
 
         return Response(FriendRequestSerializer(friend_request).data, status=status.HTTP_200_OK)
@@ -158,272 +148,319 @@ class AcceptFriendRequestView(generics.UpdateAPIView):
 class RejectFriendRequestView(generics.DestroyAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = FriendRequestSerializer
-    queryset = FriendRequest.objects.all()
+    queryset = FriendRequest.objects.select_related("from_user__profile", "to_user__profile")
 
     def destroy(self, request, *args, **kwargs):
         friend_request = self.get_object()
-        if friend_request.to_user != request.user:
+        if friend_request.to_user_id != request.user.id:
             return Response({"error": "Not authorized"}, status=status.HTTP_403_FORBIDDEN)
+        if friend_request.status != "pending":
+            return Response({"error": "Friend request is not pending"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Kept as rejected rather than deleted so delta sync can report it
+        friend_request.status = "rejected"
+        friend_request.save()
+        return Response({"message": "Friend request rejected."}, status=status.HTTP_204_NO_CONTENT)
+
 
-        friend_request.delete()
-        return Response({"message": "Friend request rejected and deleted."}, status=status.HTTP_204_NO_CONTENT)
+# Users whose online status appears in a response, for its ETag
+def profile_members(data):
+    return [profile["user_id"] for profile in data]
+
+
+def request_members(data):
+    return [user_id for request in data for user_id in (request["from_user"]["id"], request["to_user"]["id"])]
 
 
 # List Incoming Requests
 class IncomingFriendRequestsView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
     serializer_class = FriendRequestSerializer
 
     def get_queryset(self):
-        return FriendRequest.objects.filter(to_user=self.request.user, status="pending")
+        return FriendRequest.objects.filter(to_user_id=self.request.user.id, status="pending").select_related(
+            "from_user__profile", "to_user__profile"
+        )
+
+    def get(self, request, *args, **kwargs):
+        return versions.conditional_response(
+            request, "friends-incoming", ["graph"], request_members,
+            lambda: super(IncomingFriendRequestsView, self).get(request, *args, **kwargs)
+        )
 
 
 # List Outgoing Requests
 class OutgoingFriendRequestsView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
     serializer_class = FriendRequestSerializer
 
     def get_queryset(self):
-        return FriendRequest.objects.filter(from_user=self.request.user, status="pending")
+        return FriendRequest.objects.filter(from_user_id=self.request.user.id, status="pending").select_related(
+            "from_user__profile", "to_user__profile"
+        )
+
+    def get(self, request, *args, **kwargs):
+        return versions.conditional_response(
+            request, "friends-outgoing", ["graph"], request_members,
+            lambda: super(OutgoingFriendRequestsView, self).get(request, *args, **kwargs)
+        )
 
 
 # List Friends (accepted requests)
 class FriendsListView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
     serializer_class = ProfileSerializer  # <-- use ProfileSerializer here
 
     def get_queryset(self):
-        # all users who accepted or sent accepted requests
-        sent = FriendRequest.objects.filter(
-            from_user=self.request.user, status="accepted"
-        ).values_list("to_user", flat=True)
-        received = FriendRequest.objects.filter(
-            to_user=self.request.user, status="accepted"
-        ).values_list("from_user", flat=True)
-        return Profile.objects.filter(user__id__in=list(sent) + list(received))
-    
+        friend_ids = friendships.get_friend_ids(self.request.user.id)
+        return Profile.objects.filter(user__id__in=friend_ids).select_related("user")
 
-class FriendsListWithMessagesView(generics.ListAPIView):
-    permission_classes = [IsAuthenticated]
-    serializer_class = ProfileSerializer
-    
-    def get_queryset(self):
-        user = self.request.user
-        
-        # Get all accepted friend requests
-        sent = FriendRequest.objects.filter(
-            from_user=user,
-            status="accepted"
-        ).select_related('to_user__profile')
-        
-        received = FriendRequest.objects.filter(
-            to_user=user,
-            status="accepted"
-        ).select_related('from_user__profile')
-        
-        # Build a list of friends with new message flags and last message time
-        friends_data = []
-        
-        # For requests we sent, check to_new_message
-        for req in sent:
-            friend_user = req.to_user
-            # Get most recent message between user and this friend (both directions)
-            last_message = Message.objects.filter(
-                Q(sender=user, receiver=friend_user) | Q(sender=friend_user, receiver=user)
-            ).order_by('-timestamp').first()
-            
-            friends_data.append({
-                'profile': friend_user.profile,
-                'has_new_message': req.to_new_message,
-                'last_message_time': last_message.timestamp if last_message else None
-            })
-        
-        # For requests we received, check from_new_message
-        for req in received:
-            friend_user = req.from_user
-            # Get most recent message between user and this friend (both directions)
-            last_message = Message.objects.filter(
-                Q(sender=user, receiver=friend_user) | Q(sender=friend_user, receiver=user)
-            ).order_by('-timestamp').first()
-            
-            friends_data.append({
-                'profile': friend_user.profile,
-                'has_new_message': req.from_new_message,
-                'last_message_time': last_message.timestamp if last_message else None
-            })
-        
-        # Sort by most recent message first (None values go to end)
-        from datetime import datetime
-        from django.utils import timezone
-        friends_data.sort(key=lambda x: x['last_message_time'] or datetime.min.replace(tzinfo=dt_timezone.utc), reverse=True)
-        
-        # Store in request for use in serializer
-        self.friends_data = friends_data
-        
-        # Return profiles in the sorted order
-        profile_ids = [fd['profile'].id for fd in friends_data]
-        
-        # Preserve the order using django's Case/When
-        from django.db.models import Case, When, IntegerField
-        
-        preserved_order = Case(
-            *[When(id=id, then=pos) for pos, id in enumerate(profile_ids)],
-            output_field=IntegerField()
+    def get(self, request, *args, **kwargs):
+        return versions.conditional_response(
+            request, "friends", ["graph"], profile_members,
+            lambda: super(FriendsListView, self).get(request, *args, **kwargs)
         )
-        
-        return Profile.objects.filter(id__in=profile_ids).order_by(preserved_order)
-    
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        
-        # Create a mapping of profile_id to has_new_message
-        message_map = {fd['profile'].id: fd['has_new_message'] 
-                      for fd in self.friends_data}
-        
-        serializer = self.get_serializer(queryset, many=True)
-        
-        # Add has_new_message to each serialized profile
-        response_data = []
-        for profile_data in serializer.data:
-            profile_id = profile_data['id']
-            response_data.append({
-                **profile_data,
-                'has_new_message': message_map.get(profile_id, False)
-            })
-        
-        return Response(response_data)
-    
 
-class ChangeNewMessageView(generics.GenericAPIView):
+
+class FriendsListWithMessagesView(generics.GenericAPIView):
+    """Friends with their unread state, most recent conversation first. See api/bootstrap.py."""
     permission_classes = [IsAuthenticated]
-    
+    authentication_classes = [ClaimsJWTAuthentication]
+
     def get(self, request, *args, **kwargs):
-        friend_id = request.query_params.get('friend_id')
-        
-        if not friend_id:
-            return Response({'error': 'friend_id is required'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        current_user = request.user
-        
-        # Find the FriendRequest between current user and friend
-        # Check both directions since either could have sent the request
-        friend_request = FriendRequest.objects.filter(
-            from_user=friend_id,
-            to_user=current_user,
-            status='accepted'
-        ).first()
-        
-        if friend_request:
-            # They sent the request, so mark from_new_message as False
-            friend_request.from_new_message = False
-            friend_request.save()
-        else:
-            # We sent the request, so mark to_new_message as False
-            friend_request = FriendRequest.objects.filter(
-                from_user=current_user,
-                to_user=friend_id,
-                status='accepted'
-            ).first()
-            
-            if friend_request:
-                friend_request.to_new_message = False
-                friend_request.save()
-            else:
-                return Response({'error': 'Friend request not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        return Response({'success': True}, status=status.HTTP_200_OK)
-    
-    
-class ChangeNewMessageTrueView(generics.GenericAPIView):
+        return versions.conditional_response(
+            request, "has-new-message", ["graph", "inbox"], profile_members,
+            lambda: Response(bootstrap.friends(request.user.id, self.get_serializer_context()))
+        )
+
+
+class MarkReadView(generics.GenericAPIView):
+    """
+    Advances the caller's read watermark. Accepts one marker
+    ({"friend_id", "message_id"}) or a list of them, applied in one UPDATE.
+    """
     permission_classes = [IsAuthenticated]
-    
+    authentication_classes = [ClaimsJWTAuthentication]
+    serializer_class = ReadMarkerSerializer
+
+    def post(self, request, *args, **kwargs):
+        many = isinstance(request.data, list)
+        serializer = self.get_serializer(data=request.data, many=many)
+        serializer.is_valid(raise_exception=True)
+        markers = serializer.validated_data if many else [serializer.validated_data]
+
+        watermarks = {marker["friend_id"]: marker.get("message_id") for marker in markers}
+        updated = Conversation.objects.mark_read(request.user.id, watermarks)
+        if updated:
+            notify_users([request.user.id], events.conversation_read(list(watermarks)))
+
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
+
+
+class SyncView(generics.GenericAPIView):
+    """
+    Changes since ?since=<cursor>: messages, conversation unread state and
+    friend requests. See api/sync.py.
+    """
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
+
     def get(self, request, *args, **kwargs):
-        friend_id = request.query_params.get('friend_id')
-        
-        if not friend_id:
-            return Response({'error': 'friend_id is required'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        current_user = request.user
-        
-        # Find the FriendRequest between current user and friend
-        # Check both directions since either could have sent the request
-        friend_request = FriendRequest.objects.filter(
-            from_user=friend_id,
-            to_user=current_user,
-            status='accepted'
-        ).first()
-        
-        if friend_request:
-            # They sent the original request, so we mark to_new_message as True
-            # (because WE are sending a message TO them)
-            friend_request.to_new_message = True
-            friend_request.save()
-        else:
-            # We sent the original request, so mark from_new_message as True
-            # (because WE are sending a message FROM us)
-            friend_request = FriendRequest.objects.filter(
-                from_user=current_user,
-                to_user=friend_id,
-                status='accepted'
-            ).first()
-            
-            if friend_request:
-                friend_request.from_new_message = True
-                friend_request.save()
-            else:
-                return Response({'error': 'Friend request not found'}, status=status.HTTP_404_NOT_FOUND)
-            
-        channel_layer = get_channel_layer()
-
-        async_to_sync(channel_layer.group_send)(
-            f"user_{friend_id}",
-            {
-                "type": "new_message_dot",
-                "event": "new_message_dot"
-            }
-        )
-        
-        return Response({'success': True}, status=status.HTTP_200_OK)
-    
+        try:
+            data = sync.delta(request.user.id, request.query_params.get("since"))
+        except ValueError:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data, status=status.HTTP_200_OK)
+
 
 class MessageListView(generics.ListAPIView):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
         friend_id = self.kwargs["friend_id"]
         user = self.request.user
         return Message.objects.filter(
-            (Q(sender=user) & Q(receiver_id=friend_id)) |
-            (Q(sender_id=friend_id) & Q(receiver=user))
-        ).order_by("timestamp")
+            (Q(sender_id=user.id) & Q(receiver_id=friend_id)) |
+            (Q(sender_id=friend_id) & Q(receiver_id=user.id))
+        )
+
+    def get_archive(self):
+        # Months moved out of the table by archive_messages
+        return archive.ConversationArchive(self.request.user.id, self.kwargs["friend_id"])
+
+    def get_serializer_context(self):
+        # is_read comes from the conversation's read watermarks
+        context = super().get_serializer_context()
+        context["conversation"] = Conversation.objects.find_pair(self.request.user.id, self.kwargs["friend_id"])
+        return context
 
 class MessageCreateView(generics.CreateAPIView):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
 
     def perform_create(self, serializer):
-        message = serializer.save(sender=self.request.user)
+        with transaction.atomic():
+            message = serializer.save(sender_id=self.request.user.id)
+            Conversation.objects.record_message(message)
+
+        # Notify both the receiver and the sender via WebSocket
+        notify_users(
+            [message.receiver_id, message.sender_id],
+            # serializer.data is cached, so the response reuses this rendering
+            events.new_message(serializer.data)
+        )
 
-        # Notify both the sender and receiver via WebSocket
-        channel_layer = get_channel_layer()
 
-        # Send to the receiver (assuming the receiver's ID is in the message)
-        receiver_id = message.receiver.id
+class MetricsView(generics.GenericAPIView):
+    """Prometheus scrape endpoint for this worker's metrics."""
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        if settings.METRICS_TOKEN:
+            supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+            if not hmac.compare_digest(supplied.encode(), settings.METRICS_TOKEN.encode()):
+                return Response(status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
-        async_to_sync(channel_layer.group_send)(
-            f"user_{receiver_id}",
-            {
-                "type": "chat_message",
-                "message": MessageSerializer(message).data  # Serialize the message
-            }
-        )
 
-        # Send to the sender (optional, if you want an acknowledgment)
-        async_to_sync(channel_layer.group_send)(
-            f"user_{message.sender.id}",
-            {
-                "type": "chat_message",
-                "message": MessageSerializer(message).data
-            }
-        )
\ No newline at end of file
+class ExportView(generics.GenericAPIView):
+    """
+    The caller's whole history as a gzip-compressed NDJSON download,
+    streamed as it is read. See api/export.py.
+    """
+    # Not a hot path: authenticate against the user row, so a deactivated
+    # account can't export with a token that hasn't expired yet
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        if isinstance(request._request, ASGIRequest):
+            chunks = export.agzip_chunks(request.user.id)
+        else:
+            chunks = export.gzip_chunks(request.user.id)
+        response = StreamingHttpResponse(chunks, content_type="application/gzip")
+        filename = f"chat-export-{request.user.username}-{timezone.now():%Y%m%d}.ndjson.gz"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        # Already compressed; keep GZipMiddleware or a proxy from doing it again
+        response["Cache-Control"] = "private, no-store, no-transform"
+        return response
+
+
+# Group rooms (see api/rooms.py)
+class RoomMixin:
+    def get_room_id(self):
+        # Non-members get the same answer as for a room that doesn't exist
+        room_id = self.kwargs["pk"]
+        if not rooms.is_member(self.request.user.id, room_id):
+            raise NotFound("Room not found")
+        return room_id
+
+
+class RoomListCreateView(generics.ListCreateAPIView):
+    """The caller's rooms, most recent activity first, with their unread counts."""
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
+    serializer_class = RoomSerializer
+
+    def get_queryset(self):
+        # Counted from the caller's watermark over the (room, id) index, so
+        # sending a message never has to touch member rows
+        unread = RoomMessage.objects.filter(room=OuterRef("pk"), id__gt=OuterRef("last_read_id")).order_by().values(
+            "room"
+        ).annotate(count=Count("id")).values("count")
+        return Room.objects.filter(members__user_id=self.request.user.id).annotate(
+            last_read_id=F("members__last_read_id")
+        ).annotate(
+            unread_count=Coalesce(Subquery(unread), Value(0))
+        ).order_by(F("last_message_at").desc(nulls_last=True), "-id")
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        member_ids = set(serializer.validated_data.get("member_ids", [])) - {request.user.id}
+        if not member_ids <= friendships.get_friend_ids(request.user.id):
+            return Response({"error": "Rooms can only be started with friends"}, status=status.HTTP_400_BAD_REQUEST)
+        room = rooms.create_room(request.user.id, serializer.validated_data["name"], member_ids)
+        return Response(RoomSerializer(room).data, status=status.HTTP_201_CREATED)
+
+
+class RoomDetailView(RoomMixin, generics.GenericAPIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
+
+    def get(self, request, *args, **kwargs):
+        room = Room.objects.get(pk=self.get_room_id())
+        members = RoomMember.objects.filter(room=room).select_related("user__profile").order_by("joined_at", "id")
+        return Response({
+            **RoomSerializer(room).data,
+            "members": RoomMemberSerializer(members, many=True).data,
+        })
+
+
+class RoomMembersView(RoomMixin, generics.GenericAPIView):
+    """POST adds the caller's friends to the room; DELETE removes a member (yourself, or anyone if you made the room)."""
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
+    serializer_class = RoomMembersSerializer
+
+    def post(self, request, *args, **kwargs):
+        room = Room.objects.get(pk=self.get_room_id())
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_ids = set(serializer.validated_data["user_ids"])
+        if not user_ids <= friendships.get_friend_ids(request.user.id):
+            return Response({"error": "Only friends can be added"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rooms.get_member_ids(room.id) | user_ids) > settings.ROOM_MAX_MEMBERS:
+            return Response({"error": "Room is full"}, status=status.HTTP_400_BAD_REQUEST)
+        added = rooms.add_members(room, user_ids)
+        return Response({"added": added}, status=status.HTTP_200_OK)
+
+    def delete(self, request, *args, **kwargs):
+        room = Room.objects.get(pk=self.get_room_id())
+        user_id = self.kwargs["user_id"]
+        if user_id != request.user.id and room.created_by_id != request.user.id:
+            return Response({"error": "Not authorized"}, status=status.HTTP_403_FORBIDDEN)
+        if not rooms.remove_member(room, user_id):
+            return Response({"error": "Not a member"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class RoomMessageListCreateView(RoomMixin, generics.ListCreateAPIView):
+    """A room's history, paginated like MessageListView, and posting to it."""
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
+    serializer_class = RoomMessageSerializer
+    pagination_class = MessageCursorPagination
+
+    def get_queryset(self):
+        return RoomMessage.objects.filter(room_id=self.get_room_id())
+
+    def perform_create(self, serializer):
+        room_id = self.get_room_id()
+        serializer.instance = rooms.record_message(room_id, self.request.user.id, serializer.validated_data["content"])
+        # One group_send reaches every member's sockets
+        rooms.publish(room_id, events.room_message(events.room_message_data(serializer.instance)))
+
+
+class RoomReadView(RoomMixin, generics.GenericAPIView):
+    """Advances the caller's read watermark in the room. One UPDATE."""
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [ClaimsJWTAuthentication]
+    serializer_class = RoomReadSerializer
+
+    def post(self, request, *args, **kwargs):
+        room_id = self.get_room_id()
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        message_id = serializer.validated_data["message_id"]
+        updated = rooms.mark_read(room_id, request.user.id, message_id)
+        if updated:
+            notify_users([request.user.id], events.room_read(room_id, message_id))
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
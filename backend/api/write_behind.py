@@ -0,0 +1,163 @@
+import asyncio
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import ids, metrics
+from .log import log
+from .metrics import database_sync_to_async
+from .models import Message, Conversation
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBehind:
+    """
+    Bounded in-process queue of messages that have already been broadcast
+    and still need to be inserted. It is flushed with bulk_create every
+    MESSAGE_WRITE_BEHIND_INTERVAL_MS or as soon as MESSAGE_WRITE_BEHIND_BATCH
+    messages are waiting, whichever comes first. When the queue is full,
+    submit() waits for a flush instead of dropping messages.
+    """
+
+    def __init__(self, batch_size, interval, max_queue):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queue = max_queue
+        self._queue = []
+        self._lock = threading.Lock()
+        self._flush_lock = None
+        self._flusher = None
+        self._wakeup = None
+        self.stats = {"enqueued": 0, "flushed": 0, "batches": 0, "failed": 0, "max_depth": 0}
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def build(self, sender_id, receiver_id, content):
+        # The id comes from api/ids.py like every other message's, so it
+        # can be broadcast before the row exists
+        return Message(
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            content=content,
+            timestamp=timezone.now(),
+        )
+
+    async def submit(self, message):
+        self.ensure_flusher()
+        if self.depth >= self.max_queue:
+            metrics.WRITE_BEHIND_FULL.inc()
+            await self.flush()
+        with self._lock:
+            self._queue.append(message)
+            self.stats["enqueued"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(self._queue))
+            metrics.WRITE_BEHIND_DEPTH.set(len(self._queue))
+            full = len(self._queue) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flush_lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.get_running_loop().create_task(self.run_flusher())
+
+    async def run_flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log(logger, logging.ERROR, "write_behind.flush_failed", exc_info=True)
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self.depth:
+                batch = self._take(self.batch_size)
+                await database_sync_to_async(self.write)(batch)
+
+    def drain(self):
+        """Synchronously write everything still queued. Used at shutdown."""
+        while self.depth:
+            self.write(self._take(self.batch_size))
+
+    def _take(self, count):
+        with self._lock:
+            batch, self._queue = self._queue[:count], self._queue[count:]
+            metrics.WRITE_BEHIND_DEPTH.set(len(self._queue))
+        return batch
+
+    def write(self, batch):
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+                Conversation.objects.record_messages(batch)
+            written = batch
+        except IntegrityError:
+            # One bad row (say, a receiver deleted in the meantime) must not
+            # take the rest of the batch with it.
+            written = []
+            for message in batch:
+                if self._write_one(message):
+                    written.append(message)
+        self.stats["flushed"] += len(written)
+        metrics.WRITE_BEHIND_ROWS.labels(result="flushed").inc(len(written))
+        self.stats["batches"] += 1
+        return written
+
+    def _write_one(self, message):
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+                Conversation.objects.record_message(message)
+            return True
+        except IntegrityError as exc:
+            error = exc
+        if Message.objects.filter(id=message.id).exists():
+            # Id collision, which means two processes share a worker id;
+            # keep the content under a fresh id.
+            try:
+                with transaction.atomic():
+                    message.id = ids.next_message_id()
+                    message.save(force_insert=True)
+                    Conversation.objects.record_message(message)
+                return True
+            except IntegrityError as exc:
+                error = exc
+        self.stats["failed"] += 1
+        metrics.WRITE_BEHIND_ROWS.labels(result="failed").inc()
+        log(
+            logger, logging.ERROR, "write_behind.dropped",
+            sender_id=message.sender_id, receiver_id=message.receiver_id, error=repr(error),
+        )
+        return False
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = MessageWriteBehind(
+                    batch_size=settings.MESSAGE_WRITE_BEHIND_BATCH,
+                    interval=settings.MESSAGE_WRITE_BEHIND_INTERVAL_MS / 1000,
+                    max_queue=settings.MESSAGE_WRITE_BEHIND_MAX_QUEUE,
+                )
+                atexit.register(_writer.drain)
+    return _writer
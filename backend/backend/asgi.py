@@ -5,15 +5,15 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
 from django.core.asgi import get_asgi_application
 django_asgi_app = get_asgi_application()
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from api import routing
+from api.authentication import JWTAuthMiddleware
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        JWTAuthMiddleware(
             URLRouter(routing.websocket_urlpatterns)
         )
     ),
@@ -19,18 +19,158 @@ ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', '').split(',')
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "api.authentication.CachedJWTAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": (
         "rest_framework.permissions.IsAuthenticated",
     ),
 }
 
+# Message history pages for /api/messages/<friend_id>/
+MESSAGE_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE', '50'))
+MESSAGE_MAX_PAGE_SIZE = int(os.environ.get('MESSAGE_MAX_PAGE_SIZE', '200'))
+
+# Typing indicators: "typing" is re-sent to the receiver at most every
+# TYPING_RESEND_INTERVAL seconds, and a sender silent for TYPING_TIMEOUT
+# seconds is reported as stopped.
+TYPING_RESEND_INTERVAL = float(os.environ.get('TYPING_RESEND_INTERVAL', '3'))
+TYPING_TIMEOUT = float(os.environ.get('TYPING_TIMEOUT', '8'))
+
+# Sequenced delivery: per-user event counters and the last EVENT_BUFFER_SIZE
+# events per user, shared through Redis when EVENT_BUFFER_REDIS_URL (or
+# REDIS_URL) is set. Idle users' buffers expire after EVENT_BUFFER_TTL seconds.
+EVENT_BUFFER_REDIS_URL = os.environ.get('EVENT_BUFFER_REDIS_URL', os.environ.get('REDIS_URL'))
+EVENT_BUFFER_SIZE = int(os.environ.get('EVENT_BUFFER_SIZE', '200'))
+EVENT_BUFFER_TTL = int(os.environ.get('EVENT_BUFFER_TTL', '3600'))
+
+# Delta sync: how many messages one sync returns, and how far the
+# returned cursor trails the clock to cover rows that commit late.
+SYNC_MAX_MESSAGES = int(os.environ.get('SYNC_MAX_MESSAGES', '500'))
+SYNC_GRACE_SECONDS = int(os.environ.get('SYNC_GRACE_SECONDS', '5'))
+
+# A socket that connects without a sync cursor is sent a "bootstrap" event
+# (profile, friends with unread state, pending requests) in place of the
+# empty first sync, so the client needs no REST calls to draw its first
+# screen. See api/bootstrap.py.
+WS_BOOTSTRAP = os.environ.get('WS_BOOTSTRAP', 'True') == 'True'
+
+# Messages are kept in the table for MESSAGE_HOT_MONTHS whole months before
+# archive_messages moves them to gzip files in the "message_archive"
+# storage (MESSAGE_ARCHIVE_ROOT); MessageListView reads them back for deep
+# scrollback. On PostgreSQL the table is partitioned by month, and the
+# command keeps MESSAGE_PARTITION_MONTHS_AHEAD future partitions created.
+MESSAGE_HOT_MONTHS = int(os.environ.get('MESSAGE_HOT_MONTHS', '6'))
+MESSAGE_PARTITION_MONTHS_AHEAD = int(os.environ.get('MESSAGE_PARTITION_MONTHS_AHEAD', '3'))
+# The default sits on the persistent volume mounted at /code/media (fly.toml)
+MESSAGE_ARCHIVE_ROOT = os.environ.get('MESSAGE_ARCHIVE_ROOT', str(BASE_DIR / 'media' / 'message_archive'))
+
+# Group rooms: membership is cached in ROOM_CACHE_ALIAS, which must be a
+# shared cache (Redis, Memcached) when more than one worker serves requests.
+ROOM_CACHE_ALIAS = os.environ.get('ROOM_CACHE_ALIAS', 'default')
+ROOM_CACHE_TIMEOUT = int(os.environ.get('ROOM_CACHE_TIMEOUT', '3600'))
+ROOM_MAX_MEMBERS = int(os.environ.get('ROOM_MAX_MEMBERS', '256'))
+
+# User search result pages
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', '20'))
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get('SEARCH_MAX_PAGE_SIZE', '50'))
+
+# Friendship adjacency cache. Leave FRIENDSHIP_CACHE_ALIAS unset for a
+# per-process LRU, or point it at an entry in CACHES to share it across workers.
+FRIENDSHIP_CACHE_ALIAS = os.environ.get('FRIENDSHIP_CACHE_ALIAS') or None
+FRIENDSHIP_CACHE_MAX_USERS = int(os.environ.get('FRIENDSHIP_CACHE_MAX_USERS', '10000'))
+FRIENDSHIP_CACHE_TIMEOUT = int(os.environ.get('FRIENDSHIP_CACHE_TIMEOUT', '3600'))
+
+# Presence: live connections are counted in Redis when PRESENCE_REDIS_URL (or
+# REDIS_URL) is set, otherwise per process. Each worker refreshes its sockets
+# every PRESENCE_SWEEP_INTERVAL seconds; entries not refreshed within
+# PRESENCE_TTL are treated as left behind by a crashed worker.
+PRESENCE_REDIS_URL = os.environ.get('PRESENCE_REDIS_URL', os.environ.get('REDIS_URL'))
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', '60'))
+PRESENCE_SWEEP_INTERVAL = int(os.environ.get('PRESENCE_SWEEP_INTERVAL', '10'))
+
+# Upper bound on concurrent group_sends for one broadcast
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '64'))
+
+# Write-behind persistence for WebSocket messages. When enabled, messages get
+# an id on the worker, are broadcast straight away and are inserted with
+# bulk_create every MESSAGE_WRITE_BEHIND_INTERVAL_MS or
+# MESSAGE_WRITE_BEHIND_BATCH messages. Anything queued is written on exit.
+MESSAGE_WRITE_BEHIND = os.environ.get('MESSAGE_WRITE_BEHIND', 'False') == 'True'
+MESSAGE_WRITE_BEHIND_BATCH = int(os.environ.get('MESSAGE_WRITE_BEHIND_BATCH', '200'))
+MESSAGE_WRITE_BEHIND_INTERVAL_MS = int(os.environ.get('MESSAGE_WRITE_BEHIND_INTERVAL_MS', '50'))
+MESSAGE_WRITE_BEHIND_MAX_QUEUE = int(os.environ.get('MESSAGE_WRITE_BEHIND_MAX_QUEUE', '10000'))
+
+# Every message id comes from a generator on the worker (api/ids.py), so each
+# process that creates messages needs its own MESSAGE_WORKER_ID (0-31). There
+# is no default: two processes with the same id could hand out the same ids.
+MESSAGE_WORKER_ID = int(os.environ['MESSAGE_WORKER_ID']) if os.environ.get('MESSAGE_WORKER_ID') else None
+
+# Logs are JSON lines on stderr at LOG_LEVEL. Per-frame WebSocket logs are
+# debug level and only WS_FRAME_LOG_SAMPLE_RATE of them are kept.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+WS_FRAME_LOG_SAMPLE_RATE = float(os.environ.get('WS_FRAME_LOG_SAMPLE_RATE', '0.01'))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "json": {"()": "api.log.JsonFormatter"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "json"},
+    },
+    "loggers": {
+        "api": {"handlers": ["console"], "level": LOG_LEVEL, "propagate": False},
+    },
+}
+
+# Query profiling for every HTTP request and WebSocket event. Requests that
+# take DB_PROFILE_SLOW_MS or run DB_PROFILE_MAX_QUERIES queries are logged
+# with their DB_PROFILE_TOP_QUERIES slowest statements, and
+# DB_PROFILE_TRACE_SAMPLE_RATE of those with every statement (up to
+# DB_PROFILE_MAX_TRACE). DB_PROFILE_HEADERS adds X-DB-Queries, X-DB-Time-Ms
+# and Server-Timing to HTTP responses.
+DB_PROFILE = os.environ.get('DB_PROFILE', 'True') == 'True'
+DB_PROFILE_HEADERS = os.environ.get('DB_PROFILE_HEADERS', str(DEBUG)) == 'True'
+DB_PROFILE_SLOW_MS = float(os.environ.get('DB_PROFILE_SLOW_MS', '250'))
+DB_PROFILE_MAX_QUERIES = int(os.environ.get('DB_PROFILE_MAX_QUERIES', '25'))
+DB_PROFILE_TOP_QUERIES = int(os.environ.get('DB_PROFILE_TOP_QUERIES', '3'))
+DB_PROFILE_TRACE_SAMPLE_RATE = float(os.environ.get('DB_PROFILE_TRACE_SAMPLE_RATE', '0.1'))
+DB_PROFILE_MAX_TRACE = int(os.environ.get('DB_PROFILE_MAX_TRACE', '200'))
+
+# Uploaded profile pictures are re-encoded without metadata to a JPEG at most
+# PROFILE_PICTURE_MAX_SIZE pixels on a side, plus square WebP and JPEG
+# thumbnails for each of PROFILE_THUMBNAIL_SIZES. This runs on
+# IMAGE_PROCESSING_WORKERS background threads unless IMAGE_PROCESSING_ASYNC
+# is off.
+PROFILE_PICTURE_MAX_SIZE = int(os.environ.get('PROFILE_PICTURE_MAX_SIZE', '1024'))
+PROFILE_THUMBNAIL_SIZES = [int(size) for size in os.environ.get('PROFILE_THUMBNAIL_SIZES', '64,128,256').split(',')]
+IMAGE_PROCESSING_ASYNC = os.environ.get('IMAGE_PROCESSING_ASYNC', 'True') == 'True'
+IMAGE_PROCESSING_WORKERS = int(os.environ.get('IMAGE_PROCESSING_WORKERS', '2'))
+
+# ETags and a per-user response cache for the profile, friend list, friend
+# request and inbox endpoints. Version tokens live in RESPONSE_CACHE_ALIAS,
+# which must be shared (Redis, Memcached) when more than one worker serves
+# requests, or a worker that missed a change keeps answering 304.
+CONDITIONAL_GET = os.environ.get('CONDITIONAL_GET', 'True') == 'True'
+RESPONSE_CACHE_ALIAS = os.environ.get('RESPONSE_CACHE_ALIAS', 'default')
+RESPONSE_CACHE_TIMEOUT = int(os.environ.get('RESPONSE_CACHE_TIMEOUT', '300'))
+
+# Prometheus metrics are served at /api/metrics/. When METRICS_TOKEN is set,
+# scrapes must send it as "Authorization: Bearer <token>".
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
+    "TOKEN_OBTAIN_SERIALIZER": "api.serializers.ChatTokenObtainPairSerializer",
+    "TOKEN_USER_CLASS": "api.authentication.ClaimsUser",
 }
 
+# Full User rows needed after JWT validation are cached here
+USER_CACHE_ALIAS = os.environ.get('USER_CACHE_ALIAS', 'default')
+USER_CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TIMEOUT', '300'))
+
 INSTALLED_APPS = [
     'daphne',
     'django.contrib.admin',
@@ -47,6 +187,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'api.profiling.DBProfileMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -139,4 +280,9 @@ STORAGES = {
     "staticfiles": {
         "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
     },
+    # Private: never behind MEDIA_URL, whose bucket is public-read
+    "message_archive": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+        "OPTIONS": {"location": MESSAGE_ARCHIVE_ROOT},
+    },
 }
\ No newline at end of file
@@ -1,4 +1,5 @@
 import React from "react";
+import { profilePictureUrl } from "../images";
 
 const Friend = ({ profile, id, sendFriendRequest }) => {
   function timeAgo(dateString) {
@@ -27,7 +28,7 @@ const Friend = ({ profile, id, sendFriendRequest }) => {
           className={`friend-image ${
             profile.is_online ? "friend-online" : "friend-offline"
           }`}
-          src={profile.profile_picture}
+          src={profilePictureUrl(profile, 40)}
         />
       </div>
       <div className="friend-info">
@@ -1,4 +1,5 @@
 import React from "react";
+import { profilePictureUrl } from "../images";
 
 const Friend = ({
   profile,
@@ -41,7 +42,7 @@ const Friend = ({
           className={`friend-image ${
             profile.is_online ? "friend-online" : "friend-offline"
           }`}
-          src={profile.profile_picture}
+          src={profilePictureUrl(profile, 40)}
         />
       </div>
       <div className="friend-info">
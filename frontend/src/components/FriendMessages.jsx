@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from "react";
 import "../styles/Messages.css";
 import MessageImage from "../assets/message.png";
+import { profilePictureUrl } from "../images";
 
 const useMediaQuery = (query) => {
   const [matches, setMatches] = useState(false);
@@ -55,7 +56,7 @@ const FriendMessages = ({
             }}
           >
             <img
-              src={friend.profile_picture}
+              src={profilePictureUrl(friend, 40)}
               className="messages-pic"
               alt={`${friend.first_name} ${friend.last_name}`}
             />
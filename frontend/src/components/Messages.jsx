@@ -9,6 +9,7 @@ import rehypeKatex from "rehype-katex";
 import rehypeHighlight from "rehype-highlight"; // Code syntax highlighting
 import "katex/dist/katex.min.css";
 import "highlight.js/styles/github-dark.css"; // Code highlighting theme
+import { profilePictureUrl } from "../images";
 
 const Messages = ({ friend, currentUserId, ws }) => {
   const [messages, setMessages] = useState([]);
@@ -19,6 +20,9 @@ const Messages = ({ friend, currentUserId, ws }) => {
   const [shouldScroll, setShouldScroll] = useState(false);
   const [isTyping, setIsTyping] = useState(false);
   const [friendTyping, setFriendTyping] = useState(false);
+  const [olderMessagesUrl, setOlderMessagesUrl] = useState(null);
+  const loadingOlderRef = useRef(false);
+  const typingSentAtRef = useRef(0);
   const GROUP_THRESHOLD = 2 * 60 * 1000; // 2 minutes
 
   const shouldShowTimestamp = (msg, nextMsg) => {
@@ -34,9 +38,14 @@ const Messages = ({ friend, currentUserId, ws }) => {
     if (!ws?.current) return;
 
     const typingState = text.trim() !== "";
+    // While typing, refresh now and then so the server's stop timeout
+    // doesn't fire mid-sentence; it drops the repeats it doesn't need.
+    const refresh =
+      typingState && Date.now() - typingSentAtRef.current > 2000;
 
-    if (typingState !== isTyping) {
+    if (typingState !== isTyping || refresh) {
       setIsTyping(typingState);
+      typingSentAtRef.current = Date.now();
 
       ws.current.send(
         JSON.stringify({
@@ -78,7 +87,9 @@ const Messages = ({ friend, currentUserId, ws }) => {
     const fetchMessages = async () => {
       try {
         const res = await api.get(`/api/messages/${friend.user_id}/`);
-        setMessages(res.data);
+        // Pages come back newest first
+        setMessages([...res.data.results].reverse());
+        setOlderMessagesUrl(res.data.next);
         setTimeout(() => {
           scrollToBottomInstant();
         }, 1);
@@ -102,7 +113,10 @@ const Messages = ({ friend, currentUserId, ws }) => {
       ) {
         const msg = data.message;
         if (msg.sender === friend.user_id || msg.receiver === friend.user_id) {
-          setMessages((prev) => [...prev, msg]);
+          // Replayed events can repeat a message we already have
+          setMessages((prev) =>
+            prev.some((m) => m.id === msg.id) ? prev : [...prev, msg],
+          );
           if (msg.sender == String(currentUserId)) {
             setNewMessage(false);
             setShouldScroll(true); // tell effect to scroll once message is rendered
@@ -112,6 +126,20 @@ const Messages = ({ friend, currentUserId, ws }) => {
         }
       }
 
+      if (data.event === "sync" && data.messages.length) {
+        // Replayed after a reconnect; some may already be on screen
+        const missed = data.messages.filter(
+          (msg) =>
+            msg.sender === friend.user_id || msg.receiver === friend.user_id,
+        );
+        if (missed.length) {
+          setMessages((prev) => {
+            const seen = new Set(prev.map((msg) => msg.id));
+            return [...prev, ...missed.filter((msg) => !seen.has(msg.id))];
+          });
+        }
+      }
+
       if (data.event === "typing_indicator") {
         if (data.user_id === friend.user_id) {
           // Update typing status for the friend
@@ -129,20 +157,42 @@ const Messages = ({ friend, currentUserId, ws }) => {
     return () => ws.current.removeEventListener("message", handleMessage);
   }, [friend.id, ws]);
 
+  // Load the previous page of history, keeping the scroll position steady
+  const fetchOlderMessages = async () => {
+    const box = messageContentRef.current;
+    if (!olderMessagesUrl || loadingOlderRef.current || !box) return;
+    loadingOlderRef.current = true;
+    try {
+      const previousHeight = box.scrollHeight;
+      const res = await api.get(olderMessagesUrl);
+      setMessages((prev) => [...[...res.data.results].reverse(), ...prev]);
+      setOlderMessagesUrl(res.data.next);
+      requestAnimationFrame(() => {
+        box.scrollTop = box.scrollHeight - previousHeight;
+      });
+    } catch (err) {
+      console.error("Error fetching older messages:", err);
+    } finally {
+      loadingOlderRef.current = false;
+    }
+  };
+
   useEffect(() => {
     const box = messageContentRef.current;
 
     const handleScroll = () => {
-      console.log("Box scrolled:", box.scrollTop);
       if (isAtBottom()) {
         setNewMessage(false);
       }
+      if (box.scrollTop === 0) {
+        fetchOlderMessages();
+      }
     };
 
     box.addEventListener("scroll", handleScroll);
 
     return () => box.removeEventListener("scroll", handleScroll);
-  }, []);
+  }, [olderMessagesUrl]);
 
   useEffect(() => {
     if (shouldScroll) {
@@ -176,13 +226,6 @@ const Messages = ({ friend, currentUserId, ws }) => {
         console.error("Error:", err);
       }
     }
-    try {
-      await api.get(
-        `/api/change_new_message_true/?friend_id=${friend.user_id}`
-      );
-    } catch (err) {
-      console.error("Error updating new message status:", err);
-    }
 
     setText("");
   };
@@ -224,7 +267,7 @@ const Messages = ({ friend, currentUserId, ws }) => {
     <div className="message-container">
       <div className="message-header">
         <img
-          src={friend.profile_picture}
+          src={profilePictureUrl(friend, 100)}
           alt={`${friend.first_name} ${friend.last_name}`}
           className="message-header-pic"
         />
@@ -11,9 +11,11 @@ const SearchProfiles = () => {
   const performSearch = useCallback(async () => {
     if (!searchQuery) return;
     try {
-      const res = await api.get(`/api/users/search/?q=${searchQuery}`);
-      setSearchResults(res.data);
-      console.log("Search results:", res.data);
+      const res = await api.get("/api/users/search/", {
+        params: { q: searchQuery },
+      });
+      setSearchResults(res.data.results);
+      console.log("Search results:", res.data.results);
     } catch (err) {
       console.error("Error searching users:", err);
     }
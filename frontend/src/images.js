@@ -0,0 +1,12 @@
+// Smallest thumbnail that covers `size` CSS pixels on this screen, falling
+// back to the full picture until the server has made thumbnails.
+export function profilePictureUrl(profile, size) {
+  const variants = profile?.profile_picture_urls || {};
+  const sizes = Object.keys(variants)
+    .map(Number)
+    .sort((a, b) => a - b);
+  if (sizes.length === 0) return profile?.profile_picture;
+  const wanted = size * (window.devicePixelRatio || 1);
+  const match = sizes.find((available) => available >= wanted) ?? sizes[sizes.length - 1];
+  return variants[match].webp || variants[match].jpeg;
+}
@@ -1,5 +1,6 @@
 import React, { useState, useEffect, useCallback, act } from "react";
 import api from "../api";
+import { ACCESS_TOKEN } from "../constants";
 import { jwtDecode } from "jwt-decode";
 import "../styles/Friends.css";
 import FriendsImage from "../assets/friends.png";
@@ -12,6 +13,7 @@ import PendingFriends from "../components/PendingFriend";
 import FriendMessages from "../components/FriendMessages";
 import Messages from "../components/Messages";
 import MessageImage from "../assets/message.png";
+import { profilePictureUrl } from "../images";
 
 const useMediaQuery = (query) => {
   const [matches, setMatches] = useState(false);
@@ -149,17 +151,140 @@ const Friends = () => {
     [fetchPendingRequests],
   );
 
+  const applyProfile = useCallback((profile) => {
+    setFirstName(profile.first_name);
+    setLastName(profile.last_name);
+    setProfilePic(profilePictureUrl(profile, 40));
+    setUsername(profile.username);
+  }, []);
+
   const getUserFullName = useCallback(async () => {
     try {
       const res = await api.get(`/api/profile/`);
-      setFirstName(res.data.first_name);
-      setLastName(res.data.last_name);
-      setProfilePic(res.data.profile_picture);
-      setUsername(res.data.username);
+      applyProfile(res.data);
     } catch (err) {
       console.error("Error fetching user full name:", err);
     }
-  }, [userId]);
+  }, [applyProfile]);
+
+  // Everything the first screen needs, for servers that don't bootstrap
+  const fetchInitialState = useCallback(() => {
+    fetchFriends();
+    fetchPendingRequests();
+    getUserFullName();
+    fetchHasNewMessage();
+  }, [fetchFriends, fetchPendingRequests, getUserFullName, fetchHasNewMessage]);
+
+  // The socket's first event for a client without a sync cursor
+  const applyBootstrap = useCallback(
+    (data) => {
+      if (data.profile) {
+        applyProfile(data.profile);
+      }
+      setFriends(data.friends);
+      setHasNewMessage(data.friends);
+      setPendingRequests(data.incoming);
+    },
+    [applyProfile],
+  );
+
+  // Delta sync: keep the cursor and refresh whatever changed while away
+  const syncCursorRef = React.useRef(null);
+
+  // Every event up to lastSeqRef has been handled; that is what gets
+  // acknowledged (at most once a second) and resumed from. Group sends run
+  // concurrently, so later events can overtake earlier ones: those wait in
+  // seenSeqsRef until the gap closes, or are replayed if it doesn't.
+  const lastSeqRef = React.useRef(null);
+  const seenSeqsRef = React.useRef(new Set());
+  const ackTimerRef = React.useRef(null);
+  const gapTimerRef = React.useRef(null);
+
+  const resetSeq = (seq) => {
+    lastSeqRef.current = seq;
+    seenSeqsRef.current.clear();
+    clearTimeout(gapTimerRef.current);
+    gapTimerRef.current = null;
+  };
+
+  // False for an event that was already handled
+  const trackSeq = (seq) => {
+    const seen = seenSeqsRef.current;
+    if (lastSeqRef.current === null) {
+      lastSeqRef.current = seq - 1;
+    }
+    if (seq <= lastSeqRef.current || seen.has(seq)) return false;
+    seen.add(seq);
+    while (seen.has(lastSeqRef.current + 1)) {
+      lastSeqRef.current += 1;
+      seen.delete(lastSeqRef.current);
+    }
+    if (seen.size === 0) {
+      clearTimeout(gapTimerRef.current);
+      gapTimerRef.current = null;
+    } else if (!gapTimerRef.current) {
+      gapTimerRef.current = setTimeout(requestReplay, 2000);
+    }
+    return true;
+  };
+
+  // A gap that is still open is filled from the server's event buffer
+  const requestReplay = () => {
+    gapTimerRef.current = null;
+    const socket = wRef.current;
+    if (seenSeqsRef.current.size === 0) return;
+    if (socket && socket.readyState === WebSocket.OPEN) {
+      socket.send(
+        JSON.stringify({
+          type: "replay",
+          seq: lastSeqRef.current,
+          since: syncCursorRef.current,
+        }),
+      );
+    }
+  };
+
+  const scheduleAck = () => {
+    if (ackTimerRef.current) return;
+    ackTimerRef.current = setTimeout(() => {
+      ackTimerRef.current = null;
+      const socket = wRef.current;
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({ type: "ack", seq: lastSeqRef.current }));
+      }
+    }, 1000);
+  };
+
+  const applySync = useCallback(
+    async (data) => {
+      let delta = data;
+      let changed = false;
+      while (true) {
+        syncCursorRef.current = delta.cursor;
+        if (delta.conversations.length || delta.messages.length) {
+          changed = true;
+        }
+        if (delta.friend_requests.length) {
+          fetchFriends();
+          fetchPendingRequests();
+        }
+        if (!delta.has_more) break;
+        try {
+          const res = await api.get("/api/sync/", {
+            params: { since: delta.cursor },
+          });
+          delta = res.data;
+        } catch (err) {
+          console.error("Error syncing:", err);
+          break;
+        }
+      }
+      if (changed || data.reset) {
+        fetchHasNewMessage();
+      }
+    },
+    [fetchFriends, fetchPendingRequests, fetchHasNewMessage],
+  );
 
   // Decode JWT on mount
   useEffect(() => {
@@ -175,22 +300,6 @@ const Friends = () => {
     }
   }, []);
 
-  // Fetch friends once authenticated
-  useEffect(() => {
-    if (isAuthenticated && userId) {
-      fetchFriends();
-      fetchPendingRequests();
-      getUserFullName();
-      fetchHasNewMessage();
-    }
-  }, [
-    isAuthenticated,
-    userId,
-    fetchFriends,
-    fetchPendingRequests,
-    fetchHasNewMessage,
-  ]);
-
   // WebSocket connection
   useEffect(() => {
     if (!isAuthenticated || !userId) return;
@@ -208,9 +317,18 @@ const Friends = () => {
       }
 
       console.log("🔄 Connecting WebSocket...");
+      // The server authenticates the socket from the JWT access token
+      const token = localStorage.getItem(ACCESS_TOKEN);
+      // On reconnect the server replays what changed since this cursor
+      let since = syncCursorRef.current
+        ? `&since=${encodeURIComponent(syncCursorRef.current)}`
+        : "";
+      if (lastSeqRef.current !== null) {
+        since += `&seq=${lastSeqRef.current}`;
+      }
       socket = new WebSocket(
-        // `ws://10.195.149.38:8000/ws/friends/?user_id=${userId}` // Change to your IP for mobile
-        `wss://api.alexehlebracht.com/chat/ws/friends/?user_id=${userId}`,
+        // `ws://10.195.149.38:8000/ws/friends/?token=${token}${since}` // Change to your IP for mobile
+        `wss://api.alexehlebracht.com/chat/ws/friends/?token=${token}${since}`,
       );
 
       wRef.current = socket;
@@ -237,6 +355,37 @@ const Friends = () => {
           return;
         }
 
+        // A frame we sent was rejected, e.g. a message to a non-friend
+        if (data.event === "error") {
+          console.error("WebSocket frame rejected:", data.error);
+          return;
+        }
+
+        // Sent instead of a sync when connecting without a cursor
+        if (data.event === "bootstrap") {
+          resetSeq(data.seq);
+          syncCursorRef.current = data.cursor;
+          applyBootstrap(data);
+          return;
+        }
+
+        if (data.event === "sync") {
+          if (syncCursorRef.current === null) {
+            fetchInitialState();
+          }
+          resetSeq(data.seq);
+          applySync(data);
+          return;
+        }
+
+        if (data.seq !== undefined) {
+          // Sequenced events may arrive out of order or twice (replays)
+          if (!trackSeq(data.seq)) {
+            return;
+          }
+          scheduleAck();
+        }
+
         if (data.event === "online_status") {
           fetchFriends();
           fetchHasNewMessage();
@@ -251,14 +400,22 @@ const Friends = () => {
           fetchHasNewMessage();
         }
         console.log("WebSocket message received:", data.event);
-        if (data.event === "new_message_dot") {
-          fetchHasNewMessage();
-          console.log(friendRef.current);
-          console.log(activeTabRef.current);
-          if (friendRef.current && activeTabRef.current === "Messages") {
-            setHasNewMessageFalse(friendRef.current);
+        if (data.event === "new_message") {
+          const msg = data.message;
+          if (
+            friendRef.current &&
+            activeTabRef.current === "Messages" &&
+            msg.sender === friendRef.current.user_id
+          ) {
+            // Already looking at this conversation
+            setHasNewMessageFalse(friendRef.current, msg.id);
+          } else if (String(msg.sender) !== String(userId)) {
+            fetchHasNewMessage();
           }
         }
+        if (data.event === "conversation_read") {
+          fetchHasNewMessage();
+        }
       };
 
       socket.onerror = (err) => {
@@ -324,6 +481,9 @@ const Friends = () => {
         clearTimeout(reconnectTimer);
       }
 
+      clearTimeout(gapTimerRef.current);
+      gapTimerRef.current = null;
+
       if (pingInterval) {
         clearInterval(pingInterval);
       }
@@ -338,6 +498,9 @@ const Friends = () => {
     fetchFriends,
     fetchPendingRequests,
     fetchHasNewMessage,
+    applySync,
+    applyBootstrap,
+    fetchInitialState,
   ]);
 
   // Refresh on tab change
@@ -346,11 +509,12 @@ const Friends = () => {
     if (activeTab === "Pending") fetchPendingRequests();
   }, [activeTab, fetchFriends, fetchPendingRequests]);
 
-  const setHasNewMessageFalse = async (friend) => {
+  const setHasNewMessageFalse = async (friend, messageId = null) => {
     try {
-      const res = await api.get(
-        `/api/change_new_message/?friend_id=${friend.user_id}`,
-      );
+      const res = await api.post("/api/messages/read/", {
+        friend_id: friend.user_id,
+        message_id: messageId,
+      });
 
       console.log("Set has new message false response:", res);
       if (res.status === 200) {